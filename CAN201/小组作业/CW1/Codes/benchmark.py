@@ -0,0 +1,847 @@
+import argparse
+import atexit
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import time
+import tracemalloc
+from threading import Barrier, Thread
+
+import safe_server as server
+
+
+def legacy_get_tcp_packet(conn):
+    """
+    The original get_tcp_packet (bytes += and re-slicing), kept here as the baseline.
+    Only the recv sizes are limited to the remaining bytes: the original asks for the whole section
+    again on every iteration and would read into the next packet of a pipelined stream.
+    :param conn: the TCP connection
+    :return:
+        json_data
+        bin_data
+    """
+    bin_data = b''
+    while len(bin_data) < 8:
+        data_rec = conn.recv(8 - len(bin_data))
+        if data_rec == b'':
+            return None, None
+        bin_data += data_rec
+    data = bin_data[:8]
+    bin_data = bin_data[8:]
+    j_len, b_len = struct.unpack('!II', data)
+    while len(bin_data) < j_len:
+        data_rec = conn.recv(j_len - len(bin_data))
+        if data_rec == b'':
+            return None, None
+        bin_data += data_rec
+    j_bin = bin_data[:j_len]
+    try:
+        json_data = json.loads(j_bin.decode())
+    except Exception as ex:
+        return None, None
+    bin_data = bin_data[j_len:]
+    while len(bin_data) < b_len:
+        data_rec = conn.recv(b_len - len(bin_data))
+        if data_rec == b'':
+            return None, None
+        bin_data += data_rec
+    return json_data, bin_data
+
+
+def legacy_get_file_md5(filename):
+    """
+    The original get_file_md5 (2 KB reads), kept here as the baseline.
+    """
+    m = hashlib.md5()
+    with open(filename, 'rb') as fid:
+        while True:
+            d = fid.read(2048)
+            if not d:
+                break
+            m.update(d)
+    return m.hexdigest()
+
+
+def legacy_make_packet(json_data, bin_data=None):
+    """
+    The original make_packet (header + json + data concatenated), kept here as the baseline.
+    """
+    j = json.dumps(dict(json_data), ensure_ascii=False)
+    j_len = len(j)
+    if bin_data is None:
+        return struct.pack('!II', j_len, 0) + j.encode()
+    else:
+        return struct.pack('!II', j_len, len(bin_data)) + j.encode() + bin_data
+
+
+def legacy_send_block(conn, file_path, block_size, block_index):
+    """
+    The original DOWNLOAD send path (open, seek, read, concatenate into one packet), kept here as the baseline.
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as fid:
+        fid.seek(block_size * block_index)
+        bin_data = fid.read(min(block_size, file_size - block_size * block_index))
+        rval = {server.FIELD_BLOCK_INDEX: block_index, server.FIELD_KEY: file_path, server.FIELD_SIZE: len(bin_data)}
+        conn.sendall(server.make_response_packet(server.OP_DOWNLOAD, 200, server.TYPE_FILE, 'An available block.',
+                                                 rval, bin_data))
+
+
+def sendfile_send_block(open_files):
+    """
+    The DOWNLOAD send path of safe_server: a kept open file and send_file_packet.
+    """
+    def send_block(conn, file_path, block_size, block_index):
+        fid, file_size = open_files.get(file_path)
+        offset = block_size * block_index
+        count = min(block_size, file_size - offset)
+        rval = {server.FIELD_BLOCK_INDEX: block_index, server.FIELD_KEY: file_path, server.FIELD_SIZE: count}
+        server.send_file_packet(conn, server.make_response_json(server.OP_DOWNLOAD, 200, server.TYPE_FILE,
+                                                                'An available block.', rval), fid, offset, count)
+    return send_block
+
+
+def upload_packet(block_size, block_index=0):
+    """
+    An UPLOAD request packet as client.py sends it.
+    :param block_size:
+    :param block_index:
+    :return: the complete binary packet
+    """
+    return server.make_packet({
+        server.FIELD_TYPE: server.TYPE_FILE,
+        server.FIELD_OPERATION: server.OP_UPLOAD,
+        server.FIELD_DIRECTION: server.DIR_REQUEST,
+        server.FIELD_TOKEN: 'MTIzLjIwMjYxMDE3MTIwMDAwLmxvZ2luLjAxMjM0NTY3ODlhYmNkZWYwMTIzNDU2Nzg5YWJjZGVm',
+        server.FIELD_KEY: 'benchmark.bin',
+        server.FIELD_BLOCK_INDEX: block_index
+    }, b'\x5a' * block_size)
+
+
+class CountingSocket(socket.socket):
+    """
+    A socket counting its recv/recv_into calls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recv_calls = 0
+
+    def recv(self, *args):
+        self.recv_calls += 1
+        return super().recv(*args)
+
+    def recv_into(self, *args):
+        self.recv_calls += 1
+        return super().recv_into(*args)
+
+
+def loopback_pair():
+    """
+    A connected TCP pair over 127.0.0.1 (unlike socketpair, TCP delivers large bodies in pieces).
+    :return: (receiver socket, sender socket)
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    tx = socket.create_connection(listener.getsockname())
+    rx, _ = listener.accept()
+    rx = CountingSocket(fileno=rx.detach())
+    listener.close()
+    return rx, tx
+
+
+def _feed(sock, packet, count):
+    for _ in range(count):
+        sock.sendall(packet)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def bench_receiver(make_receiver, block_size, count, trace=False):
+    """
+    Push count UPLOAD packets through a TCP loopback connection and receive them.
+    :param make_receiver: called with the receiving socket, returns a function giving (json_data, bin_data)
+    :param block_size:
+    :param count:
+    :param trace: measure the transient allocation per packet with tracemalloc (slower)
+    :return: (MB/s, peak bytes allocated per packet, recv calls per packet)
+    """
+    packet = upload_packet(block_size)
+    rx, tx = loopback_pair()
+    receiver = make_receiver(rx)
+    th = Thread(target=_feed, args=(tx, packet, count), daemon=True)
+    th.start()
+    peak_total = 0
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    received = 0
+    while True:
+        if trace:
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        json_data, bin_data = receiver()
+        if json_data is None:
+            break
+        if trace:
+            peak_total += tracemalloc.get_traced_memory()[1] - current
+        received += len(bin_data)
+        del json_data, bin_data
+    seconds = time.perf_counter() - start
+    if trace:
+        tracemalloc.stop()
+    th.join()
+    rx.close()
+    tx.close()
+    return received / seconds / (1024 * 1024), peak_total / count, rx.recv_calls / count
+
+
+RECEIVERS = [
+    ('legacy get_tcp_packet', lambda conn: lambda: legacy_get_tcp_packet(conn)),
+    ('get_tcp_packet', lambda conn: lambda: server.get_tcp_packet(conn)),
+    ('PacketReader', lambda conn: server.PacketReader(conn).read_packet),
+]
+
+
+def cmd_recv(args):
+    print(f'{"Receiver":<24} | {"Block (KB)":>10} | {"MB/s":>10} | {"Alloc/packet (KB)":>18} | {"x payload":>9} | '
+          f'{"recv/packet":>11}')
+    print('-' * 98)
+    for block_size in args.block_sizes:
+        count = max(1, args.megabytes * 1024 * 1024 // block_size)
+        for name, make_receiver in RECEIVERS:
+            mbps, _, calls = bench_receiver(make_receiver, block_size, count)
+            _, alloc, _ = bench_receiver(make_receiver, block_size, max(1, count // 10), trace=True)
+            print(f'{name:<24} | {block_size / 1024:>10.0f} | {mbps:>10.1f} | {alloc / 1024:>18.1f} | '
+                  f'{alloc / block_size:>9.2f} | {calls:>11.3f}')
+
+
+def enter_workdir():
+    """
+    Change to a temporary working directory that is removed at exit.
+    """
+    workdir = tempfile.mkdtemp(prefix='step-bench-')
+    atexit.register(shutil.rmtree, workdir, True)
+    os.chdir(workdir)
+
+
+def start_server():
+    """
+    Run safe_server's thread engine in this process, in a temporary working directory.
+    :return: the port on 127.0.0.1
+    """
+    enter_workdir()
+    logging.disable(logging.CRITICAL)
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    Thread(target=server.tcp_listener, args=('127.0.0.1', port), daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return port
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError('benchmark server did not start')
+
+
+class BenchClient:
+    """
+    A minimal STEP client (no logging, no progress bar) over one connection.
+    """
+
+    def __init__(self, port, username='bench'):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = server.PacketReader(self.sock)
+        self.requests = 0
+        resp, _ = self.request({
+            server.FIELD_TYPE: server.TYPE_AUTH,
+            server.FIELD_OPERATION: server.OP_LOGIN,
+            server.FIELD_USERNAME: username,
+            server.FIELD_PASSWORD: hashlib.md5(username.encode()).hexdigest()
+        })
+        self.token = resp[server.FIELD_TOKEN]
+
+    def request(self, json_data, bin_data=None):
+        json_data[server.FIELD_DIRECTION] = server.DIR_REQUEST
+        if json_data[server.FIELD_TYPE] != server.TYPE_AUTH:
+            json_data[server.FIELD_TOKEN] = self.token
+        self.sock.sendall(server.make_packet(json_data, bin_data))
+        self.requests += 1
+        return self.reader.read_packet()
+
+    def upload(self, key, file_path, block_size=None, batch_blocks=1, md5=None):
+        """
+        SAVE + stop-and-wait UPLOAD of a file.
+        :param batch_blocks: contiguous blocks per UPLOAD request ("block_count")
+        :param md5: sent with SAVE, for a server with DEDUP
+        :return: the plan of the server
+        """
+        file_size = os.path.getsize(file_path)
+        save_req = {server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_OPERATION: server.OP_SAVE,
+                    server.FIELD_KEY: key, server.FIELD_SIZE: file_size}
+        if block_size is not None:
+            save_req[server.FIELD_BLOCK_SIZE] = block_size
+        if md5 is not None:
+            save_req[server.FIELD_MD5] = md5
+        plan, _ = self.request(save_req)
+        assert plan[server.FIELD_STATUS] == 200, plan
+        plan_block_size, total_block = plan[server.FIELD_BLOCK_SIZE], plan[server.FIELD_TOTAL_BLOCK]
+        with open(file_path, 'rb') as f:
+            for block_index in range(0, total_block, batch_blocks):
+                upload_req = {server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_OPERATION: server.OP_UPLOAD,
+                              server.FIELD_KEY: key, server.FIELD_BLOCK_INDEX: block_index}
+                block_count = min(batch_blocks, total_block - block_index)
+                if block_count > 1:
+                    upload_req[server.FIELD_BLOCK_COUNT] = block_count
+                resp, _ = self.request(upload_req, f.read(plan_block_size * block_count))
+                assert resp[server.FIELD_STATUS] == 200, resp
+        return plan
+
+    def close(self):
+        self.sock.close()
+
+
+def make_test_file(size):
+    """
+    A file of random content in the working directory.
+    :return: path
+    """
+    path = f'bench-{size}.bin'
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(os.urandom(min(remaining, 1024 * 1024)))
+                remaining -= 1024 * 1024
+    return path
+
+
+def cmd_blocksize(args):
+    port = start_server()
+    server.MIN_BLOCK_SIZE = min(args.block_sizes)
+    file_path = make_test_file(args.megabytes * 1024 * 1024)
+    client = BenchClient(port)
+    print(f'{"Block size":>16} | {"Blocks":>8} | {"Upload (s)":>10} | {"MB/s":>8}')
+    print('-' * 52)
+    for i, block_size in enumerate([None] + args.block_sizes):
+        start = time.perf_counter()
+        plan = client.upload(f'sweep-{i}', file_path, block_size)
+        seconds = time.perf_counter() - start
+        label = f'{plan[server.FIELD_BLOCK_SIZE]}' + ('' if block_size is not None else ' (default)')
+        print(f'{label:>16} | {plan[server.FIELD_TOTAL_BLOCK]:>8} | {seconds:>10.3f} | '
+              f'{args.megabytes / seconds:>8.1f}')
+    client.close()
+
+
+def _send_file(send_block, conn, file_path, block_size, result):
+    total_block = -(-os.path.getsize(file_path) // block_size)
+    start = time.thread_time()
+    for block_index in range(total_block):
+        send_block(conn, file_path, block_size, block_index)
+    result.append(time.thread_time() - start)
+    conn.shutdown(socket.SHUT_WR)
+
+
+def bench_download(send_block, file_path, block_size):
+    """
+    Send all blocks of a file through a TCP loopback connection, the receiver only drains the stream.
+    :return: (sender CPU seconds, wall seconds)
+    """
+    rx, tx = loopback_pair()
+    result = []
+    th = Thread(target=_send_file, args=(send_block, tx, file_path, block_size, result), daemon=True)
+    start = time.perf_counter()
+    th.start()
+    buffer = bytearray(1024 * 1024)
+    while rx.recv_into(buffer):
+        pass
+    seconds = time.perf_counter() - start
+    th.join()
+    rx.close()
+    tx.close()
+    return result[0], seconds
+
+
+def cmd_download(args):
+    enter_workdir()
+    file_path = make_test_file(args.megabytes * 1024 * 1024)
+    legacy_get_file_md5(file_path)  # warm the page cache
+    gigabytes = args.megabytes / 1024
+    print(f'{"Send path":<20} | {"Block (KB)":>10} | {"CPU s/GB":>8} | {"MB/s":>8}')
+    print('-' * 56)
+    for block_size in args.block_sizes:
+        open_files = server.OpenFileCache()
+        for name, send_block in [('read + concat (old)', legacy_send_block),
+                                 ('sendfile', sendfile_send_block(open_files))]:
+            cpu, seconds = bench_download(send_block, file_path, block_size)
+            print(f'{name:<20} | {block_size / 1024:>10.0f} | {cpu / gigabytes:>8.3f} | '
+                  f'{args.megabytes / seconds:>8.1f}')
+        open_files.close()
+
+
+def cmd_ranged(args):
+    port = start_server()
+    file_path = make_test_file(args.megabytes * 1024 * 1024)
+    client = BenchClient(port)
+    plan = client.upload('ranged.bin', file_path)
+    block_size, total_block = plan[server.FIELD_BLOCK_SIZE], plan[server.FIELD_TOTAL_BLOCK]
+    expected = hashlib.md5(open(file_path, 'rb').read()).hexdigest()
+    print(f'{"Blocks/request":>14} | {"Requests":>8} | {"Download (s)":>12} | {"MB/s":>8}')
+    print('-' * 52)
+    for block_count in args.block_counts:
+        requests = client.requests
+        md5 = hashlib.md5()
+        start = time.perf_counter()
+        block_index = 0
+        while block_index < total_block:
+            download_req = {server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_OPERATION: server.OP_DOWNLOAD,
+                            server.FIELD_KEY: 'ranged.bin', server.FIELD_BLOCK_INDEX: block_index}
+            if block_count > 1:
+                download_req[server.FIELD_BLOCK_COUNT] = min(block_count, total_block - block_index)
+            resp, data = client.request(download_req)
+            assert resp[server.FIELD_STATUS] == 200, resp
+            md5.update(data)
+            block_index += resp.get(server.FIELD_BLOCK_COUNT, 1)
+        seconds = time.perf_counter() - start
+        assert md5.hexdigest() == expected, 'the download is corrupted'
+        print(f'{block_count:>14} | {client.requests - requests:>8} | {seconds:>12.3f} | '
+              f'{args.megabytes / seconds:>8.1f}')
+    client.close()
+
+
+def cmd_batched(args):
+    port = start_server()
+    file_path = make_test_file(args.megabytes * 1024 * 1024)
+    expected = hashlib.md5(open(file_path, 'rb').read()).hexdigest()
+    client = BenchClient(port)
+    print(f'{"Blocks/request":>14} | {"Requests":>8} | {"Upload (s)":>10} | {"MB/s":>8}')
+    print('-' * 50)
+    for batch_blocks in args.block_counts:
+        key = f'batched-{batch_blocks}.bin'
+        requests = client.requests
+        start = time.perf_counter()
+        plan = client.upload(key, file_path, batch_blocks=batch_blocks)
+        seconds = time.perf_counter() - start
+        assert batch_blocks <= plan[server.FIELD_MAX_BLOCK_COUNT], plan
+        resp, _ = client.request({server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_OPERATION: server.OP_GET,
+                                  server.FIELD_KEY: key})
+        assert resp[server.FIELD_MD5] == expected, 'the upload is corrupted'
+        print(f'{batch_blocks:>14} | {client.requests - requests:>8} | {seconds:>10.3f} | '
+              f'{args.megabytes / seconds:>8.1f}')
+    client.close()
+
+
+def cmd_dedup(args):
+    port = start_server()
+    server.DEDUP = True
+    file_path = make_test_file(args.megabytes * 1024 * 1024)
+    client = BenchClient(port)
+    print(f'{"Upload":>12} | {"Blocks":>6} | {"Hash (s)":>8} | {"Upload (s)":>10} | {"Stored MB":>9}')
+    print('-' * 58)
+    for i in range(args.copies):
+        for with_md5 in (False, True):
+            start = time.perf_counter()
+            md5 = server.get_file_md5(file_path) if with_md5 else None
+            hashed = time.perf_counter()
+            plan = client.upload(f'copy-{i}-{with_md5}.bin', file_path, md5=md5)
+            seconds = time.perf_counter() - hashed
+            inodes = {os.stat(entry.path).st_ino: entry.stat().st_size
+                      for entry in os.scandir(os.path.join('file', 'bench'))}
+            print(f'{f"#{i} " + ("md5" if with_md5 else "plain"):>12} | {plan[server.FIELD_TOTAL_BLOCK]:>6} | '
+                  f'{hashed - start:>8.3f} | {seconds:>10.3f} | {sum(inodes.values()) / (1024 * 1024):>9.1f}')
+    print(f'SAVE requests linked: {server.dedup_hits}, bytes saved: {server.dedup_bytes}')
+    client.close()
+
+
+def _drain(sock):
+    buffer = bytearray(1024 * 1024)
+    while sock.recv_into(buffer):
+        pass
+
+
+def bench_sender(send, block_size, count, trace=False):
+    """
+    Send count UPLOAD packets through a TCP loopback connection, the receiver only drains the stream.
+    :param send: called with (socket, json_data, bin_data)
+    :param block_size:
+    :param count:
+    :param trace: measure the transient allocation per packet with tracemalloc (slower)
+    :return: (MB/s, peak bytes allocated per packet)
+    """
+    rx, tx = loopback_pair()
+    th = Thread(target=_drain, args=(rx,), daemon=True)
+    th.start()
+    bin_data = b'\x5a' * block_size
+    peak_total = 0
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for block_index in range(count):
+        json_data = {server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_OPERATION: server.OP_UPLOAD,
+                     server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_KEY: 'benchmark.bin',
+                     server.FIELD_BLOCK_INDEX: block_index}
+        if trace:
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        send(tx, json_data, bin_data)
+        if trace:
+            peak_total += tracemalloc.get_traced_memory()[1] - current
+    tx.shutdown(socket.SHUT_WR)
+    th.join()
+    seconds = time.perf_counter() - start
+    if trace:
+        tracemalloc.stop()
+    rx.close()
+    tx.close()
+    return count * block_size / seconds / (1024 * 1024), peak_total / count
+
+
+SENDERS = [
+    ('sendall(concat) (old)', lambda conn, json_data, bin_data: conn.sendall(legacy_make_packet(json_data, bin_data))),
+    ('send_buffers (sendmsg)',
+     lambda conn, json_data, bin_data: server.send_buffers(conn, server.make_packet_buffers(json_data, bin_data))),
+]
+
+
+def cmd_send(args):
+    print(f'{"Sender":<24} | {"Block (KB)":>10} | {"MB/s":>10} | {"Alloc/packet (KB)":>18} | {"x payload":>9}')
+    print('-' * 84)
+    for block_size in args.block_sizes:
+        count = max(1, args.megabytes * 1024 * 1024 // block_size)
+        for name, send in SENDERS:
+            mbps, _ = bench_sender(send, block_size, count)
+            _, alloc = bench_sender(send, block_size, max(1, count // 10), trace=True)
+            print(f'{name:<24} | {block_size / 1024:>10.0f} | {mbps:>10.1f} | {alloc / 1024:>18.1f} | '
+                  f'{alloc / block_size:>9.2f}')
+
+
+class NullSocket:
+    """
+    Discards the responses of file_process.
+    """
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        return sum(len(data) for data in buffers)
+
+
+def _upload_blocks(key, bin_data, block_indexes, barrier):
+    conn_cache = server.ConnectionCache()
+    sock = NullSocket()
+    barrier.wait()
+    for block_index in block_indexes:
+        server.file_process('bench', server.OP_UPLOAD, {server.FIELD_KEY: key, server.FIELD_BLOCK_INDEX: block_index},
+                            bin_data, sock, conn_cache)
+    conn_cache.close()
+
+
+def cmd_contention(args):
+    enter_workdir()
+    logging.disable(logging.CRITICAL)
+    for folder in ['data', 'file', 'tmp', 'meta']:
+        os.makedirs(os.path.join(folder, 'bench'))
+    server.MIN_BLOCK_SIZE = min(server.MIN_BLOCK_SIZE, args.block_size)
+    bin_data = b'\x5a' * args.block_size
+    print(f'{"Threads":>8} | {"Blocks":>8} | {"Seconds":>8} | {"Blocks/s":>9} | {"MB/s":>8}')
+    print('-' * 54)
+    for i, threads in enumerate(args.threads):
+        key = f'contention-{i}'
+        plan_request = {server.FIELD_KEY: key, server.FIELD_SIZE: args.blocks * args.block_size,
+                        server.FIELD_BLOCK_SIZE: args.block_size}
+        server.file_process('bench', server.OP_SAVE, plan_request, None, NullSocket(), server.ConnectionCache())
+        barrier = Barrier(threads + 1)
+        # Interleaved block indexes: all threads write to the same key at the same time
+        workers = [Thread(target=_upload_blocks, args=(key, bin_data, range(t, args.blocks, threads), barrier))
+                   for t in range(threads)]
+        for th in workers:
+            th.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for th in workers:
+            th.join()
+        seconds = time.perf_counter() - start
+        assert os.path.exists(os.path.join('file', 'bench', key)), 'the upload is not completed'
+        print(f'{threads:>8} | {args.blocks:>8} | {seconds:>8.3f} | {args.blocks / seconds:>9.0f} | '
+              f'{args.blocks * args.block_size / seconds / (1024 * 1024):>8.1f}')
+
+
+class CaptureSocket(NullSocket):
+    """
+    Keeps the JSON of the last response.
+    """
+    json_data = None
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        self.json_data = json.loads(bytes(buffers[1]))
+        return super().sendmsg(buffers, ancdata, flags, address)
+
+
+def cmd_dispatch(args):
+    enter_workdir()
+    logging.disable(logging.CRITICAL)
+    conn_cache = server.ConnectionCache()
+    sock = CaptureSocket()
+    server.STEP_dispatch({server.FIELD_TYPE: server.TYPE_AUTH, server.FIELD_OPERATION: server.OP_LOGIN,
+                          server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_USERNAME: 'bench',
+                          server.FIELD_PASSWORD: hashlib.md5(b'bench').hexdigest()}, None, sock, conn_cache)
+    token = sock.json_data[server.FIELD_TOKEN]
+    request = {server.FIELD_TYPE: server.TYPE_DATA, server.FIELD_DIRECTION: server.DIR_REQUEST,
+               server.FIELD_TOKEN: token, server.FIELD_KEY: 'tiny'}
+    server.STEP_dispatch(dict(request, operation=server.OP_SAVE, value=1), None, sock, conn_cache)
+    cases = [
+        ('DATA GET (200)', dict(request, operation=server.OP_GET), 200),
+        ('DATA GET unknown key (404)', dict(request, operation=server.OP_GET, key='missing'), 404),
+        ('DATA GET without key (410)', {k: v for k, v in dict(request, operation=server.OP_GET).items()
+                                        if k != server.FIELD_KEY}, 410),
+    ]
+    print(f'{"Request":<28} | {"Requests/s":>10} | {"us/request":>10}')
+    print('-' * 54)
+    for name, json_data, status in cases:
+        server.STEP_dispatch(json_data, None, sock, conn_cache)
+        assert sock.json_data[server.FIELD_STATUS] == status, sock.json_data
+        null_sock = NullSocket()
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            server.STEP_dispatch(json_data, None, null_sock, conn_cache)
+        seconds = time.perf_counter() - start
+        print(f'{name:<28} | {args.requests / seconds:>10.0f} | {seconds / args.requests * 1e6:>10.2f}')
+
+
+class StreamSocket:
+    """
+    Serves a prepared byte stream to PacketReader and counts the response bytes.
+    """
+
+    def __init__(self, stream):
+        self.stream = memoryview(stream)
+        self.sent = 0
+
+    def gettimeout(self):
+        return None
+
+    def settimeout(self, value):
+        pass
+
+    def recv_into(self, buffer):
+        n = min(len(buffer), len(self.stream))
+        buffer[:n] = self.stream[:n]
+        self.stream = self.stream[n:]
+        return n
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        n = sum(len(data) for data in buffers)
+        self.sent += n
+        return n
+
+
+def cmd_framing(args):
+    enter_workdir()
+    logging.disable(logging.CRITICAL)
+    bin_data = b'\x5a' * args.block_size
+    server.MIN_BLOCK_SIZE = min(server.MIN_BLOCK_SIZE, args.block_size)
+    print(f'{"Framing":<8} | {"Request head (B)":>16} | {"Response (B)":>12} | {"us/block":>8} | {"Blocks/s":>9}')
+    print('-' * 66)
+    for i, framing in enumerate(['json', 'compact']):
+        conn_cache = server.ConnectionCache()
+        sock = CaptureSocket()
+        server.STEP_dispatch({server.FIELD_TYPE: server.TYPE_AUTH, server.FIELD_OPERATION: server.OP_LOGIN,
+                              server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_USERNAME: 'bench',
+                              server.FIELD_PASSWORD: hashlib.md5(b'bench').hexdigest()}, None, sock, conn_cache)
+        token = sock.json_data[server.FIELD_TOKEN]
+        key = f'framing-{i}.bin'
+        server.STEP_dispatch({server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_OPERATION: server.OP_SAVE,
+                              server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TOKEN: token,
+                              server.FIELD_KEY: key, server.FIELD_SIZE: args.blocks * args.block_size,
+                              server.FIELD_BLOCK_SIZE: args.block_size, server.FIELD_COMPACT: True},
+                             None, sock, conn_cache)
+        session_id = sock.json_data[server.FIELD_SESSION_ID]
+        heads = []
+        for block_index in range(args.blocks):
+            if framing == 'json':
+                heads.append(server.make_packet_head({
+                    server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_OPERATION: server.OP_UPLOAD,
+                    server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_TOKEN: token, server.FIELD_KEY: key,
+                    server.FIELD_BLOCK_INDEX: block_index}, len(bin_data)))
+            else:
+                heads.append(server.COMPACT_HEAD.pack(server.COMPACT_MAGIC, server.COMPACT_VERSION,
+                                                      server.COMPACT_UPLOAD, 0, 0, 0, len(bin_data), session_id,
+                                                      block_index))
+        stream = StreamSocket(b''.join(head + bin_data for head in heads))
+        reader = server.PacketReader(stream)
+        start = time.perf_counter()
+        while True:
+            json_data, data = reader.read_packet()
+            if json_data is None:
+                break
+            server.STEP_dispatch(json_data, data, stream, conn_cache)
+        seconds = time.perf_counter() - start
+        assert os.path.exists(os.path.join('file', 'bench', key)), 'the upload is not completed'
+        print(f'{framing:<8} | {sum(map(len, heads)) / args.blocks:>16.0f} | {stream.sent / args.blocks:>12.0f} | '
+              f'{seconds / args.blocks * 1e6:>8.2f} | {args.blocks / seconds:>9.0f}')
+        conn_cache.close()
+
+
+def cmd_codec(args):
+    request = {server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_OPERATION: server.OP_UPLOAD,
+               server.FIELD_DIRECTION: server.DIR_REQUEST, server.FIELD_KEY: 'a-file-name.bin',
+               server.FIELD_BLOCK_INDEX: 1234,
+               server.FIELD_TOKEN: 'YmVuY2guMjAyNjEwMTcxMjAwMDAubG9naW4uMGNjMTc1YjljMGYxYjZhODMxYzM5OWUyNjk3NzI2NjE='}
+    encoded_request = json.dumps(request).encode()
+    rval = {server.FIELD_KEY: 'a-file-name.bin', server.FIELD_BLOCK_INDEX: 1234}
+
+    def legacy_encode():
+        json_data = server.make_response_json(server.OP_UPLOAD, 200, server.TYPE_FILE,
+                                              'The block 1234 is uploaded.', dict(rval))
+        return json.dumps(dict(json_data), ensure_ascii=False).encode()
+
+    cases = [('legacy json', legacy_encode, lambda: json.loads(encoded_request.decode()))]
+    for codec in server.JSON_CODECS:
+        cases.append((codec, lambda: server.encode_response_json(server.OP_UPLOAD, 200, server.TYPE_FILE,
+                                                                 'The block 1234 is uploaded.', dict(rval)),
+                      lambda: server.json_loads(memoryview(encoded_request))))
+    server.set_json_codec()
+    print(f'{"Codec":<12} | {"Encode response (us)":>20} | {"Decode request (us)":>19}')
+    print('-' * 58)
+    for name, encode, decode in cases:
+        if name != 'legacy json':
+            server.set_json_codec(name)
+        results = []
+        for run in (encode, decode):
+            start = time.perf_counter()
+            for _ in range(args.packets):
+                run()
+            results.append((time.perf_counter() - start) / args.packets * 1e6)
+        print(f'{name:<12} | {results[0]:>20.2f} | {results[1]:>19.2f}')
+    server.set_json_codec()
+
+
+def file_digest(file_path, algorithm):
+    with open(file_path, 'rb') as fid:
+        return hashlib.file_digest(fid, algorithm).hexdigest()
+
+
+def cmd_hash(args):
+    enter_workdir()
+    file_path = make_test_file(args.megabytes * 1024 * 1024)
+    legacy_get_file_md5(file_path)  # warm the page cache
+    cases = [
+        ('md5, 2 KB read (old)', lambda: legacy_get_file_md5(file_path)),
+        ('md5, hashlib.file_digest', lambda: file_digest(file_path, 'md5')),
+        (f'md5, readinto {args.buffer_size // 1024} KB',
+         lambda: server.get_file_digest(file_path, 'md5', args.buffer_size, mmap_threshold=0)),
+        ('md5, mmap', lambda: server.get_file_digest(file_path, 'md5', args.buffer_size, mmap_threshold=1)),
+    ]
+    for algorithm in ['sha1', 'sha256', 'blake2b', 'xxh64', 'xxh3_64', 'xxh3_128']:
+        if server.new_digest(algorithm) is None:
+            print(f'({algorithm} is not available)')
+            continue
+        cases.append((f'{algorithm}, readinto {args.buffer_size // 1024} KB',
+                      lambda algorithm=algorithm: server.get_file_digest(file_path, algorithm, args.buffer_size,
+                                                                        mmap_threshold=0)))
+    print(f'{"Digest":<28} | {"Seconds":>8} | {"GB/s":>6}')
+    print('-' * 48)
+    for name, run in cases:
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        print(f'{name:<28} | {seconds:>8.3f} | {args.megabytes / 1024 / seconds:>6.2f}')
+
+
+def _argparse():
+    parse = argparse.ArgumentParser(description='Micro-benchmarks of the STEP implementation.')
+    sub = parse.add_subparsers(dest='command', required=True)
+
+    recv = sub.add_parser('recv', help='Receive path: throughput and allocation per packet.')
+    recv.add_argument('--megabytes', type=int, default=64, help='Payload MB per run. Default is 64.')
+    recv.add_argument('--block-sizes', type=int, nargs='+', default=[20480, 1024 * 1024],
+                      help='Payload sizes in bytes. Default is 20480 and 1048576.')
+    recv.set_defaults(func=cmd_recv)
+
+    send = sub.add_parser('send', help='Send path: throughput and allocation per packet.')
+    send.add_argument('--megabytes', type=int, default=256, help='Payload MB per run. Default is 256.')
+    send.add_argument('--block-sizes', type=int, nargs='+', default=[20480, 4 * 1024 * 1024],
+                      help='Payload sizes in bytes. Default is 20480 and 4194304.')
+    send.set_defaults(func=cmd_send)
+
+    blocksize = sub.add_parser('blocksize', help='Upload throughput over loopback for a sweep of block sizes.')
+    blocksize.add_argument('--megabytes', type=int, default=256, help='File size in MB. Default is 256.')
+    blocksize.add_argument('--block-sizes', type=int, nargs='+',
+                           default=[64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024],
+                           help='Requested block sizes in bytes. The default plan (no request) is always run first.')
+    blocksize.set_defaults(func=cmd_blocksize)
+
+    contention = sub.add_parser('contention', help='Server UPLOAD path (no sockets) called by many threads '
+                                                   'for the same key.')
+    contention.add_argument('--blocks', type=int, default=20000, help='Number of blocks. Default is 20000.')
+    contention.add_argument('--block-size', type=int, default=20480, help='Block size in bytes. Default is 20480.')
+    contention.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16, 64],
+                            help='Numbers of uploading threads, each with its own ConnectionCache. '
+                                 'Default is 1 4 16 64.')
+    contention.set_defaults(func=cmd_contention)
+
+    dispatch = sub.add_parser('dispatch', help='Server request path (no sockets) for tiny DATA GET requests: '
+                                               'validation, token check, dispatch and response.')
+    dispatch.add_argument('--requests', type=int, default=100000, help='Requests per case. Default is 100000.')
+    dispatch.set_defaults(func=cmd_dispatch)
+
+    framing = sub.add_parser('framing', help='Server UPLOAD path (parse, dispatch, write, respond; no sockets) '
+                                             'with JSON heads and with the compact framing.')
+    framing.add_argument('--blocks', type=int, default=20000, help='Number of blocks. Default is 20000.')
+    framing.add_argument('--block-size', type=int, default=4096, help='Block size in bytes. Default is 4096.')
+    framing.set_defaults(func=cmd_framing)
+
+    codec = sub.add_parser('codec', help='JSON section of a packet: encoding an UPLOAD response and decoding an '
+                                         'UPLOAD request with each installed codec.')
+    codec.add_argument('--packets', type=int, default=200000, help='Packets per case. Default is 200000.')
+    codec.set_defaults(func=cmd_codec)
+
+    hashing = sub.add_parser('hash', help='File digest throughput (page cache warm).')
+    hashing.add_argument('--megabytes', type=int, default=1024, help='File size in MB. Default is 1024.')
+    hashing.add_argument('--buffer-size', type=int, default=server.HASH_BUFFER_SIZE,
+                         help=f'Read size in bytes. Default is {server.HASH_BUFFER_SIZE}.')
+    hashing.set_defaults(func=cmd_hash)
+
+    download = sub.add_parser('download', help='DOWNLOAD send path: CPU of the sending thread per GB served.')
+    download.add_argument('--megabytes', type=int, default=1024, help='File size in MB. Default is 1024.')
+    download.add_argument('--block-sizes', type=int, nargs='+', default=[20480, 1024 * 1024],
+                          help='Block sizes in bytes. Default is 20480 and 1048576.')
+    download.set_defaults(func=cmd_download)
+
+    ranged = sub.add_parser('ranged', help='Stop-and-wait DOWNLOAD of a file over loopback with one block or '
+                                           'a range of blocks ("block_count") per request.')
+    ranged.add_argument('--megabytes', type=int, default=256, help='File size in MB. Default is 256.')
+    ranged.add_argument('--block-counts', type=int, nargs='+', default=[1, 16, 256, 3200],
+                        help='Blocks (of 20480 bytes) per request. Default is 1 16 256 3200 '
+                             '(3200 blocks is the 64 MiB --max-download-range).')
+    ranged.set_defaults(func=cmd_ranged)
+
+    batched = sub.add_parser('batched', help='Stop-and-wait UPLOAD of a file over loopback with one block or '
+                                             'a batch of contiguous blocks ("block_count") per request.')
+    batched.add_argument('--megabytes', type=int, default=256, help='File size in MB. Default is 256.')
+    batched.add_argument('--block-counts', type=int, nargs='+', default=[1, 16, 256, 819],
+                         help='Blocks (of 20480 bytes) per request. Default is 1 16 256 819 '
+                              '(819 blocks is the 16 MiB --max-upload-batch).')
+    batched.set_defaults(func=cmd_batched)
+
+    dedup = sub.add_parser('dedup', help='Uploads of copies of one file to a server with DEDUP, without and with '
+                                         'the "md5" in SAVE.')
+    dedup.add_argument('--megabytes', type=int, default=256, help='File size in MB. Default is 256.')
+    dedup.add_argument('--copies', type=int, default=3, help='Uploads of each kind. Default is 3.')
+    dedup.set_defaults(func=cmd_dedup)
+    return parse.parse_args()
+
+
+def main():
+    args = _argparse()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from socket import *
 import json
+import re
 import os
 from os.path import join, getsize
 import hashlib
@@ -13,7 +14,22 @@ import uuid
 import math
 import shutil
 import struct
+import mmap
+import weakref
+from collections import deque
 from tqdm import tqdm
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 def get_time_based_filename(ext, prefix='', t=None):
     """
@@ -32,14 +48,35 @@ def get_time_based_filename(ext, prefix='', t=None):
 
 
 MAX_PACKET_SIZE = 20480
+# File hashing: read size, and the file size from which mmap is used
+HASH_BUFFER_SIZE = 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+UPLOAD_RETRIES = 3
+DOWNLOAD_RETRIES = 3
+READ_BUFFER_SIZE = 256 * 1024
+# Largest JSON section and binary section of a response packet (a DOWNLOAD range is asked for no larger);
+# a larger length in a header closes the connection before anything is allocated for it.
+MAX_JSON_SIZE = 1024 * 1024
+MAX_BODY_SIZE = 64 * 1024 * 1024
 
 # Const Value
 OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN, OP_ERROR = 'SAVE', 'DELETE', 'GET', 'UPLOAD', 'DOWNLOAD', 'BYE', 'LOGIN', "ERROR"
+# Progress of an upload, to resume it
+OP_STATUS = 'STATUS'
 TYPE_FILE, TYPE_DATA, TYPE_AUTH, DIR_EARTH = 'FILE', 'DATA', 'AUTH', 'EARTH'
 FIELD_OPERATION, FIELD_DIRECTION, FIELD_TYPE, FIELD_USERNAME, FIELD_PASSWORD, FIELD_TOKEN = 'operation', 'direction', 'type', 'username', 'password', 'token'
 FIELD_KEY, FIELD_SIZE, FIELD_TOTAL_BLOCK, FIELD_MD5, FIELD_BLOCK_SIZE = 'key', 'size', 'total_block', 'md5', 'block_size'
 FIELD_STATUS, FIELD_STATUS_MSG, FIELD_BLOCK_INDEX = 'status', 'status_msg', 'block_index'
+FIELD_DIGEST, FIELD_DIGEST_ALGORITHM = 'digest', 'digest_algorithm'
+FIELD_RECEIVED, FIELD_MISSING = 'received', 'missing'
+FIELD_BLOCK_COUNT, FIELD_MAX_BLOCK_COUNT = 'block_count', 'max_block_count'
 DIR_REQUEST, DIR_RESPONSE = 'REQUEST', 'RESPONSE'
+# Compact framing of UPLOAD/DOWNLOAD blocks, asked for with "compact" in FILE SAVE/GET
+FIELD_COMPACT, FIELD_SESSION_ID = 'compact', 'session_id'
+FIELD_DEDUPLICATED = 'deduplicated'
+COMPACT_MAGIC, COMPACT_VERSION = 0xB5, 1
+COMPACT_HEAD = struct.Struct('!BBBBHHIII')  # magic, version, opcode, 0, status, block count, b_len, session id, block index (20 bytes)
+COMPACT_UPLOAD, COMPACT_DOWNLOAD = 1, 2
 
 def set_logger(logger_name):
     """
@@ -76,103 +113,420 @@ def set_logger(logger_name):
 # Logger
 logger = set_logger('STEP-Client')
 
+# One buffered reader per socket, dropped with the socket
+packet_readers = weakref.WeakKeyDictionary()
+packet_readers_lock = threading.Lock()
+
 
 def _argparse():
     parse = argparse.ArgumentParser()
     parse.add_argument("--server_ip", required=True, help="Server IP address")
     parse.add_argument("--id", required=True, help="Student ID")
     parse.add_argument("--f", required=False, help="Path to the file to upload")
+    parse.add_argument("--download", nargs="+", required=False, metavar="KEY",
+                       help="Download the files of these keys instead of uploading. An interrupted download is "
+                            "resumed from its sidecar file <file>.download.")
+    parse.add_argument("--output-dir", default='.', help="Directory of the downloaded files (default: .)")
+    parse.add_argument("--range-blocks", type=int, default=1,
+                       help="Number of contiguous blocks asked for by one DOWNLOAD request; the server sends them in "
+                            "one packet (default: 1, one block per request).")
     # additional for benchmark
     parse.add_argument("--files", nargs="+", required=False, help="Paths to multiple files to upload")
     parse.add_argument(
         "--block-workers",
         type=int,
         default=1,
-        help="Number of worker threads for block-level parallel upload (default: 1)."
+        help="Number of worker threads for block-level parallel upload (default: 1). With --download, the number "
+             "of connections the blocks are downloaded over."
+    )
+    parse.add_argument(
+        "--block-size",
+        type=int,
+        default=None,
+        help="Block size to ask the server for in SAVE. The server chooses the final size within its bounds "
+             "(default: not asked, the server uses 20480)."
+    )
+    parse.add_argument(
+        "--digest",
+        default='md5',
+        help="Digest to verify the upload with: md5, sha1, sha256, blake2b, or xxh64/xxh3_64/xxh3_128 "
+             "with xxhash installed. The server falls back to md5 if it does not have it (default: md5)."
+    )
+    parse.add_argument(
+        "--window",
+        type=int,
+        default=1,
+        help="Number of UPLOAD requests kept in flight on one connection (default: 1, stop-and-wait). "
+             "Takes precedence over --block-workers. With --download, the number of DOWNLOAD requests in "
+             "flight on each connection."
+    )
+    parse.add_argument(
+        "--batch-blocks",
+        type=int,
+        default=1,
+        help="Number of contiguous blocks sent in one UPLOAD request, with one pwrite and one response on the "
+             "server; limited to the max_block_count of the server's plan (default: 1, one block per request)."
+    )
+    parse.add_argument(
+        "--resume",
+        action="store_true",
+        help="Ask the server which blocks of an interrupted upload of the same key are missing and upload only "
+             "those; a new upload is started if there is none (default: always start a new upload)."
+    )
+    parse.add_argument(
+        "--compact",
+        action="store_true",
+        help="Send the blocks with the 20-byte compact head instead of a JSON head, if the server supports it. "
+             "Not used with --block-workers."
+    )
+    parse.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Send the MD5 of the file with SAVE (one extra read of the file), so that a server with --dedup which "
+             "already stores the content links the key to it and no block is uploaded."
+    )
+    parse.add_argument(
+        "--json-codec",
+        default='auto',
+        choices=['auto', 'orjson', 'ujson', 'json'],
+        help="Codec of the JSON section of packets; auto takes orjson or ujson if installed (default: auto)."
     )
     args = parse.parse_args()
-    if not args.f and not args.files:
-        parse.error("You must provide at least one file via --f or --files.")
+    if args.json_codec != 'auto' and args.json_codec not in JSON_CODECS:
+        parse.error(f"--json-codec {args.json_codec} needs the {args.json_codec} package.")
+    if args.batch_blocks <= 0:
+        parse.error("--batch-blocks has to be positive.")
+    if args.range_blocks <= 0:
+        parse.error("--range-blocks has to be positive.")
+    if not args.f and not args.files and not args.download:
+        parse.error("You must provide at least one file via --f or --files, or keys via --download.")
     return args
 
 
+def new_digest(algorithm='md5'):
+    """
+    Create a hash object: md5, sha1, sha256, blake2b, or xxh64/xxh3_64/xxh3_128 if xxhash is installed.
+    :param algorithm:
+    :return: the hash object, or None if the algorithm is not available
+    """
+    if algorithm in ('md5', 'sha1', 'sha256', 'blake2b'):
+        return hashlib.new(algorithm)
+    if xxhash is not None and algorithm in ('xxh64', 'xxh3_64', 'xxh3_128'):
+        return getattr(xxhash, algorithm)()
+    return None
+
+
+def get_file_digest(filename, algorithm='md5', buffer_size=None, mmap_threshold=None):
+    """
+    Get the digest of a big file.
+    Reads HASH_BUFFER_SIZE at a time with readinto into one reused buffer; files of HASH_MMAP_THRESHOLD
+    or more are hashed through mmap instead (no read copies at all).
+    :param filename:
+    :param algorithm: see new_digest
+    :param buffer_size: default HASH_BUFFER_SIZE
+    :param mmap_threshold: default HASH_MMAP_THRESHOLD, 0 to never use mmap
+    :return: hex digest
+    """
+    buffer_size = HASH_BUFFER_SIZE if buffer_size is None else buffer_size
+    mmap_threshold = HASH_MMAP_THRESHOLD if mmap_threshold is None else mmap_threshold
+    m = new_digest(algorithm)
+    with open(filename, 'rb', buffering=0) as fid:
+        size = os.fstat(fid.fileno()).st_size
+        if 0 < mmap_threshold <= size:
+            with mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                for offset in range(0, size, buffer_size):
+                    m.update(view[offset:offset + buffer_size])
+                view.release()
+        else:
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                n = fid.readinto(buffer)
+                if not n:
+                    break
+                m.update(view[:n])
+    return m.hexdigest()
+
+
 def get_file_md5(filename):
     """
     Get MD5 value for big file
     :param filename:
     :return:
     """
-    m = hashlib.md5()
-    with open(filename, 'rb') as fid:
-        while True:
-            d = fid.read(2048)
-            if not d:
-                break
-            m.update(d)
-    return m.hexdigest()
+    return get_file_digest(filename, 'md5')
+
+
+# json.dumps with any option builds a new JSONEncoder on every call; json.loads adds type and BOM checks
+_json_encoder = json.JSONEncoder(ensure_ascii=False)
+_json_decoder = json.JSONDecoder()
+
+
+def _json_dumps_stdlib(obj):
+    return _json_encoder.encode(obj).encode()
+
+
+def _json_loads_stdlib(data):
+    return _json_decoder.decode(str(data, 'utf-8'))
+
+
+def _json_dumps_orjson(obj):
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        # Integers beyond 64 bits or non-str keys, which the json module accepts
+        return _json_dumps_stdlib(obj)
+
+
+# orjson decodes integers beyond 64 bits as floats; they have at least 19 digits
+_LONG_DIGITS = re.compile(rb'[0-9]{19}')
+
+
+def _json_loads_orjson(data):
+    if _LONG_DIGITS.search(data):
+        return _json_loads_stdlib(data)
+    return orjson.loads(data)
+
+
+def _json_dumps_ujson(obj):
+    return ujson.dumps(obj, ensure_ascii=False).encode()
+
+
+def _json_loads_ujson(data):
+    return ujson.loads(str(data, 'utf-8'))
+
+
+# name -> (dumps to UTF-8 bytes, loads from a bytes-like object)
+JSON_CODECS = {'json': (_json_dumps_stdlib, _json_loads_stdlib)}
+if ujson is not None:
+    JSON_CODECS['ujson'] = (_json_dumps_ujson, _json_loads_ujson)
+if orjson is not None:
+    JSON_CODECS['orjson'] = (_json_dumps_orjson, _json_loads_orjson)
+json_dumps, json_loads = JSON_CODECS['json']
+
+
+def set_json_codec(name='auto'):
+    """
+    Choose the codec of the JSON section of packets
+    :param name: a key of JSON_CODECS, or auto for the fastest installed one
+    :return: the name of the codec in use
+    """
+    global json_dumps, json_loads
+    if name == 'auto':
+        name = next(codec for codec in ['orjson', 'ujson', 'json'] if codec in JSON_CODECS)
+    json_dumps, json_loads = JSON_CODECS[name]
+    return name
+
+
+set_json_codec()
+
+
+def make_packet_buffers(json_data, bin_data=None):
+    """
+    Make a packet following the STEP protocol as a list of buffers: the two lengths, the json section
+    and a memoryview of the binary data. Send it with send_buffers, the data is never copied.
+    The length of the json section is the length of its UTF-8 bytes.
+    :param json_data:
+    :param bin_data:
+    :return:
+        [header, json bytes] or [header, json bytes, memoryview of bin_data]
+    """
+    j = json_dumps(json_data)
+    if bin_data is None:
+        return [struct.pack('!II', len(j), 0), j]
+    else:
+        return [struct.pack('!II', len(j), len(bin_data)), j, memoryview(bin_data)]
 
 
 def make_packet(json_data, bin_data=None):
     """
     Make a packet following the STEP protocol.
-    Any information or data for TCP transmission has to use this function to get the packet.
+    Any information or data for TCP transmission has to use this function or make_packet_buffers.
     :param json_data:
     :param bin_data:
     :return:
         The complete binary packet
     """
-    j = json.dumps(dict(json_data), ensure_ascii=False)
-    j_len = len(j)
-    if bin_data is None:
-        return struct.pack('!II', j_len, 0) + j.encode()
-    else:
-        return struct.pack('!II', j_len, len(bin_data)) + j.encode() + bin_data
+    return b''.join(make_packet_buffers(json_data, bin_data))
+
+
+def send_buffers(conn, buffers, flags=0):
+    """
+    Send a packet made of several buffers with sendmsg (scatter-gather), without joining them.
+    Partial sends are continued. Without sendmsg (e.g. on Windows) the buffers are joined and sent with sendall.
+    :param conn: the TCP connection
+    :param buffers: list of bytes-like objects
+    :param flags: flags of sendmsg
+    :return: None
+    """
+    if not hasattr(conn, 'sendmsg'):
+        conn.sendall(b''.join(buffers))
+        return
+    buffers = list(buffers)
+    while buffers:
+        sent = conn.sendmsg(buffers, [], flags)
+        done = 0
+        while done < len(buffers) and sent >= len(buffers[done]):
+            sent -= len(buffers[done])
+            done += 1
+        del buffers[:done]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
+def recv_exactly_into(conn, view):
+    """
+    Fill the whole buffer from the TCP stream with recv_into (no intermediate bytes objects).
+    :param conn: the TCP connection
+    :param view: a writable memoryview to fill
+    :return: True if the buffer is filled, False if the connection is closed
+    """
+    while len(view) > 0:
+        n = conn.recv_into(view)
+        if n == 0:
+            return False
+        view = view[n:]
+    return True
 
 
 def get_tcp_packet(conn):
     """
     Receive a complete TCP "packet" from a TCP stream and get the json data and binary data.
+    The json section and the binary section are received into one preallocated bytearray,
+    and the binary data is returned as a memoryview of it (no copy).
     :param conn: the TCP connection
     :return:
         json_data
-        bin_data
-    """
-    bin_data = b''
-    while len(bin_data) < 8:
-        data_rec = conn.recv(8)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
-    data = bin_data[:8]
-    # cut the head
-    bin_data = bin_data[8:]
-    j_len, b_len = struct.unpack('!II', data)
-    while len(bin_data) < j_len:
-        data_rec = conn.recv(j_len)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
-    j_bin = bin_data[:j_len]
+        bin_data (memoryview)
+    """
+    header = bytearray(8)
+    if not recv_exactly_into(conn, memoryview(header)):
+        return None, None
+    j_len, b_len = struct.unpack('!II', header)
+    if j_len > MAX_JSON_SIZE or b_len > MAX_BODY_SIZE:
+        logger.error(f'Packet of {j_len}+{b_len} bytes is too large.')
+        return None, None
+    buffer = memoryview(bytearray(j_len + b_len))
+    if not recv_exactly_into(conn, buffer[:j_len]):
+        return None, None
     try:
-        json_data = json.loads(j_bin.decode())
+        json_data = json_loads(buffer[:j_len])
     except Exception as ex:
         return None, None
-    # cut json data
-    bin_data = bin_data[j_len:]
-    while len(bin_data) < b_len:
-        data_rec = conn.recv(b_len)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
+    bin_data = buffer[j_len:]
+    if not recv_exactly_into(conn, bin_data):
+        return None, None
     return json_data, bin_data
 
 
+class PacketReader:
+    """
+    Buffered per-connection reader of STEP packets.
+    It reads the TCP stream in large chunks into one reusable buffer and parses as many complete packets
+    as the buffer holds, so pipelined requests cost far fewer recv calls than get_tcp_packet.
+    The binary data is a memoryview of the buffer and stays valid until the next read_packet() call.
+    """
+
+    def __init__(self, conn, buffer_size=READ_BUFFER_SIZE):
+        self.conn = conn
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not parsed yet
+        self.end = 0  # end of the received bytes
+
+    def _fill(self, size):
+        """
+        Receive until at least size bytes are buffered after self.start.
+        :param size: no larger than the buffer
+        :return: False if the connection is closed
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start + size > len(self.buffer):
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end].tobytes()
+            self.start, self.end = 0, remaining
+        while self.end - self.start < size:
+            n = self.conn.recv_into(self.view[self.end:])
+            if n == 0:
+                return False
+            self.end += n
+        return True
+
+    def read_packet(self):
+        """
+        Get the next packet of the stream.
+        :return:
+            json_data, or the head (tuple of COMPACT_HEAD) of a compact packet
+            bin_data (memoryview)
+            or None, None if the connection is closed or the packet is broken
+        """
+        if self.end - self.start < 8 and not self._fill(8):
+            return None, None
+        if self.buffer[self.start] == COMPACT_MAGIC:
+            return self._read_compact()
+        j_len, b_len = struct.unpack_from('!II', self.buffer, self.start)
+        if j_len > MAX_JSON_SIZE or b_len > MAX_BODY_SIZE:
+            logger.error(f'Packet of {j_len}+{b_len} bytes is too large.')
+            return None, None
+        total = 8 + j_len + b_len
+        if total > len(self.buffer):
+            # Larger than the buffer: take the buffered part and receive the rest into its own buffer.
+            packet = memoryview(bytearray(j_len + b_len))
+            buffered = min(self.end - self.start - 8, j_len + b_len)
+            packet[:buffered] = self.view[self.start + 8:self.start + 8 + buffered]
+            self.start = self.end = 0
+            if not recv_exactly_into(self.conn, packet[buffered:]):
+                return None, None
+        else:
+            if self.end - self.start < total and not self._fill(total):
+                return None, None
+            packet = self.view[self.start + 8:self.start + total]
+            self.start += total
+        try:
+            json_data = json_loads(packet[:j_len])
+        except Exception as ex:
+            return None, None
+        return json_data, packet[j_len:]
+
+    def _read_compact(self):
+        """
+        Get a packet of the compact framing
+        :return:
+            the head (tuple of COMPACT_HEAD)
+            bin_data (memoryview)
+            or None, None if the connection is closed, the version is unknown or the packet is too large
+        """
+        head_size = COMPACT_HEAD.size
+        if self.end - self.start < head_size and not self._fill(head_size):
+            return None, None
+        head = COMPACT_HEAD.unpack_from(self.buffer, self.start)
+        if head[1] != COMPACT_VERSION or head[6] > MAX_BODY_SIZE:
+            return None, None
+        total = head_size + head[6]
+        if total > len(self.buffer):
+            bin_data = memoryview(bytearray(head[6]))
+            buffered = min(self.end - self.start - head_size, head[6])
+            bin_data[:buffered] = self.view[self.start + head_size:self.start + head_size + buffered]
+            self.start = self.end = 0
+            if not recv_exactly_into(self.conn, bin_data[buffered:]):
+                return None, None
+        else:
+            if self.end - self.start < total and not self._fill(total):
+                return None, None
+            bin_data = self.view[self.start + head_size:self.start + total]
+            self.start += total
+        return head, bin_data
+
+    def __iter__(self):
+        while True:
+            json_data, bin_data = self.read_packet()
+            if json_data is None:
+                return
+            yield json_data, bin_data
+
+
 def make_password(student_id):
     """
     Generate MD5 password (32-char lowercase hex) from student_id per protocol.
@@ -182,16 +536,79 @@ def make_password(student_id):
 
 def send_packet(sock, json_obj, bin_data=None):
     """
-    Serialize and send one STEP protocol packet.
+    Serialize and send one STEP protocol packet (scatter-gather, the binary data is not copied).
+    """
+    send_buffers(sock, make_packet_buffers(json_obj, bin_data))
+
+
+def get_packet_reader(sock):
+    """
+    Get the buffered PacketReader of a socket, created on first use.
     """
-    sock.sendall(make_packet(json_obj, bin_data))
+    with packet_readers_lock:
+        reader = packet_readers.get(sock)
+        if reader is None:
+            reader = PacketReader(sock)
+            packet_readers[sock] = reader
+        return reader
 
 
 def recv_packet(sock):
     """
     Receive and parse one protocol packet. Returns (json_data, bin_data) or (None, None) on error.
     """
-    return get_tcp_packet(sock)
+    return get_packet_reader(sock).read_packet()
+
+
+def make_upload_buffers(token, key, block_index, data, session_id=None, block_count=1):
+    """
+    Buffers of an UPLOAD request, with the compact head if the server has given a session_id, else the JSON head.
+    With a block_count above 1, data is that many contiguous blocks from block_index.
+    """
+    if session_id is not None:
+        return [COMPACT_HEAD.pack(COMPACT_MAGIC, COMPACT_VERSION, COMPACT_UPLOAD, 0, 0,
+                                  block_count if block_count > 1 else 0, len(data), session_id, block_index), data]
+    upload_req = {
+        FIELD_TYPE: TYPE_FILE,
+        FIELD_OPERATION: OP_UPLOAD,
+        FIELD_DIRECTION: DIR_REQUEST,
+        FIELD_TOKEN: token,
+        FIELD_KEY: key,
+        FIELD_BLOCK_INDEX: block_index
+    }
+    if block_count > 1:
+        upload_req[FIELD_BLOCK_COUNT] = block_count
+    return make_packet_buffers(upload_req, data)
+
+
+def validate_upload_response(resp, key, block_index, block_count=1):
+    """
+    Validate the response of an UPLOAD request, a compact head or JSON.
+    Return (True, None) if it is the successful response of the block(s); otherwise (False, error_message).
+    """
+    if type(resp) is tuple:
+        if resp[2] != COMPACT_UPLOAD:
+            return False, f'unexpected compact opcode: expected {COMPACT_UPLOAD}, got {resp[2]}'
+        if resp[4] != 200:
+            return False, f'status {resp[4]} != 200'
+        if resp[8] != block_index:
+            return False, f'mismatched field {FIELD_BLOCK_INDEX}: expected {block_index}, got {resp[8]}'
+        if (resp[5] or 1) != block_count:
+            return False, f'mismatched field {FIELD_BLOCK_COUNT}: expected {block_count}, got {resp[5] or 1}'
+        return True, None
+    match_fields = {
+        FIELD_KEY: key,
+        FIELD_BLOCK_INDEX: block_index
+    }
+    if block_count > 1:
+        match_fields[FIELD_BLOCK_COUNT] = block_count
+    return validate_response(
+        resp,
+        expected_operation=OP_UPLOAD,
+        expected_type=TYPE_FILE,
+        required_fields=[FIELD_KEY, FIELD_BLOCK_INDEX],
+        match_fields=match_fields
+    )
 
 
 def validate_response(resp, *, expected_operation, expected_type, expected_direction=DIR_RESPONSE,
@@ -259,9 +676,12 @@ def login(sock, student_id):
     return token, resp
 
 
-def request_save(sock, token, filename, size):
+def request_save(sock, token, filename, size, block_size=None, compact=False, md5=None):
     """
-    Request upload plan. On success return a dict with key, block_size, total_block; otherwise (None, resp).
+    Request upload plan. On success return a dict with key, block_size, total_block, session_id; otherwise (None, resp).
+    block_size is only a request; the server returns the block size it has chosen.
+    With compact the server is asked for a session of the compact framing; session_id is None if it has none.
+    With the md5 of the file a server storing that content answers with 0 blocks and the "deduplicated" bytes.
     """
     save_req = {
         FIELD_TYPE: TYPE_FILE,
@@ -271,6 +691,12 @@ def request_save(sock, token, filename, size):
         FIELD_KEY: os.path.basename(filename),
         FIELD_SIZE: size
     }
+    if block_size is not None:
+        save_req[FIELD_BLOCK_SIZE] = block_size
+    if compact:
+        save_req[FIELD_COMPACT] = True
+    if md5 is not None:
+        save_req[FIELD_MD5] = md5
     logger.info(f'Sending SAVE request for file {save_req[FIELD_KEY]} (size: {size}).')
     send_packet(sock, save_req)
     resp, _ = recv_packet(sock)
@@ -286,66 +712,164 @@ def request_save(sock, token, filename, size):
     plan = {
         FIELD_KEY: resp[FIELD_KEY],
         FIELD_BLOCK_SIZE: resp[FIELD_BLOCK_SIZE],
-        FIELD_TOTAL_BLOCK: resp[FIELD_TOTAL_BLOCK]
+        FIELD_TOTAL_BLOCK: resp[FIELD_TOTAL_BLOCK],
+        FIELD_SESSION_ID: resp.get(FIELD_SESSION_ID) if compact else None,
+        # A server without batched UPLOAD does not send it
+        FIELD_MAX_BLOCK_COUNT: resp.get(FIELD_MAX_BLOCK_COUNT, 1),
+        FIELD_DEDUPLICATED: resp.get(FIELD_DEDUPLICATED, 0)
+    }
+    logger.info(f'Upload plan received: key={plan[FIELD_KEY]}, block_size={plan[FIELD_BLOCK_SIZE]}, total_block={plan[FIELD_TOTAL_BLOCK]}, session_id={plan[FIELD_SESSION_ID]}')
+    return plan, resp
+
+
+def request_status(sock, token, filename, compact=False):
+    """
+    Request the status of the upload of a key, to resume it. On success return a dict with key, size, block_size,
+    total_block, missing ([first, count] runs of the missing blocks) and session_id; otherwise (None, resp).
+    block_size and total_block are None if the key is completely uploaded.
+    """
+    status_req = {
+        FIELD_TYPE: TYPE_FILE,
+        FIELD_OPERATION: OP_STATUS,
+        FIELD_DIRECTION: DIR_REQUEST,
+        FIELD_TOKEN: token,
+        FIELD_KEY: os.path.basename(filename)
+    }
+    if compact:
+        status_req[FIELD_COMPACT] = True
+    logger.info(f'Sending STATUS request for file {status_req[FIELD_KEY]}.')
+    send_packet(sock, status_req)
+    resp, _ = recv_packet(sock)
+    ok, err = validate_response(
+        resp,
+        expected_operation=OP_STATUS,
+        expected_type=TYPE_FILE,
+        required_fields=[FIELD_KEY, FIELD_SIZE, FIELD_MISSING]
+    )
+    if not ok:
+        logger.info(f'No upload to resume: {err}')
+        return None, resp
+    plan = {
+        FIELD_KEY: resp[FIELD_KEY],
+        FIELD_SIZE: resp[FIELD_SIZE],
+        FIELD_BLOCK_SIZE: resp.get(FIELD_BLOCK_SIZE),
+        FIELD_TOTAL_BLOCK: resp.get(FIELD_TOTAL_BLOCK),
+        FIELD_MISSING: resp[FIELD_MISSING],
+        FIELD_SESSION_ID: resp.get(FIELD_SESSION_ID) if compact else None,
+        FIELD_MAX_BLOCK_COUNT: resp.get(FIELD_MAX_BLOCK_COUNT, 1)
     }
-    logger.info(f'Upload plan received: key={plan[FIELD_KEY]}, block_size={plan[FIELD_BLOCK_SIZE]}, total_block={plan[FIELD_TOTAL_BLOCK]}')
+    logger.info(f'Upload status received: key={plan[FIELD_KEY]}, total_block={plan[FIELD_TOTAL_BLOCK]}, '
+                f'received={resp.get(FIELD_RECEIVED)}, missing ranges={len(plan[FIELD_MISSING])}')
     return plan, resp
 
 
-def upload_blocks(sock, server_ip, server_port, token, key, block_size, total_block, file_path, file_size, metrics=None, block_workers=1):
+def expand_ranges(ranges):
+    """
+    Block indexes of [first, count] runs.
+    """
+    for first, count in ranges:
+        yield from range(first, first + count)
+
+
+def upload_blocks_windowed(sock, token, key, block_size, total_block, file_path, file_size, window, metrics, progress,
+                           session_id=None, ranges=None):
+    """
+    Upload the file in blocks over one connection, keeping up to `window` UPLOAD requests in flight.
+    The server answers the requests of a connection in order, so responses are matched to the oldest
+    request in flight and checked by block_index. A failed request is sent again, at most UPLOAD_RETRIES times.
+    With a session_id the blocks use the compact framing. ranges are the [first, count] runs of blocks to send,
+    one request each; all blocks one by one by default.
+    Return True on success, False on failure.
+    """
+    pending = deque([block_index, 1] for block_index in range(total_block)) if ranges is None else deque(ranges)
+    in_flight = deque()
+    retries = {}
+    with open(file_path, 'rb') as f:
+        while pending or in_flight:
+            while pending and len(in_flight) < window:
+                first, count = pending.popleft()
+                offset = first * block_size
+                data = os.pread(f.fileno(), min(block_size * count, file_size - offset), offset)
+                logger.debug(f'Sending UPLOAD blocks {first}+{count} for key {key}.')
+                send_buffers(sock, make_upload_buffers(token, key, first, data, session_id, count))
+                in_flight.append((first, count, len(data)))
+
+            resp, _ = recv_packet(sock)
+            if resp is None:
+                logger.error(f'UPLOAD aborted: connection closed with {len(in_flight)} requests in flight')
+                return False
+            first, count, sent = in_flight.popleft()
+            ok, err = validate_upload_response(resp, key, first, count)
+            if not ok:
+                if metrics is not None:
+                    metrics['block_failures'] += 1
+                retries[first] = retries.get(first, 0) + 1
+                if retries[first] > UPLOAD_RETRIES:
+                    logger.error(f'UPLOAD block {first} failed after {UPLOAD_RETRIES} retries: {err}')
+                    return False
+                logger.warning(f'UPLOAD block {first} failed, retransmitting: {err}')
+                pending.appendleft([first, count])
+                continue
+
+            if metrics is not None:
+                metrics['blocks_sent'] += count
+                metrics['bytes_sent'] += sent
+            progress.update(count)
+    return True
+
+
+def upload_blocks(sock, server_ip, server_port, token, key, block_size, total_block, file_path, file_size, metrics=None, block_workers=1, window=1, session_id=None, blocks=None, batch_blocks=1):
     """
     Upload the file in blocks. Return True on success, False on failure.
+    The session_id of the compact framing belongs to sock, so the block workers use JSON heads on their own connections.
+    blocks are the block indexes to send (those missing when resuming), all by default. Contiguous blocks are
+    sent batch_blocks at a time in one UPLOAD request.
     """
+    if blocks is None:
+        blocks = range(total_block)
+    ranges = block_ranges(blocks, batch_blocks)
     if metrics is not None:
         metrics.setdefault('blocks_sent', 0)
         metrics.setdefault('bytes_sent', 0)
         metrics.setdefault('block_failures', 0)
 
     progress = tqdm(
-        total=total_block,
+        total=len(blocks),
         unit='block',
         unit_scale=True,
         desc=f'Uploading {os.path.basename(file_path)}',
         leave=True
     )
 
+    if window > 1:
+        if block_workers > 1:
+            logger.warning(f'--window {window} is used on one connection; --block-workers {block_workers} is ignored.')
+        ok = upload_blocks_windowed(sock, token, key, block_size, total_block, file_path, file_size, window,
+                                    metrics, progress, session_id, ranges)
+        progress.close()
+        return ok
+
     if block_workers <= 1:
         with open(file_path, 'rb') as f:
-            for block_index in range(total_block):
-                data = f.read(block_size)
-                upload_req = {
-                    FIELD_TYPE: TYPE_FILE,
-                    FIELD_OPERATION: OP_UPLOAD,
-                    FIELD_DIRECTION: DIR_REQUEST,
-                    FIELD_TOKEN: token,
-                    FIELD_KEY: key,
-                    FIELD_BLOCK_INDEX: block_index
-                }
-                logger.debug(f'Sending UPLOAD block {block_index} for key {key}.')
-                send_packet(sock, upload_req, data)
+            for first, count in ranges:
+                offset = first * block_size
+                data = os.pread(f.fileno(), min(block_size * count, file_size - offset), offset)
+                logger.debug(f'Sending UPLOAD blocks {first}+{count} for key {key}.')
+                send_buffers(sock, make_upload_buffers(token, key, first, data, session_id, count))
                 resp, _ = recv_packet(sock)
-                ok, err = validate_response(
-                    resp,
-                    expected_operation=OP_UPLOAD,
-                    expected_type=TYPE_FILE,
-                    required_fields=[FIELD_KEY, FIELD_BLOCK_INDEX],
-                    match_fields={
-                        FIELD_KEY: key,
-                        FIELD_BLOCK_INDEX: block_index
-                    }
-                )
+                ok, err = validate_upload_response(resp, key, first, count)
                 if not ok:
-                    logger.error(f'UPLOAD block {block_index} failed: {err}')
+                    logger.error(f'UPLOAD block {first} failed: {err}')
                     if metrics is not None:
                         metrics['block_failures'] += 1
                     progress.close()
                     return False
 
                 if metrics is not None:
-                    metrics['blocks_sent'] += 1
+                    metrics['blocks_sent'] += count
                     metrics['bytes_sent'] += len(data)
 
-                progress.update(1)
+                progress.update(count)
         progress.close()
         return True
 
@@ -372,40 +896,19 @@ def upload_blocks(sock, server_ip, server_port, token, key, block_size, total_bl
             with open(file_path, 'rb') as f:
                 while not stop_event.is_set():
                     with index_lock:
-                        if state["next_index"] >= total_block:
+                        if state["next_index"] >= len(ranges):
                             break
-                        block_index = state["next_index"]
+                        first, count = ranges[state["next_index"]]
                         state["next_index"] += 1
 
-                    offset = block_index * block_size
-                    remaining = file_size - offset
-                    read_size = block_size if block_index != total_block - 1 else remaining
-                    f.seek(offset)
-                    data = f.read(read_size)
-
-                    upload_req = {
-                        FIELD_TYPE: TYPE_FILE,
-                        FIELD_OPERATION: OP_UPLOAD,
-                        FIELD_DIRECTION: DIR_REQUEST,
-                        FIELD_TOKEN: token,
-                        FIELD_KEY: key,
-                        FIELD_BLOCK_INDEX: block_index
-                    }
-
-                    send_packet(worker_sock, upload_req, data)
+                    offset = first * block_size
+                    data = os.pread(f.fileno(), min(block_size * count, file_size - offset), offset)
+
+                    send_buffers(worker_sock, make_upload_buffers(token, key, first, data, None, count))
                     resp, _ = recv_packet(worker_sock)
-                    ok, err = validate_response(
-                        resp,
-                        expected_operation=OP_UPLOAD,
-                        expected_type=TYPE_FILE,
-                        required_fields=[FIELD_KEY, FIELD_BLOCK_INDEX],
-                        match_fields={
-                            FIELD_KEY: key,
-                            FIELD_BLOCK_INDEX: block_index
-                        }
-                    )
+                    ok, err = validate_upload_response(resp, key, first, count)
                     if not ok:
-                        logger.error(f'UPLOAD block {block_index} failed: {err}')
+                        logger.error(f'UPLOAD block {first} failed: {err}')
                         stop_event.set()
                         failure_info["message"] = err
                         if metrics is not None:
@@ -415,11 +918,11 @@ def upload_blocks(sock, server_ip, server_port, token, key, block_size, total_bl
 
                     if metrics is not None:
                         with metrics_lock:
-                            metrics['blocks_sent'] += 1
+                            metrics['blocks_sent'] += count
                             metrics['bytes_sent'] += len(data)
 
                     with progress_lock:
-                        progress.update(1)
+                        progress.update(count)
         finally:
             worker_sock.close()
 
@@ -441,9 +944,11 @@ def upload_blocks(sock, server_ip, server_port, token, key, block_size, total_bl
     return True
 
 
-def verify_upload(sock, token, key, file_path):
+def verify_upload(sock, token, key, file_path, digest_algorithm='md5', local_md5=None):
     """
-    Send GET to verify upload. Return (server_md5, resp_json) or (None, resp_json/None) on failure.
+    Send GET to verify upload. Return (server_digest, local_digest, resp_json) or (None, None, resp_json/None)
+    on failure. With a digest_algorithm other than md5 the server is asked for that digest; the local digest
+    uses the algorithm the server answered with. local_md5 is used instead of reading the file for MD5.
     """
     logger.info('All file blocks sent. Sending GET request to verify.')
     get_req = {
@@ -453,6 +958,8 @@ def verify_upload(sock, token, key, file_path):
         FIELD_TOKEN: token,
         FIELD_KEY: key
     }
+    if digest_algorithm != 'md5':
+        get_req[FIELD_DIGEST_ALGORITHM] = digest_algorithm
     send_packet(sock, get_req)
     resp, _ = recv_packet(sock)
     ok, err = validate_response(
@@ -464,15 +971,450 @@ def verify_upload(sock, token, key, file_path):
     )
     if not ok:
         logger.error(f'GET verification failed: {err}')
+        return None, None, resp
+    if FIELD_DIGEST in resp:
+        algorithm = resp.get(FIELD_DIGEST_ALGORITHM, 'md5')
+        server_digest = resp[FIELD_DIGEST]
+    else:
+        algorithm = 'md5'
+        server_digest = resp[FIELD_MD5]
+    if algorithm == 'md5' and local_md5 is not None:
+        local_digest = local_md5
+    else:
+        local_digest = get_file_digest(file_path, algorithm)
+    logger.info(f'Local {algorithm.upper()}:  {local_digest}')
+    logger.info(f'Server {algorithm.upper()}: {server_digest}')
+    return server_digest, local_digest, resp
+
+
+def request_get(sock, token, key, block_size=None, compact=False):
+    """
+    Request the download plan of a key. On success return a dict with key, size, block_size, total_block, md5 and
+    session_id; otherwise (None, resp).
+    """
+    get_req = {
+        FIELD_TYPE: TYPE_FILE,
+        FIELD_OPERATION: OP_GET,
+        FIELD_DIRECTION: DIR_REQUEST,
+        FIELD_TOKEN: token,
+        FIELD_KEY: key
+    }
+    if block_size is not None:
+        get_req[FIELD_BLOCK_SIZE] = block_size
+    if compact:
+        get_req[FIELD_COMPACT] = True
+    logger.info(f'Sending GET request for key {key}.')
+    send_packet(sock, get_req)
+    resp, _ = recv_packet(sock)
+    ok, err = validate_response(
+        resp,
+        expected_operation=OP_GET,
+        expected_type=TYPE_FILE,
+        required_fields=[FIELD_KEY, FIELD_SIZE, FIELD_BLOCK_SIZE, FIELD_TOTAL_BLOCK, FIELD_MD5],
+        match_fields={FIELD_KEY: key}
+    )
+    if not ok:
+        logger.error(f'GET response invalid: {err}')
         return None, resp
-    server_md5 = resp[FIELD_MD5]
-    local_md5 = get_file_md5(file_path)
-    logger.info(f'Local MD5:  {local_md5}')
-    logger.info(f'Server MD5: {server_md5}')
-    return server_md5, resp
+    plan = {
+        FIELD_KEY: resp[FIELD_KEY],
+        FIELD_SIZE: resp[FIELD_SIZE],
+        FIELD_BLOCK_SIZE: resp[FIELD_BLOCK_SIZE],
+        FIELD_TOTAL_BLOCK: resp[FIELD_TOTAL_BLOCK],
+        FIELD_MD5: resp[FIELD_MD5],
+        FIELD_SESSION_ID: resp.get(FIELD_SESSION_ID) if compact else None
+    }
+    logger.info(f'Download plan received: key={key}, size={plan[FIELD_SIZE]}, block_size={plan[FIELD_BLOCK_SIZE]}, total_block={plan[FIELD_TOTAL_BLOCK]}, session_id={plan[FIELD_SESSION_ID]}')
+    return plan, resp
+
+
+def make_download_buffers(token, key, block_index, block_size=None, session_id=None, block_count=1):
+    """
+    Buffers of a DOWNLOAD request, with the compact head if the server has given a session_id, else the JSON head.
+    block_size is repeated from a plan that was asked for with one; the default plan has none.
+    With a block_count above 1 the request asks for that many blocks from block_index.
+    """
+    if session_id is not None:
+        return [COMPACT_HEAD.pack(COMPACT_MAGIC, COMPACT_VERSION, COMPACT_DOWNLOAD, 0, 0,
+                                  block_count if block_count > 1 else 0, 0, session_id, block_index)]
+    download_req = {
+        FIELD_TYPE: TYPE_FILE,
+        FIELD_OPERATION: OP_DOWNLOAD,
+        FIELD_DIRECTION: DIR_REQUEST,
+        FIELD_TOKEN: token,
+        FIELD_KEY: key,
+        FIELD_BLOCK_INDEX: block_index
+    }
+    if block_size is not None:
+        download_req[FIELD_BLOCK_SIZE] = block_size
+    if block_count > 1:
+        download_req[FIELD_BLOCK_COUNT] = block_count
+    return make_packet_buffers(download_req)
 
 
-def tcp_sender(server_ip, student_id, file_path, *, block_workers=1):
+def validate_download_response(resp, data, key, block_index, block_count, block_size, file_size):
+    """
+    Validate the response of a DOWNLOAD request, a compact head or JSON, and the length of its data.
+    The server may send fewer blocks of a range than asked for (a server without ranges sends one).
+    Return (True, None, number of blocks sent) if it is the block(s); otherwise (False, error_message, 0).
+    """
+    if type(resp) is tuple:
+        if resp[2] != COMPACT_DOWNLOAD:
+            return False, f'unexpected compact opcode: expected {COMPACT_DOWNLOAD}, got {resp[2]}', 0
+        if resp[4] != 200:
+            return False, f'status {resp[4]} != 200', 0
+        if resp[8] != block_index:
+            return False, f'mismatched field {FIELD_BLOCK_INDEX}: expected {block_index}, got {resp[8]}', 0
+        sent = resp[5] or 1
+    else:
+        ok, err = validate_response(
+            resp,
+            expected_operation=OP_DOWNLOAD,
+            expected_type=TYPE_FILE,
+            required_fields=[FIELD_KEY, FIELD_BLOCK_INDEX],
+            match_fields={
+                FIELD_KEY: key,
+                FIELD_BLOCK_INDEX: block_index
+            }
+        )
+        if not ok:
+            return ok, err, 0
+        sent = resp.get(FIELD_BLOCK_COUNT, 1)
+    if type(sent) is not int or not 1 <= sent <= block_count:
+        return False, f'{sent} blocks sent from block {block_index}, asked for {block_count}', 0
+    expected_size = min(sent * block_size, file_size - block_index * block_size)
+    if len(data) != expected_size:
+        return False, f'block {block_index} has {len(data)} bytes, expected {expected_size}', 0
+    return True, None, sent
+
+
+class DownloadState:
+    """
+    Blocks of a download written to the file: a bitmap in the sidecar file "<file>.download", mapped with mmap
+    so that it survives the client, and an interrupted download continues with the blocks it misses.
+    The header holds the plan (size, block size, MD5); a sidecar file of another plan is replaced.
+    The MD5 is fed with the contiguous prefix of written blocks, so it is ready when the last block arrives.
+    """
+    # magic, file size, block size, MD5 (hex); followed by the bitmap
+    HEADER = struct.Struct('!4sQQ32s')
+    MAGIC = b'STEP'
+
+    def __init__(self, path, size, block_size, md5):
+        self.path = path
+        self.block_size = block_size
+        self.total = math.ceil(size / block_size)
+        header = self.HEADER.pack(self.MAGIC, size, block_size, md5.encode())
+        length = self.HEADER.size + (self.total + 7) // 8
+        try:
+            fid = open(path, 'r+b', buffering=0)
+            if fid.read(self.HEADER.size) != header or os.fstat(fid.fileno()).st_size != length:
+                fid.close()
+                fid = None
+        except FileNotFoundError:
+            fid = None
+        if fid is None:
+            fid = open(path, 'w+b', buffering=0)
+            fid.write(header)
+            fid.truncate(length)
+        self.fid = fid
+        self.mm = mmap.mmap(fid.fileno(), 0)
+        self.bitmap = memoryview(self.mm)[self.HEADER.size:]
+        self.lock = threading.Lock()
+        # MD5 of the blocks [0, hashed)
+        self.md5 = hashlib.md5()
+        self.md5_lock = threading.Lock()
+        self.hashed = 0
+
+    def has(self, block_index):
+        return self.bitmap[block_index >> 3] & (1 << (block_index & 7)) != 0
+
+    def add(self, block_index):
+        """
+        Mark a block as written (after its pwrite).
+        :return: True if the block is new
+        """
+        with self.lock:
+            if self.has(block_index):
+                return False
+            self.bitmap[block_index >> 3] |= 1 << (block_index & 7)
+            return True
+
+    def missing_blocks(self):
+        return [block_index for block_index in range(self.total) if not self.has(block_index)]
+
+    def update_md5(self, fd, block_index, data):
+        """
+        Feed the MD5 with the contiguous prefix of written blocks. The new block is hashed from memory if it
+        extends the prefix; blocks written earlier (out of order, or before a resume) are read back from the file.
+        A thread that finds the MD5 busy returns at once: the hashing thread checks the prefix again.
+        :param fd: file descriptor of the downloaded file
+        :param block_index: the block just written (already added)
+        :param data: its data
+        """
+        while self.hashed < self.total and self.has(self.hashed):
+            if not self.md5_lock.acquire(blocking=False):
+                return
+            try:
+                while self.hashed < self.total and self.has(self.hashed):
+                    if self.hashed == block_index:
+                        self.md5.update(data)
+                    else:
+                        self.md5.update(os.pread(fd, self.block_size, self.hashed * self.block_size))
+                    self.hashed += 1
+            finally:
+                self.md5_lock.release()
+
+    def get_md5(self, fd):
+        """
+        MD5 of the completed download; the blocks not hashed yet are read back from the file.
+        """
+        with self.md5_lock:
+            while self.hashed < self.total:
+                self.md5.update(os.pread(fd, self.block_size, self.hashed * self.block_size))
+                self.hashed += 1
+            return self.md5.hexdigest()
+
+    def close(self, remove=False):
+        """
+        Unmap the sidecar file, and delete it when the download is completed.
+        """
+        self.bitmap.release()
+        self.mm.close()
+        self.fid.close()
+        if remove:
+            os.remove(self.path)
+
+
+def block_ranges(blocks, max_count):
+    """
+    Group sorted block indexes into [first, count] runs of contiguous blocks, at most max_count blocks each.
+    """
+    ranges = []
+    for block_index in blocks:
+        if ranges and ranges[-1][0] + ranges[-1][1] == block_index and ranges[-1][1] < max_count:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([block_index, 1])
+    return ranges
+
+
+def download_blocks_windowed(sock, token, key, block_size, file_size, fd, state, pending, window, metrics, progress,
+                             progress_lock, session_id=None, asked_block_size=False):
+    """
+    Download blocks over one connection, keeping up to `window` DOWNLOAD requests in flight, and write them
+    with os.pwrite. [first, count] ranges of blocks are taken from the left of `pending`, which block workers
+    share (deque.popleft is atomic); the rest of a range the server has cut is put back, and so is a failed
+    range, at most DOWNLOAD_RETRIES times.
+    asked_block_size tells if the plan was asked for with a block size, which the requests then repeat.
+    Return True on success, False on failure; the ranges in flight are then put back to `pending` for the
+    other workers (also when an OSError is raised).
+    """
+    in_flight = deque()
+    try:
+        return _download_blocks_windowed(sock, token, key, block_size, file_size, fd, state, pending, in_flight,
+                                         window, metrics, progress, progress_lock, session_id, asked_block_size)
+    finally:
+        pending.extend(in_flight)
+
+
+def _download_blocks_windowed(sock, token, key, block_size, file_size, fd, state, pending, in_flight, window,
+                              metrics, progress, progress_lock, session_id, asked_block_size):
+    retries = {}
+    while pending or in_flight:
+        while len(in_flight) < window:
+            try:
+                first, count = pending.popleft()
+            except IndexError:
+                break
+            logger.debug(f'Sending DOWNLOAD blocks {first}+{count} for key {key}.')
+            send_buffers(sock, make_download_buffers(token, key, first, block_size if asked_block_size else None,
+                                                     session_id, count))
+            in_flight.append((first, count))
+        if not in_flight:
+            break
+
+        resp, data = recv_packet(sock)
+        if resp is None:
+            logger.error(f'DOWNLOAD aborted: connection closed with {len(in_flight)} requests in flight')
+            return False
+        first, count = in_flight.popleft()
+        ok, err, sent = validate_download_response(resp, data, key, first, count, block_size, file_size)
+        if not ok:
+            metrics['block_failures'] += 1
+            retries[first] = retries.get(first, 0) + 1
+            if retries[first] > DOWNLOAD_RETRIES:
+                logger.error(f'DOWNLOAD block {first} failed after {DOWNLOAD_RETRIES} retries: {err}')
+                in_flight.appendleft((first, count))
+                return False
+            logger.warning(f'DOWNLOAD block {first} failed, requesting it again: {err}')
+            pending.appendleft([first, count])
+            continue
+        if sent < count:
+            pending.appendleft([first + sent, count - sent])
+
+        os.pwrite(fd, data, first * block_size)
+        for i in range(sent):
+            if state.add(first + i):
+                state.update_md5(fd, first + i, data[i * block_size:(i + 1) * block_size])
+        metrics['blocks_received'] += sent
+        metrics['bytes_received'] += len(data)
+        with progress_lock:
+            progress.update(sent)
+    return True
+
+
+def download_blocks(sock, server_ip, server_port, token, key, block_size, file_size, fd, state, blocks, metrics,
+                    block_workers=1, window=1, session_id=None, asked_block_size=False, range_blocks=1):
+    """
+    Download the blocks, over sock or over block_workers connections of their own (each with `window`
+    requests in flight), asking for up to range_blocks contiguous blocks per request.
+    Return True if all blocks of the file are written, False otherwise.
+    """
+    progress = tqdm(
+        total=len(blocks),
+        unit='block',
+        unit_scale=True,
+        desc=f'Downloading {key}',
+        leave=True
+    )
+    progress_lock = threading.Lock()
+    # A response larger than MAX_BODY_SIZE would be refused
+    pending = deque(block_ranges(blocks, max(1, min(range_blocks, MAX_BODY_SIZE // block_size))))
+    for name in ('blocks_received', 'bytes_received', 'block_failures'):
+        metrics.setdefault(name, 0)
+
+    if block_workers <= 1:
+        download_blocks_windowed(sock, token, key, block_size, file_size, fd, state, pending, window, metrics,
+                                 progress, progress_lock, session_id, asked_block_size)
+    else:
+        worker_metrics = [{'blocks_received': 0, 'bytes_received': 0, 'block_failures': 0}
+                          for _ in range(block_workers)]
+
+        def worker(own_metrics):
+            try:
+                with socket(AF_INET, SOCK_STREAM) as worker_sock:
+                    worker_sock.connect((server_ip, server_port))
+                    # The compact session belongs to sock, so the workers use JSON heads
+                    download_blocks_windowed(worker_sock, token, key, block_size, file_size, fd, state, pending,
+                                             window, own_metrics, progress, progress_lock,
+                                             asked_block_size=asked_block_size)
+            except OSError as exc:
+                logger.error(f'Worker failed: {exc}')
+
+        threads = [threading.Thread(target=worker, args=(own_metrics,), daemon=True) for own_metrics in worker_metrics]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        for own_metrics in worker_metrics:
+            for name, value in own_metrics.items():
+                metrics[name] += value
+        if pending:
+            # Put back by a worker that failed after the others had finished
+            logger.warning(f'Downloading {len(pending)} ranges of failed workers over the main connection.')
+            download_blocks_windowed(sock, token, key, block_size, file_size, fd, state, pending, window, metrics,
+                                     progress, progress_lock, session_id, asked_block_size)
+    progress.close()
+
+    # The ranges of a failed worker are put back for the others; the download is complete only if none is missing
+    missing = len(state.missing_blocks())
+    if missing:
+        logger.error(f'DOWNLOAD incomplete: {missing} blocks missing')
+        return False
+    return True
+
+
+def tcp_receiver(server_ip, student_id, key, output_dir='.', *, block_workers=1, window=1, block_size=None,
+                 compact=False, range_blocks=1):
+    """
+    Download the file of key into output_dir: GET the plan, DOWNLOAD the blocks missing from the sidecar file
+    (all of them for a new download) and check the MD5.
+    :return: metrics, or None on failure
+    """
+    file_path = join(output_dir, key)
+    state_path = file_path + '.download'
+    metrics = {
+        'server_ip': server_ip,
+        'student_id': student_id,
+        'file_path': file_path
+    }
+    total_start = time.perf_counter()
+
+    with socket(AF_INET, SOCK_STREAM) as sock:
+        logger.info(f'Connecting to server {server_ip}:1379')
+        sock.connect((server_ip, 1379))
+        logger.info('Connected to server.')
+        token, login_resp = login(sock, student_id)
+        if token is None:
+            print(f"Login failed: {None if login_resp is None else login_resp.get('status_msg', 'Unknown error')}")
+            return None
+
+        if compact and block_workers > 1:
+            logger.warning(f'--compact is not used with --block-workers {block_workers}.')
+            compact = False
+        asked_block_size = block_size is not None
+        plan, get_resp = request_get(sock, token, key, block_size, compact)
+        if plan is None:
+            print(f"GET failed: {None if get_resp is None else get_resp.get('status_msg', 'Unknown error')}")
+            return None
+        file_size = plan[FIELD_SIZE]
+        block_size = plan[FIELD_BLOCK_SIZE]
+        metrics['file_size_bytes'] = file_size
+        metrics['block_size_bytes'] = block_size
+        metrics['total_blocks'] = plan[FIELD_TOTAL_BLOCK]
+        if compact and plan[FIELD_SESSION_ID] is None:
+            logger.warning('The server does not support the compact framing; the blocks use JSON heads.')
+
+        # The sidecar file only describes a file of the planned size
+        if (not os.path.exists(file_path) or getsize(file_path) != file_size) and os.path.exists(state_path):
+            os.remove(state_path)
+        state = DownloadState(state_path, file_size, block_size, plan[FIELD_MD5])
+        blocks = state.missing_blocks()
+        metrics['blocks_resumed'] = plan[FIELD_TOTAL_BLOCK] - len(blocks)
+        print(f"Download plan: key={key}, block_size={block_size}, total_block={plan[FIELD_TOTAL_BLOCK]}, "
+              f"to receive={len(blocks)}")
+
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, file_size)
+            download_start = time.perf_counter()
+            ok = not blocks or download_blocks(sock, server_ip, 1379, token, key, block_size, file_size, fd, state,
+                                               blocks, metrics, block_workers, window, plan[FIELD_SESSION_ID],
+                                               asked_block_size, range_blocks)
+            metrics['download_seconds'] = time.perf_counter() - download_start
+            local_md5 = state.get_md5(fd) if ok else None
+        finally:
+            os.close(fd)
+        if not ok:
+            state.close()
+            print("DOWNLOAD failed: see logs for details; run it again to resume")
+            return None
+
+        logger.info(f'Local MD5:  {local_md5}')
+        logger.info(f'Server MD5: {plan[FIELD_MD5]}')
+        print(f"Local MD5:  {local_md5}")
+        print(f"Server MD5: {plan[FIELD_MD5]}")
+        # A corrupted download is not resumed
+        state.close(remove=True)
+        if local_md5 != plan[FIELD_MD5]:
+            print("MD5 mismatch! Download may be corrupted.")
+            logger.error('MD5 mismatch! Download may be corrupted.')
+            return None
+        print("Download verified successfully!")
+        logger.info('Download verified successfully! MD5 match.')
+
+    metrics['total_seconds'] = time.perf_counter() - total_start
+    if metrics.get('bytes_received') and metrics['download_seconds'] > 0:
+        metrics['throughput_mbps'] = (
+            metrics['bytes_received'] / metrics['download_seconds'] / (1024 * 1024)
+        )
+    else:
+        metrics['throughput_mbps'] = None
+    return metrics
+
+
+def tcp_sender(server_ip, student_id, file_path, *, block_workers=1, window=1, block_size=None,
+               digest_algorithm='md5', compact=False, resume=False, batch_blocks=1, dedup=False):
     if not os.path.exists(file_path):
         print(f"Error: File '{file_path}' does not exist.")
         logger.error(f'File not found: {file_path}')
@@ -498,20 +1440,47 @@ def tcp_sender(server_ip, student_id, file_path, *, block_workers=1):
             print(f"Login failed: {None if login_resp is None else login_resp.get('status_msg', 'Unknown error')}")
             return None
 
-        plan, save_resp = request_save(sock, token, file_path, file_size)
+        if compact and block_workers > 1 and window <= 1:
+            logger.warning(f'--compact is not used with --block-workers {block_workers}.')
+            compact = False
+        plan = None
+        if resume:
+            plan, status_resp = request_status(sock, token, file_path, compact)
+            if plan is not None and plan[FIELD_SIZE] != file_size:
+                logger.warning(f'The upload on the server is {plan[FIELD_SIZE]} bytes, the file {file_size} bytes; '
+                               f'starting a new upload.')
+                plan = None
+            if plan is None:
+                print("Nothing to resume, starting a new upload.")
+        local_md5 = None
         if plan is None:
-            print(f"SAVE failed: {None if save_resp is None else save_resp.get('status_msg', 'Unknown error')}")
-            logger.error(f'SAVE failed: {None if save_resp is None else save_resp.get("status_msg", "Unknown error")}')
-            return None
+            if dedup:
+                hash_start = time.perf_counter()
+                local_md5 = get_file_md5(file_path)
+                metrics['hash_seconds'] = time.perf_counter() - hash_start
+            plan, save_resp = request_save(sock, token, file_path, file_size, block_size, compact, local_md5)
+            if plan is None:
+                print(f"SAVE failed: {None if save_resp is None else save_resp.get('status_msg', 'Unknown error')}")
+                logger.error(f'SAVE failed: {None if save_resp is None else save_resp.get("status_msg", "Unknown error")}')
+                return None
+            plan[FIELD_MISSING] = [[0, plan[FIELD_TOTAL_BLOCK]]]
         key = plan[FIELD_KEY]
         block_size = plan[FIELD_BLOCK_SIZE]
         total_block = plan[FIELD_TOTAL_BLOCK]
-        print(f"Upload plan: key={key}, block_size={block_size}, total_block={total_block}")
+        blocks = list(expand_ranges(plan[FIELD_MISSING]))
+        print(f"Upload plan: key={key}, block_size={block_size}, total_block={total_block}, to send={len(blocks)}")
+        metrics['bytes_deduplicated'] = plan.get(FIELD_DEDUPLICATED, 0)
+        if metrics['bytes_deduplicated']:
+            print(f"The server already stores this content: {metrics['bytes_deduplicated']} bytes not uploaded.")
+            logger.info(f'Deduplicated by the server: {metrics["bytes_deduplicated"]} bytes not uploaded.')
+        if compact and plan[FIELD_SESSION_ID] is None:
+            logger.warning('The server does not support the compact framing; the blocks use JSON heads.')
 
         metrics['block_size_bytes'] = block_size
         metrics['total_blocks'] = total_block
+        metrics['blocks_resumed'] = 0 if total_block is None else total_block - len(blocks)
         upload_start = time.perf_counter()
-        ok = upload_blocks(
+        ok = not blocks or upload_blocks(
             sock,
             server_ip,
             1379,
@@ -522,7 +1491,11 @@ def tcp_sender(server_ip, student_id, file_path, *, block_workers=1):
             file_path,
             file_size,
             metrics=metrics,
-            block_workers=block_workers
+            block_workers=block_workers,
+            window=window,
+            session_id=plan[FIELD_SESSION_ID],
+            blocks=blocks,
+            batch_blocks=min(batch_blocks, plan[FIELD_MAX_BLOCK_COUNT])
         )
         metrics['upload_seconds'] = time.perf_counter() - upload_start
         if not ok:
@@ -530,28 +1503,30 @@ def tcp_sender(server_ip, student_id, file_path, *, block_workers=1):
             return None
 
         verify_start = time.perf_counter()
-        server_md5, get_resp = verify_upload(sock, token, key, file_path)
+        server_digest, local_digest, get_resp = verify_upload(sock, token, key, file_path, digest_algorithm,
+                                                              local_md5)
         metrics['verify_seconds'] = time.perf_counter() - verify_start
         print(f"GET response: {json.dumps(get_resp, indent=2) if get_resp is not None else None}")
-        if server_md5 is None:
+        if server_digest is None:
             print(f"GET failed: {None if get_resp is None else get_resp.get('status_msg')}")
             return None
 
-        local_md5 = get_file_md5(file_path)
-        print(f"Local MD5:  {local_md5}")
-        print(f"Server MD5: {server_md5}")
-        if server_md5 == local_md5:
+        algorithm = get_resp.get(FIELD_DIGEST_ALGORITHM, 'md5').upper()
+        print(f"Local {algorithm}:  {local_digest}")
+        print(f"Server {algorithm}: {server_digest}")
+        if server_digest == local_digest:
             print("Upload verified successfully!")
-            logger.info('Upload verified successfully! MD5 match.')
+            logger.info(f'Upload verified successfully! {algorithm} match.')
         else:
-            print("MD5 mismatch! Upload may be corrupted.")
-            logger.error('MD5 mismatch! Upload may be corrupted.')
+            print(f"{algorithm} mismatch! Upload may be corrupted.")
+            logger.error(f'{algorithm} mismatch! Upload may be corrupted.')
 
         logger.info('Client session ended.')
     metrics['total_seconds'] = time.perf_counter() - total_start
-    if metrics.get('upload_seconds') and metrics['upload_seconds'] > 0:
+    if metrics.get('bytes_sent') and metrics['upload_seconds'] > 0:
+        # Only the bytes sent count when an upload is resumed
         metrics['throughput_mbps'] = (
-            metrics['file_size_bytes'] / metrics['upload_seconds'] / (1024 * 1024)
+            metrics['bytes_sent'] / metrics['upload_seconds'] / (1024 * 1024)
         )
     else:
         metrics['throughput_mbps'] = None
@@ -560,8 +1535,25 @@ def tcp_sender(server_ip, student_id, file_path, *, block_workers=1):
 
 def main():
     args = _argparse()
+    set_json_codec(args.json_codec)
     server_ip = args.server_ip
     student_id = args.id
+    if args.download:
+        logger.info(f'Starting download of {len(args.download)} keys. Server: {server_ip}, ID: {student_id}')
+        os.makedirs(args.output_dir, exist_ok=True)
+        results = []
+        for key in args.download:
+            metrics = tcp_receiver(server_ip, student_id, key, args.output_dir, block_workers=args.block_workers,
+                                   window=args.window, block_size=args.block_size, compact=args.compact,
+                                   range_blocks=args.range_blocks)
+            results.append({
+                'file': join(args.output_dir, key),
+                'metrics': metrics
+            })
+        print_summary(results, 'Download')
+        logger.info('Client finished (download).')
+        return
+
     file_paths = []
     if args.files:
         file_paths.extend(args.files)
@@ -585,26 +1577,40 @@ def main():
     if len(file_paths) == 1:
         file_path = file_paths[0]
         logger.info(f'Starting client. Server: {server_ip}, ID: {student_id}, File: {file_path}')
-        tcp_sender(server_ip, student_id, file_path, block_workers=args.block_workers)
+        tcp_sender(server_ip, student_id, file_path, block_workers=args.block_workers, window=args.window,
+                   block_size=args.block_size, digest_algorithm=args.digest, compact=args.compact,
+                   resume=args.resume, batch_blocks=args.batch_blocks, dedup=args.dedup)
         logger.info(f'Client finished.')
         return
 
     logger.info(f'Starting sequential multi-upload for {len(file_paths)} files.')
-    print(f"Starting multi-upload: files={len(file_paths)}, block_workers={args.block_workers}")
+    print(f"Starting multi-upload: files={len(file_paths)}, block_workers={args.block_workers}, window={args.window}")
 
     results = []
     for path in file_paths:
         logger.info(f'Uploading file: {path}')
-        metrics = tcp_sender(server_ip, student_id, path, block_workers=args.block_workers)
+        metrics = tcp_sender(server_ip, student_id, path, block_workers=args.block_workers, window=args.window,
+                             block_size=args.block_size, digest_algorithm=args.digest, compact=args.compact,
+                             resume=args.resume, batch_blocks=args.batch_blocks, dedup=args.dedup)
         results.append({
             'file': path,
             'metrics': metrics
         })
 
+    print_summary(results)
+    logger.info('Client finished (multi-upload).')
+
+
+def print_summary(results, direction='Upload'):
+    """
+    Print the table of the transfers of several files
+    :param results: list of {'file': path, 'metrics': metrics of tcp_sender/tcp_receiver, or None if it failed}
+    :param direction: Upload or Download
+    """
     if results:
         print("\nSummary:")
-        headers = ["File", "Size (MB)", "Upload Time (s)", "Throughput (MB/s)", "Status"]
-        col_widths = [max(len(h), 20), 12, 16, 18, 10]
+        headers = ["File", "Size (MB)", f"{direction} Time (s)", "Throughput (MB/s)", "Status"]
+        col_widths = [max([20] + [len(item["file"]) for item in results]), 12, 16, 18, 10]
 
         def fmt_row(values):
             return " | ".join(str(v).ljust(w) for v, w in zip(values, col_widths))
@@ -616,22 +1622,24 @@ def main():
             if metrics is None:
                 status = "FAILED"
                 size_mb = "—"
-                upload_time = "—"
+                elapsed = "—"
                 throughput = "—"
             else:
                 status = "OK"
                 size_mb = f"{metrics['file_size_bytes'] / (1024 * 1024):.2f}"
-                upload_time = f"{metrics['upload_seconds']:.3f}" if metrics.get('upload_seconds') else "—"
+                seconds = metrics.get(f'{direction.lower()}_seconds')
+                elapsed = f"{seconds:.3f}" if seconds else "—"
                 throughput = f"{metrics['throughput_mbps']:.2f}" if metrics.get('throughput_mbps') else "—"
             print(fmt_row([
                 item['file'],
                 size_mb,
-                upload_time,
+                elapsed,
                 throughput,
                 status
             ]))
-
-    logger.info('Client finished (multi-upload).')
+        deduplicated = sum(item['metrics'].get('bytes_deduplicated', 0) for item in results if item['metrics'])
+        if deduplicated:
+            print(f"\nDeduplicated by the server: {deduplicated / (1024 * 1024):.2f} MB not uploaded.")
 
 
 if __name__ == '__main__':
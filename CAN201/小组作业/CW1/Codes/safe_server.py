@@ -4,30 +4,127 @@ import os
 from os.path import join, getsize
 import hashlib
 import argparse
-from threading import Thread, Lock
+from threading import Thread, Lock, RLock, Condition
 import time
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import base64
 import uuid
 import math
+import re
 import shutil
 import struct
-from collections import defaultdict
+import mmap
+import select
+from collections import defaultdict, OrderedDict
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    from socket import MSG_MORE
+except ImportError:
+    MSG_MORE = 0
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 MAX_PACKET_SIZE = 20480
+# File hashing: read size, and the file size from which mmap is used
+HASH_BUFFER_SIZE = 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+# Bounds of a block size requested in SAVE/GET. Set by --min-block-size/--max-block-size.
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+# Largest "size" of a SAVE; the bitmap of an upload takes one bit per block. Set by --max-file-size.
+MAX_FILE_SIZE = 1024 ** 4
+# Number of stored files whose MD5 is cached for FILE GET. Set by --meta-cache-size.
+FILE_META_CACHE_SIZE = 4096
+# Number of verified tokens cached for all connections. Set by --token-cache-size.
+TOKEN_CACHE_SIZE = 1024
+# Number of files a connection keeps open for DOWNLOAD. Set by --download-open-files.
+DOWNLOAD_OPEN_FILES = 16
+# Largest range (bytes) sent for one DOWNLOAD with "block_count"; fewer blocks are sent for a longer range
+# (at least one). Set by --max-download-range.
+MAX_DOWNLOAD_RANGE = 64 * 1024 * 1024
+# Largest run of blocks (bytes) one UPLOAD with "block_count" may carry; SAVE/STATUS tell the client how many
+# blocks that is ("max_block_count"). Set by --max-upload-batch.
+MAX_UPLOAD_BATCH = 16 * 1024 * 1024
+# Content-addressed store of stored files: a SAVE with the "md5" of content the user already stores is linked
+# to it and gets a plan of 0 blocks. Set by --dedup.
+DEDUP = False
+# Number of tmp files of uploads kept open for UPLOAD. Set by --upload-open-files.
+UPLOAD_OPEN_FILES = 256
+# Codec of the JSON section of packets: orjson, ujson, json, or auto (the fastest installed). Set by --json-codec.
+JSON_CODEC = 'auto'
+# Admission control of the thread engine. Set by --max-connections, --connection-queue and --backlog.
+MAX_CONNECTIONS = 256
+CONNECTION_QUEUE = 64
+LISTEN_BACKLOG = 128
+# Seconds a rejected client is told to wait
+RETRY_AFTER = 1
+# Seconds a connection may wait between packets, may be silent within a packet, and may take to send
+# the header (8 bytes + JSON) and the binary section of a packet. 0 disables one.
+# Set by --idle-timeout, --read-timeout, --header-deadline and --body-deadline.
+IDLE_TIMEOUT = 300
+READ_TIMEOUT = 30
+HEADER_DEADLINE = 30
+BODY_DEADLINE = 300
+READ_BUFFER_SIZE = 256 * 1024
+# Largest JSON section and binary section of a request packet. A larger length in a header closes the
+# connection before anything is allocated for it. The binary section is one block or an UPLOAD batch, so
+# MAX_BODY_SIZE is set from --max-block-size and --max-upload-batch.
+MAX_JSON_SIZE = 1024 * 1024
+MAX_BODY_SIZE = max(MAX_BLOCK_SIZE, MAX_UPLOAD_BATCH)
 
 OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN, OP_ERROR = 'SAVE', 'DELETE', 'GET', 'UPLOAD', 'DOWNLOAD', 'BYE', 'LOGIN', "ERROR"
+# Progress of an upload, to resume it
+OP_STATUS = 'STATUS'
 TYPE_FILE, TYPE_DATA, TYPE_AUTH, DIR_EARTH = 'FILE', 'DATA', 'AUTH', 'EARTH'
 FIELD_OPERATION, FIELD_DIRECTION, FIELD_TYPE, FIELD_USERNAME, FIELD_PASSWORD, FIELD_TOKEN = 'operation', 'direction', 'type', 'username', 'password', 'token'
 FIELD_KEY, FIELD_SIZE, FIELD_TOTAL_BLOCK, FIELD_MD5, FIELD_BLOCK_SIZE = 'key', 'size', 'total_block', 'md5', 'block_size'
 FIELD_STATUS, FIELD_STATUS_MSG, FIELD_BLOCK_INDEX = 'status', 'status_msg', 'block_index'
+FIELD_DIGEST, FIELD_DIGEST_ALGORITHM = 'digest', 'digest_algorithm'
+FIELD_RETRY_AFTER = 'retry_after'
+FIELD_RECEIVED, FIELD_MISSING = 'received', 'missing'
+FIELD_BLOCK_COUNT, FIELD_MAX_BLOCK_COUNT = 'block_count', 'max_block_count'
+FIELD_COMPACT, FIELD_SESSION_ID = 'compact', 'session_id'
+FIELD_DEDUPLICATED = 'deduplicated'
 DIR_REQUEST, DIR_RESPONSE = 'REQUEST', 'RESPONSE'
 
+# Compact framing of UPLOAD/DOWNLOAD blocks, negotiated by "compact" in FILE SAVE/GET. Its first byte is
+# COMPACT_MAGIC, which as the first byte of a JSON length would mean a JSON section of 3 GB or more, so both
+# framings share a connection. Head: magic, version, opcode, 0, status (of a response), block count (of a
+# DOWNLOAD range or an UPLOAD batch, 0 for one block), binary length, session id, block index.
+COMPACT_MAGIC, COMPACT_VERSION = 0xB5, 1
+COMPACT_HEAD = struct.Struct('!BBBBHHIII')
+COMPACT_UPLOAD, COMPACT_DOWNLOAD = 1, 2
+
 logger = logging.getLogger('')
 upload_locks = {} 
 upload_states = {}
 upload_meta_lock = Lock() 
+# Users whose data/file/tmp/state/meta/cas directories exist
+prepared_users = set()
+# Connections closed by the server because of a timeout or a deadline
+reaped_connections = 0
+reaped_lock = Lock()
+# SAVE requests answered from the content-addressed store, and the bytes they did not upload
+dedup_hits = 0
+dedup_bytes = 0
+dedup_lock = Lock()
 
 
 def _get_or_create_upload_lock(state_key):
@@ -55,7 +152,10 @@ def cleanup_upload_state(state_key):
     Thread-safe function to cleanup upload state and lock when upload is complete or failed.
     """
     with upload_meta_lock:
-        upload_states.pop(state_key, None)
+        state = upload_states.pop(state_key, None)
+        if state is not None:
+            # Connections that cached it resolve the key again
+            state.finished = True
         if state_key in upload_locks:
             lock = upload_locks[state_key]
             if lock.acquire(blocking=False):
@@ -63,20 +163,933 @@ def cleanup_upload_state(state_key):
                 upload_locks.pop(state_key, None)
 
 
+class UploadState:
+    """
+    Progress of one upload: a bitmap of the received blocks (one bit per block) and a counter.
+    It is checkpointed to a small sidecar file (see get_state_path) every CHECKPOINT_BLOCKS new blocks
+    or CHECKPOINT_SECONDS, so an upload can be continued after a server restart.
+    Parallel UPLOADs of one key only contend on one of STRIPES locks (by bitmap byte), each with its
+    own counter; only the completion of the upload is serialized, by the per-key lock.
+    """
+    CHECKPOINT_BLOCKS = 1024
+    CHECKPOINT_SECONDS = 5.0
+    STRIPES = 16
+    # magic, total block, block size, received blocks; followed by the bitmap
+    HEADER = struct.Struct('!4sQQQ')
+    MAGIC = b'STEP'
+
+    def __init__(self, path, total, block_size, bitmap=None, received=0, size=None):
+        self.path = path
+        self.total = total
+        self.block_size = block_size
+        # File size, None until known (not in the sidecar file)
+        self.size = size
+        self.bitmap = bytearray((total + 7) // 8) if bitmap is None else bitmap
+        self.locks = [Lock() for _ in range(self.STRIPES)]
+        self.counts = [0] * self.STRIPES
+        self.counts[0] = received
+        # MD5 of the blocks [0, hashed), see update_md5
+        self.md5 = hashlib.md5()
+        self.md5_lock = Lock()
+        self.hashed = 0
+        # Set when the upload is completed or deleted; the state is no longer used then
+        self.finished = False
+        # Writes of blocks in progress, see begin_write
+        self.writers = 0
+        self.writers_cond = Condition()
+        self.checkpoint_lock = Lock()
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    @property
+    def received(self):
+        return sum(self.counts)
+
+    def has(self, block_index):
+        return self.bitmap[block_index >> 3] & (1 << (block_index & 7)) != 0
+
+    def add(self, block_index):
+        """
+        Mark a block as received and checkpoint if it is time to.
+        :return: True if the block is new
+        """
+        stripe = (block_index >> 3) % self.STRIPES
+        with self.locks[stripe]:
+            if self.has(block_index):
+                return False
+            self.bitmap[block_index >> 3] |= 1 << (block_index & 7)
+            self.counts[stripe] += 1
+        # Not exact under contention, it only decides when to checkpoint
+        self.unsaved += 1
+        if self.unsaved >= self.CHECKPOINT_BLOCKS or time.monotonic() - self.saved_at >= self.CHECKPOINT_SECONDS:
+            self.checkpoint()
+        return True
+
+    def is_complete(self):
+        return self.received == self.total
+
+    def missing(self):
+        """
+        The blocks not received yet, run-length encoded (whole bytes of the bitmap are skipped at once).
+        :return: list of [first block index, number of blocks]
+        """
+        runs = []
+        first = None  # first block of the current run of missing blocks
+        for byte_index, byte in enumerate(bytes(self.bitmap)):
+            if byte == 0xFF:
+                if first is not None:
+                    runs.append([first, byte_index * 8 - first])
+                    first = None
+            elif byte == 0:
+                if first is None:
+                    first = byte_index * 8
+            else:
+                for bit in range(8):
+                    block_index = byte_index * 8 + bit
+                    if byte & (1 << bit):
+                        if first is not None:
+                            runs.append([first, block_index - first])
+                            first = None
+                    elif first is None:
+                        first = block_index
+        # The bits after the last block are 0
+        if first is not None and first < self.total:
+            runs.append([first, self.total - first])
+        return runs
+
+    def begin_write(self):
+        """
+        Register a write of blocks to the tmp file, which must end with end_write. Blocks do not overlap,
+        so writes do not exclude each other; they only hold off claim_finish.
+        :return: False if the upload is finished: the tmp file may be the stored file by now
+        """
+        with self.writers_cond:
+            if self.finished:
+                return False
+            self.writers += 1
+            return True
+
+    def end_write(self):
+        with self.writers_cond:
+            self.writers -= 1
+            if self.writers == 0:
+                self.writers_cond.notify_all()
+
+    def claim_finish(self):
+        """
+        Called under the per-key lock by a request that sees the upload complete. The winner waits for the
+        writes in progress (retransmitted blocks), so none of them lands after the MD5 is taken.
+        :return: True for exactly one caller, which then moves the tmp file
+        """
+        with self.writers_cond:
+            if self.finished:
+                return False
+            self.finished = True
+            while self.writers > 0:
+                self.writers_cond.wait()
+        return True
+
+    def update_md5(self, fd, block_index, bin_data):
+        """
+        Feed the MD5 with the contiguous prefix of received blocks, so that the digest is ready when the
+        last block arrives. The new block is hashed from memory if it extends the prefix; blocks received
+        earlier out of order (or before a restart) are read back from the tmp file when the prefix reaches them.
+        One thread hashes at a time. A thread that finds the MD5 busy returns at once: the hashing thread
+        checks the prefix again after releasing the lock, so the block is not missed.
+        :param fd: file descriptor of the tmp file
+        :param block_index: the block just received (already added)
+        :param bin_data: its data
+        :return: None
+        """
+        while self.hashed < self.total and self.has(self.hashed):
+            if not self.md5_lock.acquire(blocking=False):
+                return
+            try:
+                while self.hashed < self.total and self.has(self.hashed):
+                    if self.hashed == block_index:
+                        self.md5.update(bin_data)
+                    else:
+                        self.md5.update(os.pread(fd, self.block_size, self.hashed * self.block_size))
+                    self.hashed += 1
+            finally:
+                self.md5_lock.release()
+
+    def get_md5(self, fd):
+        """
+        MD5 of the completed upload. The part of the file not hashed yet (none, unless the state was
+        loaded from a checkpoint) is read back from the tmp file.
+        :param fd: file descriptor of the tmp file
+        """
+        with self.md5_lock:
+            while self.hashed < self.total:
+                self.md5.update(os.pread(fd, self.block_size, self.hashed * self.block_size))
+                self.hashed += 1
+            return self.md5.hexdigest()
+
+    def checkpoint(self):
+        """
+        Write the sidecar file (atomically, through a temporary file).
+        Skipped if another thread is writing it.
+        """
+        if not self.checkpoint_lock.acquire(blocking=False):
+            return
+        try:
+            if self.finished:
+                return
+            bitmap = bytes(self.bitmap)
+            received = bin(int.from_bytes(bitmap, 'big')).count('1')
+            with open(self.path + '.part', 'wb') as fid:
+                fid.write(self.HEADER.pack(self.MAGIC, self.total, self.block_size, received))
+                fid.write(bitmap)
+            os.replace(self.path + '.part', self.path)
+            self.unsaved = 0
+            self.saved_at = time.monotonic()
+        finally:
+            self.checkpoint_lock.release()
+
+    def remove(self):
+        """
+        Delete the sidecar file when the upload is completed or deleted (after setting finished).
+        """
+        with self.checkpoint_lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a sidecar file written by checkpoint().
+        :return: UploadState, or None if there is no valid sidecar file
+        """
+        try:
+            with open(path, 'rb') as fid:
+                raw = fid.read()
+        except OSError:
+            return None
+        if len(raw) < cls.HEADER.size:
+            return None
+        magic, total, block_size, received = cls.HEADER.unpack_from(raw)
+        bitmap = bytearray(raw[cls.HEADER.size:])
+        if magic != cls.MAGIC or len(bitmap) != (total + 7) // 8:
+            return None
+        return cls(path, total, block_size, bitmap, received)
+
+    @classmethod
+    def remove_file(cls, path):
+        """
+        Delete the sidecar file of a deleted upload.
+        """
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class SharedUploadState(UploadState):
+    """
+    UploadState of the --workers mode: the sidecar file itself, mapped with mmap, is the state, so that
+    all worker processes see the same bitmap whichever of them receives a block. A block is recorded under
+    a lock of the process and an fcntl lock of the "received" field of the header; the header magic is
+    set to DONE when the upload is finished, which the other workers see through their mapping.
+    Workers cannot share an MD5 object, so it is computed from the file on completion (get_md5).
+    """
+    DONE = b'DONE'
+    # Offset of "received" in HEADER (after magic, total block, block size)
+    RECEIVED_OFFSET = 20
+    # fcntl locks belong to the process and closing any descriptor of the file drops them, so no sidecar
+    # file is closed while a thread of this process holds one
+    fcntl_lock = RLock()
+
+    def __init__(self, path, total, block_size, bitmap=None, received=0, size=None, fid=None):
+        """
+        :param fid: the sidecar file opened 'r+b' (by load); None to create the sidecar file
+        """
+        if fid is None:
+            # Mark the state this one replaces as finished for the workers that have it mapped
+            replaced = type(self).load(path)
+            if replaced is not None:
+                try:
+                    replaced.finished = True
+                finally:
+                    replaced.close()
+            with open(path + '.part', 'wb') as part:
+                part.write(self.HEADER.pack(self.MAGIC, total, block_size, received))
+                part.write(bytearray((total + 7) // 8) if bitmap is None else bitmap)
+            fid = open(path + '.part', 'r+b', buffering=0)
+            os.replace(path + '.part', path)
+        self.path = path
+        self.total = total
+        self.block_size = block_size
+        self.size = size
+        self.fid = fid
+        self.mm = mmap.mmap(fid.fileno(), 0)
+        self.bitmap = memoryview(self.mm)[self.HEADER.size:]
+        self.lock = Lock()
+        self.md5 = hashlib.md5()
+        self.md5_lock = Lock()
+        self.hashed = 0
+        self.writers = 0
+        self.writers_cond = Condition()
+        self.checkpoint_lock = Lock()
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    @property
+    def received(self):
+        return struct.unpack_from('!Q', self.mm, self.RECEIVED_OFFSET)[0]
+
+    @property
+    def finished(self):
+        return self.mm[:4] == self.DONE
+
+    @finished.setter
+    def finished(self, value):
+        self.mm[:4] = self.DONE if value else self.MAGIC
+
+    def add(self, block_index):
+        """
+        Mark a block as received, in the shared sidecar file.
+        :return: True if the block is new
+        """
+        with self.lock, self.fcntl_lock:
+            fcntl.lockf(self.fid, fcntl.LOCK_EX, 8, self.RECEIVED_OFFSET)
+            try:
+                if self.has(block_index):
+                    return False
+                self.bitmap[block_index >> 3] |= 1 << (block_index & 7)
+                struct.pack_into('!Q', self.mm, self.RECEIVED_OFFSET, self.received + 1)
+            finally:
+                fcntl.lockf(self.fid, fcntl.LOCK_UN, 8, self.RECEIVED_OFFSET)
+        self.unsaved += 1
+        if self.unsaved >= self.CHECKPOINT_BLOCKS or time.monotonic() - self.saved_at >= self.CHECKPOINT_SECONDS:
+            self.checkpoint()
+        return True
+
+    def claim_finish(self):
+        with self.fcntl_lock:
+            fcntl.lockf(self.fid, fcntl.LOCK_EX, 4, 0)
+            try:
+                return super().claim_finish()
+            finally:
+                fcntl.lockf(self.fid, fcntl.LOCK_UN, 4, 0)
+
+    def update_md5(self, fd, block_index, bin_data):
+        pass
+
+    def checkpoint(self):
+        """
+        The mapping is the state; only flush it to the disk.
+        """
+        if not self.finished:
+            self.mm.flush()
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Map a sidecar file written by checkpoint() or by another worker.
+        :return: SharedUploadState (possibly finished), or None if there is no valid sidecar file
+        """
+        try:
+            fid = open(path, 'r+b', buffering=0)
+        except OSError:
+            return None
+        raw = fid.read(cls.HEADER.size)
+        if len(raw) < cls.HEADER.size:
+            with cls.fcntl_lock:
+                fid.close()
+            return None
+        magic, total, block_size, received = cls.HEADER.unpack(raw)
+        if magic not in (cls.MAGIC, cls.DONE) or \
+                os.fstat(fid.fileno()).st_size != cls.HEADER.size + (total + 7) // 8:
+            with cls.fcntl_lock:
+                fid.close()
+            return None
+        return cls(path, total, block_size, received=received, fid=fid)
+
+    def close(self):
+        """
+        Unmap and close the sidecar file. A state loaded only for a moment must be closed this way rather
+        than left to the garbage collector, which could close it while another thread holds an fcntl lock.
+        """
+        self.bitmap.release()
+        self.mm.close()
+        with self.fcntl_lock:
+            self.fid.close()
+
+    def __del__(self):
+        # Also a state dropped from upload_states or from a ConnectionCache
+        if 'bitmap' in self.__dict__:
+            self.close()
+
+    @classmethod
+    def remove_file(cls, path):
+        state = cls.load(path)
+        if state is not None:
+            try:
+                state.finished = True
+            finally:
+                state.close()
+        super().remove_file(path)
+
+
+# UploadState, or SharedUploadState with --workers
+upload_state_type = UploadState
+
+
+def get_state_path(username, key):
+    """
+    Sidecar file of the upload of key: state/<username>/<key>.state, so that tmp/ holds only the data of keys.
+    Sidecars end with ".state" and their temporary files with ".state.part", so neither is another one.
+    """
+    return join('state', username, key) + '.state'
+
+
+def get_upload_state(username, key):
+    """
+    The UploadState of the upload of key, loaded from its sidecar file if this process does not have it
+    (server restarted during the upload, or another worker has the state).
+    :param username:
+    :param key:
+    :return: UploadState with its size set; it may be finished
+    :raise FileNotFoundError: if the tmp file does not exist
+    """
+    state_key = (username, key)
+    file_path = join('tmp', username, key)
+    file_size = getsize(file_path)
+    with upload_meta_lock:
+        state = upload_states.get(state_key)
+        if state is None or state.finished:
+            state = upload_state_type.load(get_state_path(username, key))
+            if state is None:
+                # The block size is chosen by SAVE; without any state it is the default
+                state = upload_state_type(get_state_path(username, key), math.ceil(file_size / MAX_PACKET_SIZE),
+                                          MAX_PACKET_SIZE)
+            upload_states[state_key] = state
+    state.size = file_size
+    return state
+
+
+class UploadFilePool:
+    """
+    Open file descriptors of the tmp files of uploads in progress, so that an UPLOAD block costs one pwrite
+    instead of open/seek/write/close. An LRU of at most `capacity` descriptors (more only while all of them
+    are in use); a descriptor is closed only when no request is writing through it.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # file path -> [fd, number of requests using it, discarded]
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, file_path):
+        """
+        :param file_path: the tmp file
+        :return: the pool entry, entry[0] is the fd. Hand it back with release().
+        :raise FileNotFoundError: if the tmp file does not exist
+        """
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is not None:
+                entry[1] += 1
+                self.entries.move_to_end(file_path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        fd = os.open(file_path, os.O_RDWR)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is None:
+                entry = [fd, 0, False]
+                self.entries[file_path] = entry
+            else:
+                # Opened by another request in the meantime
+                os.close(fd)
+            entry[1] += 1
+            self._evict()
+            return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry[1] -= 1
+            if entry[2]:
+                self._close(entry)
+            else:
+                self._evict()
+
+    def discard(self, file_path):
+        """
+        Drop the fd of a tmp file that is completed or deleted. It is closed once nobody uses it.
+        """
+        with self.lock:
+            entry = self.entries.pop(file_path, None)
+            if entry is not None:
+                entry[2] = True
+                self._close(entry)
+
+    def _close(self, entry):
+        if entry[1] == 0:
+            os.close(entry[0])
+
+    def _evict(self):
+        if len(self.entries) <= self.capacity:
+            return
+        for file_path, entry in list(self.entries.items()):
+            if len(self.entries) <= self.capacity:
+                break
+            if entry[1] == 0:
+                del self.entries[file_path]
+                entry[2] = True
+                self._close(entry)
+                self.evictions += 1
+
+
+upload_file_pool = UploadFilePool(UPLOAD_OPEN_FILES)
+
+
+def get_plan_block_size(json_data):
+    """
+    Block size for an upload/download plan. MAX_PACKET_SIZE if the request does not ask for one,
+    otherwise the requested "block_size" limited to [MIN_BLOCK_SIZE, MAX_BLOCK_SIZE].
+    :param json_data:
+    :return: the block size, or None if the requested "block_size" is not a positive integer
+    """
+    if FIELD_BLOCK_SIZE not in json_data.keys():
+        return MAX_PACKET_SIZE
+    requested = json_data[FIELD_BLOCK_SIZE]
+    if type(requested) is not int or requested <= 0:
+        return None
+    return min(max(requested, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def new_digest(algorithm='md5'):
+    """
+    Create a hash object: md5, sha1, sha256, blake2b, or xxh64/xxh3_64/xxh3_128 if xxhash is installed.
+    :param algorithm:
+    :return: the hash object, or None if the algorithm is not available
+    """
+    if algorithm in ('md5', 'sha1', 'sha256', 'blake2b'):
+        return hashlib.new(algorithm)
+    if xxhash is not None and algorithm in ('xxh64', 'xxh3_64', 'xxh3_128'):
+        return getattr(xxhash, algorithm)()
+    return None
+
+
+def get_file_digest(filename, algorithm='md5', buffer_size=None, mmap_threshold=None):
+    """
+    Get the digest of a big file.
+    :param filename:
+    :param algorithm: see new_digest
+    :param buffer_size: see get_file_digests
+    :param mmap_threshold: see get_file_digests
+    :return: hex digest
+    """
+    return get_file_digests(filename, (algorithm,), buffer_size, mmap_threshold)[algorithm]
+
+
+def get_file_digests(filename, algorithms, buffer_size=None, mmap_threshold=None):
+    """
+    Get several digests of a big file in a single pass over it.
+    Reads HASH_BUFFER_SIZE at a time with readinto into one reused buffer; files of HASH_MMAP_THRESHOLD
+    or more are hashed through mmap instead (no read copies at all).
+    :param filename:
+    :param algorithms: names accepted by new_digest
+    :param buffer_size: default HASH_BUFFER_SIZE
+    :param mmap_threshold: default HASH_MMAP_THRESHOLD, 0 to never use mmap
+    :return: {algorithm: hex digest}
+    """
+    buffer_size = HASH_BUFFER_SIZE if buffer_size is None else buffer_size
+    mmap_threshold = HASH_MMAP_THRESHOLD if mmap_threshold is None else mmap_threshold
+    digests = {algorithm: new_digest(algorithm) for algorithm in algorithms}
+    with open(filename, 'rb', buffering=0) as fid:
+        size = os.fstat(fid.fileno()).st_size
+        if 0 < mmap_threshold <= size:
+            with mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                for offset in range(0, size, buffer_size):
+                    for m in digests.values():
+                        m.update(view[offset:offset + buffer_size])
+                view.release()
+        else:
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                n = fid.readinto(buffer)
+                if not n:
+                    break
+                for m in digests.values():
+                    m.update(view[:n])
+    return {algorithm: m.hexdigest() for algorithm, m in digests.items()}
+
+
 def get_file_md5(filename):
     """
     Get MD5 value for big file
     :param filename:
     :return:
     """
-    m = hashlib.md5()
-    with open(filename, 'rb') as fid:
-        while True:
-            d = fid.read(2048)
-            if not d:
-                break
-            m.update(d)
-    return m.hexdigest()
+    return get_file_digest(filename, 'md5')
+
+
+class FileMetaCache:
+    """
+    LRU cache of (size, mtime, inode, {algorithm: digest}) of stored files keyed by (username, key),
+    so that repeated FILE GET requests need only a stat. An entry is used only if the stat still matches.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username, key, st, algorithm='md5'):
+        """
+        :param st: os.stat of the stored file
+        :param algorithm:
+        :return: the digest, or None if not cached or the file has changed
+        """
+        with self.lock:
+            entry = self.entries.get((username, key))
+            if entry is not None and entry[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+                self.entries.move_to_end((username, key))
+                if algorithm in entry[3]:
+                    self.hits += 1
+                    return entry[3][algorithm]
+            elif entry is not None:
+                del self.entries[(username, key)]
+            self.misses += 1
+            return None
+
+    def put(self, username, key, st, digest, algorithm='md5'):
+        with self.lock:
+            entry = self.entries.get((username, key))
+            if entry is None or entry[:3] != (st.st_size, st.st_mtime_ns, st.st_ino):
+                entry = (st.st_size, st.st_mtime_ns, st.st_ino, {})
+                self.entries[(username, key)] = entry
+            entry[3][algorithm] = digest
+            self.entries.move_to_end((username, key))
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username, key):
+        with self.lock:
+            self.entries.pop((username, key), None)
+
+
+file_meta_cache = FileMetaCache(FILE_META_CACHE_SIZE)
+
+
+def save_file_md5(username, key, md5, digests=None):
+    """
+    Save the MD5 of a stored file to meta/<username>/<key>, together with the size, mtime and inode
+    of the file, so that GET does not have to read the whole file again.
+    :param username:
+    :param key:
+    :param md5:
+    :param digests: {algorithm: digest} of other algorithms to save with it
+    :return: None
+    """
+    st = os.stat(join('file', username, key))
+    meta = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'ino': st.st_ino, 'md5': md5}
+    if digests:
+        meta['digests'] = digests
+    with open(join('meta', username, key), 'w') as fid:
+        json.dump(meta, fid)
+    file_meta_cache.put(username, key, st, md5)
+    for algorithm, digest in (digests or {}).items():
+        file_meta_cache.put(username, key, st, digest, algorithm)
+
+
+def get_stored_file_digests(username, key, algorithms=('md5',)):
+    """
+    Digests of a stored file: the cached or saved ones if the file has not changed since (same size, mtime
+    and inode). Missing ones, and the MD5 if it is missing too, are computed in one pass over the file
+    and saved again.
+    :param username:
+    :param key:
+    :param algorithms: names accepted by new_digest
+    :return: {algorithm: hex digest}, always with 'md5'
+    """
+    file_path = join('file', username, key)
+    st = os.stat(file_path)
+    wanted = set(algorithms) | {'md5'}
+    found = {}
+    for algorithm in wanted:
+        digest = file_meta_cache.get(username, key, st, algorithm)
+        if digest is not None:
+            found[algorithm] = digest
+    if len(found) == len(wanted):
+        return found
+    saved = {}
+    try:
+        with open(join('meta', username, key), 'r') as fid:
+            meta = json.load(fid)
+        if (meta['size'], meta['mtime_ns'], meta['ino']) == (st.st_size, st.st_mtime_ns, st.st_ino):
+            saved = dict(meta.get('digests', {}), md5=meta['md5'])
+            for algorithm in wanted - found.keys():
+                if algorithm in saved:
+                    found[algorithm] = saved[algorithm]
+                    file_meta_cache.put(username, key, st, saved[algorithm], algorithm)
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    if len(found) == len(wanted):
+        return found
+    found.update(get_file_digests(file_path, wanted - found.keys()))
+    saved.update(found)
+    md5 = saved.pop('md5')
+    save_file_md5(username, key, md5, saved)
+    return found
+
+
+def get_stored_file_md5(username, key):
+    """
+    MD5 of a stored file, see get_stored_file_digests.
+    :param username:
+    :param key:
+    :return: md5
+    """
+    return get_stored_file_digests(username, key)['md5']
+
+
+def remove_file_md5(username, key):
+    """
+    Remove the saved MD5 of a deleted file.
+    """
+    file_meta_cache.invalidate(username, key)
+    try:
+        os.remove(join('meta', username, key))
+    except FileNotFoundError:
+        pass
+
+
+# The content-addressed store of a user is cas/<username>/<md5>, each blob a hard link of the stored files with
+# that content, so the link count of a blob is its reference count and needs no bookkeeping of its own.
+# Blobs are not shared between users: the "md5" of a SAVE does not prove that the client has the content.
+# An "md5" is a path component, so only 32 lowercase hex digits are accepted.
+MD5_PATTERN = re.compile('[0-9a-f]{32}')
+
+
+def store_blob(username, key, md5):
+    """
+    Add a completed upload to the content-addressed store. If the user already stores the content,
+    the new file is replaced by a link of the blob.
+    :param username:
+    :param key:
+    :param md5:
+    :return: the bytes saved
+    """
+    file_path = join('file', username, key)
+    blob_path = join('cas', username, md5)
+    try:
+        os.link(file_path, blob_path)
+        return 0
+    except FileExistsError:
+        pass
+    except OSError as ex:
+        # No hard links on this file system (EPERM, EXDEV...): the file keeps its own copy
+        logger.warning(f'The content of "key" {key} is not stored: {ex}')
+        return 0
+    try:
+        st = os.stat(file_path)
+        blob_st = os.stat(blob_path)
+        if blob_st.st_ino == st.st_ino or blob_st.st_size != st.st_size:
+            return 0
+        # A name in cas/ that is neither a key nor a blob (blobs are hex MD5s)
+        link_path = join('cas', username, f'.{md5}.{uuid.uuid4().hex}')
+        os.link(blob_path, link_path)
+        try:
+            os.replace(link_path, file_path)
+        except OSError:
+            os.remove(link_path)
+            raise
+    except FileNotFoundError:
+        # The blob was released meanwhile; the file keeps its own copy
+        return 0
+    except OSError as ex:
+        logger.warning(f'The "key" {key} is not linked to stored content: {ex}')
+        return 0
+    return st.st_size
+
+
+def link_blob(username, key, md5, size):
+    """
+    Store key as a link of the blob of md5, if the user stores that content with the same size.
+    :param username:
+    :param key:
+    :param md5:
+    :param size:
+    :return: True if key is stored
+    """
+    if not isinstance(md5, str) or MD5_PATTERN.fullmatch(md5) is None:
+        return False
+    blob_path = join('cas', username, md5)
+    try:
+        if os.stat(blob_path).st_size != size:
+            return False
+        os.link(blob_path, join('file', username, key))
+    except OSError:
+        # Not stored, key created meanwhile, or no hard links on this file system
+        return False
+    return True
+
+
+def release_blob(username, md5):
+    """
+    Remove the blob of md5 once no stored file links it (a link count of 1 is the blob alone).
+    A SAVE linking it at the same time either fails to find it or keeps its content in its own link.
+    """
+    blob_path = join('cas', username, md5)
+    try:
+        if os.stat(blob_path).st_nlink == 1:
+            os.remove(blob_path)
+    except FileNotFoundError:
+        pass
+
+
+class OpenFileCache:
+    """
+    Files kept open by one connection for DOWNLOAD, so that a block costs a stat instead of open/close.
+    An LRU of at most `capacity` files; a file replaced or changed since it was opened (other inode or
+    mtime) is reopened. Only used by the thread serving the connection.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = DOWNLOAD_OPEN_FILES if capacity is None else capacity
+        self.files = OrderedDict()
+
+    def get(self, file_path):
+        """
+        :param file_path:
+        :return: (file object opened 'rb' without buffering, file size)
+        """
+        st = os.stat(file_path)
+        entry = self.files.get(file_path)
+        if entry is not None:
+            if (entry[1].st_ino, entry[1].st_mtime_ns) == (st.st_ino, st.st_mtime_ns):
+                self.files.move_to_end(file_path)
+                return entry[0], st.st_size
+            self.discard(file_path)
+        fid = open(file_path, 'rb', buffering=0)
+        st = os.fstat(fid.fileno())
+        self.files[file_path] = (fid, st)
+        while len(self.files) > self.capacity:
+            self.files.popitem(last=False)[1][0].close()
+        return fid, st.st_size
+
+    def discard(self, file_path):
+        entry = self.files.pop(file_path, None)
+        if entry is not None:
+            entry[0].close()
+
+    def close(self):
+        for fid, _ in self.files.values():
+            fid.close()
+        self.files.clear()
+
+
+class ConnectionCache:
+    """
+    What one connection keeps between its requests: the files open for DOWNLOAD and the UploadStates
+    of the keys it uploads to, so that an UPLOAD block does not look them up under upload_meta_lock.
+    """
+    MAX_UPLOADS = 64
+    MAX_TOKENS = 16
+    MAX_SESSIONS = 64
+
+    def __init__(self):
+        self.open_files = OpenFileCache()
+        # (username, key) -> UploadState
+        self.uploads = {}
+        # token -> username, verified on this connection
+        self.tokens = {}
+        # session id of the compact framing -> (username, key, block size)
+        self.sessions = {}
+        self.next_session_id = 1
+
+    def get_upload(self, state_key):
+        """
+        :return: the cached UploadState, or None if not cached or the upload is completed/deleted
+        """
+        state = self.uploads.get(state_key)
+        if state is not None and state.finished:
+            del self.uploads[state_key]
+            return None
+        return state
+
+    def put_upload(self, state_key, state):
+        if len(self.uploads) >= self.MAX_UPLOADS:
+            self.uploads = {k: v for k, v in self.uploads.items() if not v.finished}
+            if len(self.uploads) >= self.MAX_UPLOADS:
+                self.uploads.clear()
+        self.uploads[state_key] = state
+
+    def put_token(self, token, username):
+        if len(self.tokens) >= self.MAX_TOKENS:
+            self.tokens.clear()
+        self.tokens[token] = username
+
+    def open_session(self, username, key, block_size):
+        """
+        :return: the id of a new session of the compact framing
+        """
+        if len(self.sessions) >= self.MAX_SESSIONS:
+            del self.sessions[next(iter(self.sessions))]
+        session_id = self.next_session_id
+        self.next_session_id += 1
+        self.sessions[session_id] = (username, key, block_size)
+        return session_id
+
+    def close(self):
+        self.open_files.close()
+        self.uploads.clear()
+        self.tokens.clear()
+        self.sessions.clear()
+
+
+class TokenCache:
+    """
+    LRU cache of verified tokens (token -> username) shared by all connections,
+    so that a client reconnecting with its token does not verify it again.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        """
+        :return: the username of a verified token, or None
+        """
+        with self.lock:
+            username = self.entries.get(token)
+            if username is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return username
+
+    def put(self, token, username):
+        with self.lock:
+            self.entries[token] = username
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
 
 
 def get_time_based_filename(ext, prefix='', t=None):
@@ -134,473 +1147,1519 @@ def _argparse():
                        help="The IP address bind to the server. Default bind all IP.")
     parse.add_argument("--port", default='1379', action='store', required=False, dest="port",
                        help="The port that server listen on. Default is 1379.")
-    return parse.parse_args()
+    parse.add_argument("--min-block-size", default=MIN_BLOCK_SIZE, type=int, required=False, dest="min_block_size",
+                       help=f"Smallest block size granted to a SAVE/GET asking for one. Default is {MIN_BLOCK_SIZE}.")
+    parse.add_argument("--max-block-size", default=MAX_BLOCK_SIZE, type=int, required=False, dest="max_block_size",
+                       help=f"Largest block size granted to a SAVE/GET asking for one. Default is {MAX_BLOCK_SIZE}.")
+    parse.add_argument("--meta-cache-size", default=FILE_META_CACHE_SIZE, type=int, required=False,
+                       dest="meta_cache_size",
+                       help=f"Number of stored files whose MD5 is cached for FILE GET. Default is {FILE_META_CACHE_SIZE}.")
+    parse.add_argument("--token-cache-size", default=TOKEN_CACHE_SIZE, type=int, required=False,
+                       dest="token_cache_size",
+                       help=f"Number of verified tokens cached for all connections. Default is {TOKEN_CACHE_SIZE}.")
+    parse.add_argument("--download-open-files", default=DOWNLOAD_OPEN_FILES, type=int, required=False,
+                       dest="download_open_files",
+                       help=f"Number of files a connection keeps open for DOWNLOAD. Default is {DOWNLOAD_OPEN_FILES}.")
+    parse.add_argument("--max-download-range", default=MAX_DOWNLOAD_RANGE, type=int, required=False,
+                       dest="max_download_range",
+                       help=f"Largest range in bytes sent for one DOWNLOAD with \"block_count\". "
+                            f"Default is {MAX_DOWNLOAD_RANGE}.")
+    parse.add_argument("--max-upload-batch", default=MAX_UPLOAD_BATCH, type=int, required=False,
+                       dest="max_upload_batch",
+                       help=f"Largest run of blocks in bytes one UPLOAD with \"block_count\" may carry. "
+                            f"Default is {MAX_UPLOAD_BATCH}.")
+    parse.add_argument("--max-file-size", default=MAX_FILE_SIZE, type=int, required=False, dest="max_file_size",
+                       help=f"Largest file size in bytes a SAVE may ask for. Default is {MAX_FILE_SIZE}.")
+    parse.add_argument("--dedup", action='store_true', required=False, dest="dedup",
+                       help="Keep completed uploads in a content-addressed store per user: a SAVE with the \"md5\" "
+                            "of stored content is linked to it and uploads no block. Default is off.")
+    parse.add_argument("--upload-open-files", default=UPLOAD_OPEN_FILES, type=int, required=False,
+                       dest="upload_open_files",
+                       help=f"Number of tmp files of uploads kept open for UPLOAD. Default is {UPLOAD_OPEN_FILES}.")
+    parse.add_argument("--max-connections", default=MAX_CONNECTIONS, type=int, required=False,
+                       dest="max_connections",
+                       help=f"Thread engine: connections served at a time (threads of the pool). "
+                            f"Default is {MAX_CONNECTIONS}.")
+    parse.add_argument("--connection-queue", default=CONNECTION_QUEUE, type=int, required=False,
+                       dest="connection_queue",
+                       help=f"Thread engine: accepted connections waiting for a thread; more are rejected with "
+                            f"a retry hint. Default is {CONNECTION_QUEUE}.")
+    parse.add_argument("--backlog", default=LISTEN_BACKLOG, type=int, required=False, dest="backlog",
+                       help=f"Backlog of the listening socket. Default is {LISTEN_BACKLOG}.")
+    parse.add_argument("--idle-timeout", default=IDLE_TIMEOUT, type=float, required=False, dest="idle_timeout",
+                       help=f"Seconds a connection may wait between packets, 0 for no limit. "
+                            f"Default is {IDLE_TIMEOUT}.")
+    parse.add_argument("--read-timeout", default=READ_TIMEOUT, type=float, required=False, dest="read_timeout",
+                       help=f"Thread engine: seconds a connection may be silent within a packet, 0 for no limit. "
+                            f"Default is {READ_TIMEOUT}.")
+    parse.add_argument("--header-deadline", default=HEADER_DEADLINE, type=float, required=False,
+                       dest="header_deadline",
+                       help=f"Seconds to receive the header (length fields and JSON) of a packet once it starts, "
+                            f"0 for no limit. Default is {HEADER_DEADLINE}.")
+    parse.add_argument("--body-deadline", default=BODY_DEADLINE, type=float, required=False, dest="body_deadline",
+                       help=f"Seconds to receive the binary section of a packet, 0 for no limit. "
+                            f"Default is {BODY_DEADLINE}.")
+    parse.add_argument("--json-codec", default=JSON_CODEC, choices=['auto', 'orjson', 'ujson', 'json'],
+                       required=False, dest="json_codec",
+                       help=f"Codec of the JSON section of packets; auto takes orjson or ujson if installed. "
+                            f"Default is {JSON_CODEC}.")
+    parse.add_argument("--engine", default='thread', choices=['thread', 'asyncio'], required=False, dest="engine",
+                       help="thread: one thread per connection. asyncio: a single event loop serves all "
+                            "connections and the request processing runs in an executor. Default is thread.")
+    parse.add_argument("--workers", default=1, type=int, required=False, dest="workers",
+                       help="Number of server processes sharing the listening socket, each running the engine. "
+                            "Default is 1 (no extra process).")
+    parse.add_argument("--async-workers", default=None, type=int, required=False, dest="async_workers",
+                       help="Size of the executor used by the asyncio engine for disk I/O. "
+                            "Default is the asyncio default.")
+    args = parse.parse_args()
+    if args.workers <= 0:
+        parse.error("--workers has to be positive.")
+    if args.json_codec != 'auto' and args.json_codec not in JSON_CODECS:
+        parse.error(f"--json-codec {args.json_codec} needs the {args.json_codec} package.")
+    if args.max_connections <= 0 or args.connection_queue < 0 or args.backlog <= 0:
+        parse.error("--max-connections and --backlog have to be positive, --connection-queue not negative.")
+    if min(args.idle_timeout, args.read_timeout, args.header_deadline, args.body_deadline) < 0:
+        parse.error("Timeouts and deadlines can not be negative.")
+    if args.workers > 1 and (not hasattr(os, 'fork') or fcntl is None):
+        parse.error("--workers needs os.fork and fcntl (not available on this platform).")
+    if args.download_open_files <= 0:
+        parse.error("--download-open-files has to be positive.")
+    if args.max_download_range <= 0:
+        parse.error("--max-download-range has to be positive.")
+    if args.max_upload_batch <= 0:
+        parse.error("--max-upload-batch has to be positive.")
+    if args.upload_open_files <= 0:
+        parse.error("--upload-open-files has to be positive.")
+    if args.min_block_size <= 0 or args.min_block_size > args.max_block_size:
+        parse.error("--min-block-size has to be positive and not larger than --max-block-size.")
+    return args
+
+
+# json.dumps with any option builds a new JSONEncoder on every call; json.loads adds type and BOM checks
+_json_encoder = json.JSONEncoder(ensure_ascii=False)
+_json_decoder = json.JSONDecoder()
+
+
+def _json_dumps_stdlib(obj):
+    return _json_encoder.encode(obj).encode()
+
+
+def _json_loads_stdlib(data):
+    return _json_decoder.decode(str(data, 'utf-8'))
+
+
+def _json_dumps_orjson(obj):
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        # Integers beyond 64 bits or non-str keys, which the json module accepts
+        return _json_dumps_stdlib(obj)
+
+
+# orjson decodes integers beyond 64 bits as floats; they have at least 19 digits
+_LONG_DIGITS = re.compile(rb'[0-9]{19}')
+
+
+def _json_loads_orjson(data):
+    if _LONG_DIGITS.search(data):
+        return _json_loads_stdlib(data)
+    return orjson.loads(data)
+
+
+def _json_dumps_ujson(obj):
+    return ujson.dumps(obj, ensure_ascii=False).encode()
+
+
+def _json_loads_ujson(data):
+    return ujson.loads(str(data, 'utf-8'))
+
+
+# name -> (dumps to UTF-8 bytes, loads from a bytes-like object)
+JSON_CODECS = {'json': (_json_dumps_stdlib, _json_loads_stdlib)}
+if ujson is not None:
+    JSON_CODECS['ujson'] = (_json_dumps_ujson, _json_loads_ujson)
+if orjson is not None:
+    JSON_CODECS['orjson'] = (_json_dumps_orjson, _json_loads_orjson)
+json_dumps, json_loads = JSON_CODECS['json']
+
+
+def set_json_codec(name='auto'):
+    """
+    Choose the codec of the JSON section of packets
+    :param name: a key of JSON_CODECS, or auto for the fastest installed one
+    :return: the name of the codec in use
+    """
+    global json_dumps, json_loads
+    if name == 'auto':
+        name = next(codec for codec in ['orjson', 'ujson', 'json'] if codec in JSON_CODECS)
+    json_dumps, json_loads = JSON_CODECS[name]
+    return name
+
+
+set_json_codec(JSON_CODEC)
+
+
+def make_packet_head(json_data, bin_len):
+    """
+    The part of a STEP packet before the binary data: the two lengths and the json section.
+    :param json_data: dict, or its encoding (bytes)
+    :param bin_len: length of the binary data that follows
+    :return:
+    """
+    j = json_data if isinstance(json_data, bytes) else json_dumps(json_data)
+    return struct.pack('!II', len(j), bin_len) + j
+
+
+def make_packet_buffers(json_data, bin_data=None):
+    """
+    Make a packet following the STEP protocol as a list of buffers: the two lengths, the json section
+    and a memoryview of the binary data. Send it with send_buffers, the data is never copied.
+    The length of the json section is the length of its UTF-8 bytes.
+    :param json_data: dict, or its encoding (bytes)
+    :param bin_data:
+    :return:
+        [header, json bytes] or [header, json bytes, memoryview of bin_data]
+    """
+    j = json_data if isinstance(json_data, bytes) else json_dumps(json_data)
+    if bin_data is None:
+        return [struct.pack('!II', len(j), 0), j]
+    else:
+        return [struct.pack('!II', len(j), len(bin_data)), j, memoryview(bin_data)]
 
 
 def make_packet(json_data, bin_data=None):
     """
     Make a packet following the STEP protocol.
-    Any information or data for TCP transmission has to use this function to get the packet.
+    Any information or data for TCP transmission has to use this function or make_packet_buffers.
     :param json_data:
     :param bin_data:
     :return:
         The complete binary packet
     """
-    j = json.dumps(dict(json_data), ensure_ascii=False)
-    j_len = len(j)
-    if bin_data is None:
-        return struct.pack('!II', j_len, 0) + j.encode()
-    else:
-        return struct.pack('!II', j_len, len(bin_data)) + j.encode() + bin_data
+    return b''.join(make_packet_buffers(json_data, bin_data))
 
 
-def make_response_packet(operation, status_code, data_type, status_msg, json_data, bin_data=None):
+def make_response_json(operation, status_code, data_type, status_msg, json_data):
     """
-    Make a packet for response
+    Add the response fields to json_data
     :param operation: [SAVE, DELETE, GET, UPLOAD, DOWNLOAD, BYE, LOGIN]
     :param status_code: 200 or 400+
     :param data_type: [FILE, DATA, AUTH]
     :param status_msg: A human-readable status massage
     :param json_data
-    :param bin_data
-    :return:
+    :return: json_data
     """
     json_data[FIELD_OPERATION] = operation
     json_data[FIELD_DIRECTION] = DIR_RESPONSE
     json_data[FIELD_STATUS] = status_code
     json_data[FIELD_STATUS_MSG] = status_msg
     json_data[FIELD_TYPE] = data_type
-    return make_packet(json_data, bin_data)
+    return json_data
+
+
+# Response fields that make_response_json sets
+RESPONSE_FIELDS = (FIELD_OPERATION, FIELD_DIRECTION, FIELD_STATUS, FIELD_STATUS_MSG, FIELD_TYPE)
+# (operation, status_code, data_type) -> the encoded constant response fields, without the opening brace
+response_fragments = {}
+
+
+def encode_response_json(operation, status_code, data_type, status_msg, json_data):
+    """
+    Encode json_data with the response fields, same as json_dumps(make_response_json(...)) up to the order of
+    the fields. The constant fields are serialized once and appended as bytes, only json_data and status_msg
+    go through the codec.
+    :param operation: [SAVE, DELETE, GET, UPLOAD, DOWNLOAD, BYE, LOGIN]
+    :param status_code: 200 or 400+
+    :param data_type: [FILE, DATA, AUTH]
+    :param status_msg: A human-readable status massage
+    :param json_data
+    :return: bytes
+    """
+    for field in RESPONSE_FIELDS:
+        if field in json_data:
+            # e.g. DATA GET returns a saved request: its fields have to be replaced
+            return json_dumps(make_response_json(operation, status_code, data_type, status_msg, json_data))
+    fragment = response_fragments.get((operation, status_code, data_type))
+    if fragment is None:
+        fragment = json_dumps({FIELD_OPERATION: operation, FIELD_DIRECTION: DIR_RESPONSE,
+                               FIELD_STATUS: status_code, FIELD_TYPE: data_type})[1:]
+        if len(response_fragments) < 1024:
+            response_fragments[(operation, status_code, data_type)] = fragment
+    head = json_dumps(json_data)[:-1] + b',' if json_data else b'{'
+    return b''.join([head, b'"status_msg":', json_dumps(status_msg), b',', fragment])
+
+
+def make_response_packet(operation, status_code, data_type, status_msg, json_data, bin_data=None):
+    """
+    Make a packet for response
+    :param operation: [SAVE, DELETE, GET, UPLOAD, DOWNLOAD, BYE, LOGIN]
+    :param status_code: 200 or 400+
+    :param data_type: [FILE, DATA, AUTH]
+    :param status_msg: A human-readable status massage
+    :param json_data
+    :param bin_data
+    :return:
+    """
+    return make_packet(make_response_json(operation, status_code, data_type, status_msg, json_data), bin_data)
+
+
+def make_response_buffers(operation, status_code, data_type, status_msg, json_data, bin_data=None):
+    """
+    Make a packet for response as a list of buffers, see make_packet_buffers
+    :param operation: [SAVE, DELETE, GET, UPLOAD, DOWNLOAD, BYE, LOGIN]
+    :param status_code: 200 or 400+
+    :param data_type: [FILE, DATA, AUTH]
+    :param status_msg: A human-readable status massage
+    :param json_data
+    :param bin_data
+    :return:
+    """
+    return make_packet_buffers(encode_response_json(operation, status_code, data_type, status_msg, json_data),
+                               bin_data)
+
+
+def send_buffers(conn, buffers, flags=0):
+    """
+    Send a packet made of several buffers with sendmsg (scatter-gather), without joining them.
+    Partial sends are continued. Without sendmsg (e.g. on Windows) the buffers are joined and sent with sendall.
+    :param conn: the TCP connection
+    :param buffers: list of bytes-like objects
+    :param flags: flags of sendmsg, e.g. MSG_MORE
+    :return: None
+    """
+    if not hasattr(conn, 'sendmsg'):
+        conn.sendall(b''.join(buffers))
+        return
+    buffers = list(buffers)
+    while buffers:
+        sent = conn.sendmsg(buffers, [], flags)
+        done = 0
+        while done < len(buffers) and sent >= len(buffers[done]):
+            sent -= len(buffers[done])
+            done += 1
+        del buffers[:done]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
+def send_file_packet(connection_socket, json_data, fid, offset, count):
+    """
+    Send a packet whose binary data is a range of an open file, without reading it into Python:
+    the head goes out with sendmsg (MSG_MORE, so it shares a segment with the data) and the data
+    with os.sendfile. Without os.sendfile, or for a socket-like object, the sendfile() method is used.
+    :param connection_socket: a blocking socket, or anything with the same sendmsg/sendfile methods
+    :param json_data: dict, or its encoding (bytes)
+    :param fid: file opened in binary mode
+    :param offset: start of the data in the file
+    :param count: length of the data
+    :return: None
+    """
+    send_file_range(connection_socket, make_packet_head(json_data, count), fid, offset, count)
+
+
+def send_file_range(connection_socket, head, fid, offset, count):
+    """
+    Send a packet head followed by a range of an open file, see send_file_packet
+    :param connection_socket:
+    :param head: everything before the binary data (bytes)
+    :param fid: file opened in binary mode
+    :param offset: start of the data in the file
+    :param count: length of the data
+    :return: None
+    """
+    send_buffers(connection_socket, [head], MSG_MORE)
+    if not hasattr(os, 'sendfile') or not isinstance(connection_socket, socket):
+        connection_socket.sendfile(fid, offset, count)
+        return
+    # socket.sendfile would also work, but it sets up a selector on every call
+    end = offset + count
+    while offset < end:
+        try:
+            sent = os.sendfile(connection_socket.fileno(), fid.fileno(), offset, end - offset)
+        except BlockingIOError:
+            # A socket with a timeout is non-blocking underneath: wait until it is writable again.
+            _, writable, _ = select.select([], [connection_socket], [], connection_socket.gettimeout())
+            if not writable:
+                raise timeout('The client does not receive the data.')
+            continue
+        if sent == 0:
+            raise ConnectionError('The file is shorter than expected.')
+        offset += sent
+
+
+def recv_exactly_into(conn, view):
+    """
+    Fill the whole buffer from the TCP stream with recv_into (no intermediate bytes objects).
+    :param conn: the TCP connection
+    :param view: a writable memoryview to fill
+    :return: True if the buffer is filled, False if the connection is closed
+    """
+    while len(view) > 0:
+        n = conn.recv_into(view)
+        if n == 0:
+            return False
+        view = view[n:]
+    return True
+
+
+def is_oversized_batch(json_data, b_len):
+    """
+    Whether the binary section of a request is an UPLOAD batch ("block_count" other than 1) above
+    MAX_UPLOAD_BATCH. Checked once the JSON section is received, before the binary section.
+    """
+    return b_len > MAX_UPLOAD_BATCH and type(json_data) is dict and json_data.get(FIELD_BLOCK_COUNT, 1) != 1
 
 
 def get_tcp_packet(conn):
     """
     Receive a complete TCP "packet" from a TCP stream and get the json data and binary data.
+    The json section and the binary section are received into one preallocated bytearray,
+    and the binary data is returned as a memoryview of it (no copy).
     :param conn: the TCP connection
     :return:
         json_data
-        bin_data
+        bin_data (memoryview)
     """
-    bin_data = b''
-    while len(bin_data) < 8:
-        data_rec = conn.recv(8)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
-    data = bin_data[:8]
-    bin_data = bin_data[8:]
-    j_len, b_len = struct.unpack('!II', data)
-    while len(bin_data) < j_len:
-        data_rec = conn.recv(j_len)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
-    j_bin = bin_data[:j_len]
-
+    header = bytearray(8)
+    if not recv_exactly_into(conn, memoryview(header)):
+        return None, None
+    j_len, b_len = struct.unpack('!II', header)
+    if j_len > MAX_JSON_SIZE or b_len > MAX_BODY_SIZE:
+        logger.warning(f'Packet of {j_len}+{b_len} bytes is too large.')
+        return None, None
+    buffer = memoryview(bytearray(j_len + b_len))
+    if not recv_exactly_into(conn, buffer[:j_len]):
+        return None, None
     try:
-        json_data = json.loads(j_bin.decode())
+        json_data = json_loads(buffer[:j_len])
     except Exception as ex:
         return None, None
-
-    bin_data = bin_data[j_len:]
-    while len(bin_data) < b_len:
-        data_rec = conn.recv(b_len)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
+    if is_oversized_batch(json_data, b_len):
+        logger.warning(f'UPLOAD batch of {b_len} bytes is too large.')
+        return None, None
+    bin_data = buffer[j_len:]
+    if not recv_exactly_into(conn, bin_data):
+        return None, None
     return json_data, bin_data
 
 
-def data_process(username, request_operation, json_data, connection_socket):
+class PacketReader:
     """
-    Data Process
-    :param username:
-    :param request_operation:
-    :param json_data:
-    :param connection_socket:
-    :return: None
+    Buffered per-connection reader of STEP packets.
+    It reads the TCP stream in large chunks into one reusable buffer and parses as many complete packets
+    as the buffer holds, so pipelined requests cost far fewer recv calls than get_tcp_packet.
+    The binary data is a memoryview of the buffer and stays valid until the next read_packet() call.
+    Reads are bounded in time (see IDLE_TIMEOUT): the first byte of a packet has to come within idle_timeout,
+    the connection may not be silent for read_timeout within a packet, and the header and the binary section
+    have to be complete within their deadlines, so a slow client cannot hold the connection forever.
+    A breach raises socket.timeout.
     """
-    global logger
-    if request_operation == OP_GET:
-        if FIELD_KEY not in json_data.keys():
-            logger.info(f'<-- Get data without key.')
-            logger.error(f'<-- Field "key" is missing for DATA GET.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_DATA, f'Field "key" is missing for DATA GET.', {}))
-            return
-        logger.info(f'--> Get data {json_data[FIELD_KEY]}')
-        if os.path.exists(join('data', username, json_data[FIELD_KEY])) is False:
-            logger.error(f'<-- The key {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_DATA, f'The key {json_data[FIELD_KEY]} is not existing.', {}))
-            return
-        try:
-            with open(join('data', username, json_data[FIELD_KEY]), 'r') as fid:
-                data_from_file = json.load(fid)
-                logger.info(f'<-- Find the data and return to client.')
-                connection_socket.send(
-                    make_response_packet(OP_GET, 200, TYPE_DATA, f'OK', data_from_file))
-        except Exception as ex:
-            logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
-
-    if request_operation == OP_SAVE:
-        key = str(uuid.uuid4())
-        if FIELD_KEY in json_data.keys():
-            key = json_data[FIELD_KEY]
-        logger.info(f'--> Save data with key "{key}"')
-        if os.path.exists(join('data', username, key)) is True:
-            logger.error(f'<-- This key "{key}" is existing.')
-            connection_socket.send(make_response_packet(OP_SAVE, 402, TYPE_DATA, f'This key "{key}" is existing.', {}))
-            return
-        try:
-            with open(join('data', username, key), 'w') as fid:
-                json.dump(json_data, fid)
-                logger.error(f'<-- Data is saved with key "{key}"')
-                connection_socket.send(
-                    make_response_packet(OP_SAVE, 200, TYPE_DATA, f'Data is saved with key "{key}"', {FIELD_KEY: key}))
-        except Exception as ex:
-            logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
-    if request_operation == OP_DELETE:
-        if FIELD_KEY not in json_data.keys():
-            logger.info(f'--> Delete data without any key.')
-            logger.error(f'<-- Field "key" is missing for DATA delete.')
-            connection_socket.send(
-                make_response_packet(OP_DELETE, 410, TYPE_DATA, f'Field "key" is missing for DATA delete.', {}))
-            return
-        if os.path.exists(join('data', username, json_data[FIELD_KEY])) is False:
-            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_DELETE, 404, TYPE_DATA, f'The "key" {json_data[FIELD_KEY]} is not existing.',
-                                     {}))
-            return
+    def __init__(self, conn, buffer_size=READ_BUFFER_SIZE, idle_timeout=None, read_timeout=None,
+                 header_deadline=None, body_deadline=None):
+        self.conn = conn
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not parsed yet
+        self.end = 0  # end of the received bytes
+        # None takes the module setting; 0 disables
+        self.idle_timeout = (IDLE_TIMEOUT if idle_timeout is None else idle_timeout) or None
+        self.read_timeout = (READ_TIMEOUT if read_timeout is None else read_timeout) or None
+        self.header_deadline = (HEADER_DEADLINE if header_deadline is None else header_deadline) or None
+        self.body_deadline = (BODY_DEADLINE if body_deadline is None else body_deadline) or None
+        self.timeout = conn.gettimeout()
+
+    def _deadline(self, seconds):
+        return None if seconds is None else time.monotonic() + seconds
+
+    def _recv_into(self, view, deadline=None, idle=False):
+        """
+        recv_into with the timeout of the current phase. The socket timeout is only changed when the phase
+        changes or the deadline is close, so most calls cost no extra system call.
+        :return: the number of received bytes
+        """
+        limit = self.idle_timeout if idle else self.read_timeout
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise timeout('The packet is not complete before its deadline.')
+            if limit is None or remaining < limit:
+                limit = remaining
+        # Allow 1s of slack before shrinking a timeout that is already set
+        if limit != self.timeout and not (limit is not None and self.timeout is not None
+                                          and limit <= self.timeout <= limit + 1):
+            self.conn.settimeout(limit)
+            self.timeout = limit
+        return self.conn.recv_into(view)
+
+    def _recv_exactly_into(self, view, deadline):
+        """
+        Same as recv_exactly_into, with the timeouts of the reader
+        """
+        while len(view) > 0:
+            n = self._recv_into(view, deadline)
+            if n == 0:
+                return False
+            view = view[n:]
+        return True
+
+    def _fill(self, size, deadline=None, idle=False):
+        """
+        Receive until at least size bytes are buffered after self.start.
+        :param size: no larger than the buffer
+        :param deadline: time.monotonic() by which the bytes have to be there
+        :param idle: wait with the idle timeout (for the first byte of a packet)
+        :return: False if the connection is closed
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start + size > len(self.buffer):
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end].tobytes()
+            self.start, self.end = 0, remaining
+        while self.end - self.start < size:
+            n = self._recv_into(self.view[self.end:], deadline, idle)
+            if n == 0:
+                return False
+            self.end += n
+        return True
+
+    def read_packet(self):
+        """
+        Get the next packet of the stream. The socket is left with read_timeout, not what remained of a deadline,
+        for sending the response: a send then fails only if the client takes nothing for read_timeout.
+        :return:
+            json_data
+            bin_data (memoryview)
+            or None, None if the connection is closed or the packet is broken
+        """
+        json_data, bin_data = self._read_packet()
+        if json_data is not None and self.timeout != self.read_timeout:
+            self.conn.settimeout(self.read_timeout)
+            self.timeout = self.read_timeout
+        return json_data, bin_data
+
+    def _read_packet(self):
+        if self.start == self.end and not self._fill(1, idle=True):
+            return None, None
+        deadline = self._deadline(self.header_deadline)
+        if self.buffer[self.start] == COMPACT_MAGIC:
+            return self._read_compact(deadline)
+        if self.end - self.start < 8 and not self._fill(8, deadline):
+            return None, None
+        j_len, b_len = struct.unpack_from('!II', self.buffer, self.start)
+        if j_len > MAX_JSON_SIZE or b_len > MAX_BODY_SIZE:
+            logger.warning(f'Packet of {j_len}+{b_len} bytes is too large.')
+            return None, None
+        total = 8 + j_len + b_len
+        if total > len(self.buffer):
+            # Larger than the buffer: take the buffered part and receive the rest into its own buffer.
+            packet = memoryview(bytearray(j_len + b_len))
+            buffered = min(self.end - self.start - 8, j_len + b_len)
+            packet[:buffered] = self.view[self.start + 8:self.start + 8 + buffered]
+            self.start = self.end = 0
+            if buffered < j_len and not self._recv_exactly_into(packet[buffered:j_len], deadline):
+                return None, None
+            try:
+                json_data = json_loads(packet[:j_len])
+            except Exception as ex:
+                return None, None
+            if is_oversized_batch(json_data, b_len):
+                logger.warning(f'UPLOAD batch of {b_len} bytes is too large.')
+                return None, None
+            buffered = max(buffered, j_len)
+            if not self._recv_exactly_into(packet[buffered:], self._deadline(self.body_deadline)):
+                return None, None
+            return json_data, packet[j_len:]
+        # A packet within the buffer costs no allocation; an UPLOAD batch above the limit is refused by upload_block
+        if self.end - self.start < 8 + j_len and not self._fill(8 + j_len, deadline):
+            return None, None
+        if self.end - self.start < total and not self._fill(total, self._deadline(self.body_deadline)):
+            return None, None
+        packet = self.view[self.start + 8:self.start + total]
+        self.start += total
         try:
-            os.remove(join('data', username, json_data[FIELD_KEY]))
-            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is deleted.')
-            connection_socket.send(
-                make_response_packet(OP_DELETE, 200, TYPE_DATA, f'The "key" {json_data[FIELD_KEY]} is deleted.',
-                                     {FIELD_KEY: json_data[FIELD_KEY]}))
+            json_data = json_loads(packet[:j_len])
         except Exception as ex:
-            logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+            return None, None
+        return json_data, packet[j_len:]
+
+    def _read_compact(self, deadline):
+        """
+        Get a packet of the compact framing
+        :param deadline: of the head
+        :return:
+            the head (tuple of COMPACT_HEAD)
+            bin_data (memoryview)
+            or None, None if the connection is closed, the version is unknown or the packet is too large
+        """
+        head_size = COMPACT_HEAD.size
+        if self.end - self.start < head_size and not self._fill(head_size, deadline):
+            return None, None
+        head = COMPACT_HEAD.unpack_from(self.buffer, self.start)
+        if head[1] != COMPACT_VERSION:
+            return None, None
+        b_len = head[6]
+        if b_len > (MAX_UPLOAD_BATCH if head[5] > 1 else MAX_BODY_SIZE):
+            # Checked before the session id: the head is not authenticated
+            logger.warning(f'Compact packet of {b_len} bytes is too large.')
+            return None, None
+        deadline = self._deadline(self.body_deadline)
+        if head_size + b_len > len(self.buffer):
+            bin_data = memoryview(bytearray(b_len))
+            buffered = min(self.end - self.start - head_size, b_len)
+            bin_data[:buffered] = self.view[self.start + head_size:self.start + head_size + buffered]
+            self.start = self.end = 0
+            if not self._recv_exactly_into(bin_data[buffered:], deadline):
+                return None, None
+        else:
+            if self.end - self.start < head_size + b_len and not self._fill(head_size + b_len, deadline):
+                return None, None
+            bin_data = self.view[self.start + head_size:self.start + head_size + b_len]
+            self.start += head_size + b_len
+        return head, bin_data
+
+    def __iter__(self):
+        while True:
+            json_data, bin_data = self.read_packet()
+            if json_data is None:
+                return
+            yield json_data, bin_data
 
 
-def file_process(username, request_operation, json_data, bin_data, connection_socket):
+def data_get_process(username, json_data, bin_data, connection_socket, conn_cache):
     """
-    File Process
+    DATA GET: return the saved JSON of "key"
     :param username:
-    :param request_operation:
     :param json_data:
     :param bin_data:
     :param connection_socket:
-    :return:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
     """
     global logger
-    if request_operation == OP_GET:
-        if FIELD_KEY not in json_data.keys():
-            logger.info(f'<-- Get file without key.')
-            logger.error(f'<-- Field "key" is missing for DATA GET.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for FILE GET.', {}))
-            return
-        logger.info(f'--> Plan to download file with "key" {json_data[FIELD_KEY]}')
-        if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False and os.path.exists(
-                join('tmp', username, json_data[FIELD_KEY])) is False:
-            logger.error(f'<-- The key {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_FILE, f'The key {json_data[FIELD_KEY]} is not existing.', {}))
-            return
+    logger.info(f'--> Get data {json_data[FIELD_KEY]}')
+    try:
+        # One open instead of exists + open, and no text-mode decoding layer
+        with open(join('data', username, json_data[FIELD_KEY]), 'rb') as fid:
+            data_from_file = json.loads(fid.read())
+    except FileNotFoundError:
+        logger.error(f'<-- The key {json_data[FIELD_KEY]} is not existing.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_GET, 404, TYPE_DATA,
+                                           f'The key {json_data[FIELD_KEY]} is not existing.', {}))
+        return
+    except Exception as ex:
+        logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+        return
+    logger.info(f'<-- Find the data and return to client.')
+    send_buffers(connection_socket,
+                 make_response_buffers(OP_GET, 200, TYPE_DATA, f'OK', data_from_file))
+
+
+def data_save_process(username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    DATA SAVE: save the request JSON with "key" (or a new UUID)
+    :param username:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    key = str(uuid.uuid4())
+    if FIELD_KEY in json_data.keys():
+        key = json_data[FIELD_KEY]
+    logger.info(f'--> Save data with key "{key}"')
+    if os.path.exists(join('data', username, key)) is True:
+        logger.error(f'<-- This key "{key}" is existing.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_SAVE, 402, TYPE_DATA, f'This key "{key}" is existing.', {}))
+        return
+    try:
+        with open(join('data', username, key), 'w') as fid:
+            json.dump(json_data, fid)
+            logger.error(f'<-- Data is saved with key "{key}"')
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_SAVE, 200, TYPE_DATA,
+                                               f'Data is saved with key "{key}"', {FIELD_KEY: key}))
+    except Exception as ex:
+        logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+
+
+def data_delete_process(username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    DATA DELETE: delete the saved JSON of "key"
+    :param username:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    if os.path.exists(join('data', username, json_data[FIELD_KEY])) is False:
+        logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_DELETE, 404, TYPE_DATA,
+                                           f'The "key" {json_data[FIELD_KEY]} is not existing.',
+                                           {}))
+        return
+    try:
+        os.remove(join('data', username, json_data[FIELD_KEY]))
+        logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is deleted.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_DELETE, 200, TYPE_DATA, f'The "key" {json_data[FIELD_KEY]} is deleted.',
+                                           {FIELD_KEY: json_data[FIELD_KEY]}))
+    except Exception as ex:
+        logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
-        if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False and os.path.exists(
-                join('tmp', username, json_data[FIELD_KEY])) is True:
-            logger.error(f'<-- The key {json_data[FIELD_KEY]} is not completely uploaded.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_FILE,
-                                     f'The key {json_data[FIELD_KEY]} is not completely uploaded.', {}))
-            return
 
-        file_path = join('file', username, json_data[FIELD_KEY])
-        file_size = getsize(file_path)
-        block_size = MAX_PACKET_SIZE
-        total_block = math.ceil(file_size / block_size)
-        md5 = get_file_md5(file_path)
+def file_get_process(username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    FILE GET: return the download plan of "key"
+    :param username:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    logger.info(f'--> Plan to download file with "key" {json_data[FIELD_KEY]}')
+    if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False and os.path.exists(
+            join('tmp', username, json_data[FIELD_KEY])) is False:
+        logger.error(f'<-- The key {json_data[FIELD_KEY]} is not existing.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                           f'The key {json_data[FIELD_KEY]} is not existing.', {}))
+        return
+
+    if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False and os.path.exists(
+            join('tmp', username, json_data[FIELD_KEY])) is True:
+        logger.error(f'<-- The key {json_data[FIELD_KEY]} is not completely uploaded.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                           f'The key {json_data[FIELD_KEY]} is not completely uploaded.', {}))
+        return
+
+    block_size = get_plan_block_size(json_data)
+    if block_size is None:
+        logger.error(f'<-- The "block_size" should be a positive integer.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_GET, 410, TYPE_FILE,
+                                           f'The "block_size" should be a positive integer.', {}))
+        return
+    file_path = join('file', username, json_data[FIELD_KEY])
+    file_size = getsize(file_path)
+    total_block = math.ceil(file_size / block_size)
+    algorithm = None
+    if FIELD_DIGEST_ALGORITHM in json_data.keys():
+        # The client may ask for a faster digest; MD5 if this server does not have it
+        algorithm = json_data[FIELD_DIGEST_ALGORITHM]
+        if not isinstance(algorithm, str) or new_digest(algorithm) is None:
+            algorithm = 'md5'
+    # The MD5 and the requested digest come from one pass over the file if neither is saved yet
+    digests = get_stored_file_digests(username, json_data[FIELD_KEY], () if algorithm is None else (algorithm,))
+    md5 = digests['md5']
+    rval = {
+        FIELD_KEY: json_data[FIELD_KEY],
+        FIELD_SIZE: file_size,
+        FIELD_TOTAL_BLOCK: total_block,
+        FIELD_BLOCK_SIZE: block_size,
+        FIELD_MD5: md5
+    }
+    if algorithm is not None:
+        rval[FIELD_DIGEST_ALGORITHM] = algorithm
+        rval[FIELD_DIGEST] = digests[algorithm]
+    if json_data.get(FIELD_COMPACT) is True:
+        # DOWNLOAD blocks of this plan may use the compact framing on this connection
+        rval[FIELD_SESSION_ID] = conn_cache.open_session(username, json_data[FIELD_KEY], block_size)
+    logger.info(f'<-- Plan: file size {file_size}, total block number {total_block}. '
+                f'(MD5 cache: {file_meta_cache.hits} hits, {file_meta_cache.misses} misses)')
+    send_buffers(connection_socket,
+                 make_response_buffers(OP_GET, 200, TYPE_FILE, f'OK. This is the download plan.', rval))
+    return
+
+
+def file_save_process(username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    FILE SAVE: accept a file "size" for "key" (or a new UUID) and return the upload plan
+    :param username:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    key = str(uuid.uuid4())
+    if FIELD_KEY in json_data.keys():
+        key = json_data[FIELD_KEY]
+    logger.info(f'--> Plan to save/upload a file with key "{key}"')
+    if os.path.exists(join('file', username, key)) is True:
+        logger.error(f'<-- This key "{key}" is existing.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_SAVE, 402, TYPE_FILE, f'This "key" {key} is existing.', {}))
+        return
+    if FIELD_SIZE not in json_data.keys():
+        logger.error(f'<-- This file "size" has to be included.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_SAVE, 402, TYPE_FILE, f'This file "size" has to be included', {}))
+        return
+    block_size = get_plan_block_size(json_data)
+    if block_size is None:
+        logger.error(f'<-- The "block_size" should be a positive integer.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_SAVE, 410, TYPE_FILE,
+                                           f'The "block_size" should be a positive integer.', {}))
+        return
+    file_size = json_data[FIELD_SIZE]
+    if type(file_size) is not int or not 0 < file_size <= MAX_FILE_SIZE:
+        logger.error(f'<-- The file "size" should be a positive integer up to {MAX_FILE_SIZE}.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_SAVE, 410, TYPE_FILE,
+                                           f'The file "size" should be a positive integer up to {MAX_FILE_SIZE}.', {}))
+        return
+    if DEDUP and FIELD_MD5 in json_data.keys() and file_save_linked(username, key, json_data[FIELD_MD5], file_size,
+                                                                    block_size, connection_socket):
+        return
+    total_block = math.ceil(file_size / block_size)
+    try:
         rval = {
-            FIELD_KEY: json_data[FIELD_KEY],
+            FIELD_KEY: key,
             FIELD_SIZE: file_size,
             FIELD_TOTAL_BLOCK: total_block,
             FIELD_BLOCK_SIZE: block_size,
-            FIELD_MD5: md5
+            FIELD_MAX_BLOCK_COUNT: max(1, MAX_UPLOAD_BATCH // block_size)
         }
-        logger.info(f'<-- Plan: file size {file_size}, total block number {FIELD_TOTAL_BLOCK}.')
-        connection_socket.send(
-            make_response_packet(OP_GET, 200, TYPE_FILE, f'OK. This is the download plan.', rval))
-        return
+        with open(join('tmp', username, key), 'wb+') as fid:
+            fid.seek(file_size - 1)
+            fid.write(b'\0')
 
-    if request_operation == OP_SAVE:
-        key = str(uuid.uuid4())
-        if FIELD_KEY in json_data.keys():
-            key = json_data[FIELD_KEY]
-        logger.info(f'--> Plan to save/upload a file with key "{key}"')
-        if os.path.exists(join('file', username, key)) is True:
-            logger.error(f'<-- This key "{key}" is existing.')
-            connection_socket.send(make_response_packet(OP_SAVE, 402, TYPE_FILE, f'This "key" {key} is existing.', {}))
-            return
-        if FIELD_SIZE not in json_data.keys():
-            logger.error(f'<-- This file "size" has to be included.')
-            connection_socket.send(
-                make_response_packet(OP_SAVE, 402, TYPE_FILE, f'This file "size" has to be included', {}))
-            return
-        file_size = json_data[FIELD_SIZE]
-        block_size = MAX_PACKET_SIZE
-        total_block = math.ceil(file_size / block_size)
-        try:
-            rval = {
-                FIELD_KEY: key,
-                FIELD_SIZE: file_size,
-                FIELD_TOTAL_BLOCK: total_block,
-                FIELD_BLOCK_SIZE: block_size,
-            }
-            with open(join('tmp', username, key), 'wb+') as fid:
-                fid.seek(file_size - 1)
-                fid.write(b'\0')
-
-            state_key = (username, key)
-            with upload_meta_lock:
-                upload_states[state_key] = {
-                    "total": total_block,
-                    "received": set()
-                }
-
-            logger.error(f'<-- Upload plan: key {key}, total block number {total_block}, block size {block_size}.')
-            connection_socket.send(
-                make_response_packet(OP_SAVE, 200, TYPE_FILE, f'This is the upload plan.', rval))
-        except Exception as ex:
-            logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+        state = upload_state_type(get_state_path(username, key), total_block, block_size, size=file_size)
+        state.checkpoint()
+        with upload_meta_lock:
+            replaced = upload_states.get((username, key))
+            if replaced is not None:
+                # Uploads in progress that cached it resolve the key again
+                replaced.finished = True
+            upload_states[(username, key)] = state
+        if json_data.get(FIELD_COMPACT) is True:
+            # UPLOAD blocks of this plan may use the compact framing on this connection
+            rval[FIELD_SESSION_ID] = conn_cache.open_session(username, key, block_size)
+
+        logger.error(f'<-- Upload plan: key {key}, total block number {total_block}, block size {block_size}.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_SAVE, 200, TYPE_FILE, f'This is the upload plan.', rval))
+    except Exception as ex:
+        logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
-    if request_operation == OP_DELETE:
-        if FIELD_KEY not in json_data.keys():
-            logger.info(f'--> Delete file without any key.')
-            logger.error(f'<-- Field "key" is missing for FILE delete.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for FILE delete.', {}))
-            return
 
-        if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False:
-            if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is True:
-                delete_key = (username, json_data[FIELD_KEY])
-                delete_lock = get_upload_lock(delete_key)
-                with delete_lock:
-                    if not os.path.exists(join('file', username, json_data[FIELD_KEY])) and \
-                       os.path.exists(join('tmp', username, json_data[FIELD_KEY])):
-                        try:
-                            os.remove(join('tmp', username, json_data[FIELD_KEY]))
-                        except Exception as ex:
-                            logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
-                        cleanup_upload_state(delete_key)
-                logger.error(
-                    f'<-- The "key" {json_data[FIELD_KEY]} is not completely uploaded. The tmp files are deleted.')
-                connection_socket.send(
-                    make_response_packet(OP_GET, 404, TYPE_FILE,
-                                         f'The "key" {json_data[FIELD_KEY]} is not completely uploaded. '
-                                         f'The tmp files are deleted.',
-                                         {}))
-                return
-            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is not existing.', {}))
+def file_save_linked(username, key, md5, file_size, block_size, connection_socket):
+    """
+    FILE SAVE of content the user already stores: link key to its blob, drop an upload of key in progress,
+    and answer with a plan of 0 blocks
+    :param username:
+    :param key:
+    :param md5: "md5" of the SAVE request
+    :param file_size:
+    :param block_size:
+    :param connection_socket:
+    :return: True if answered, False if the content is not stored (a normal upload plan follows)
+    """
+    global logger, dedup_hits, dedup_bytes
+    state_key = (username, key)
+    with get_upload_lock(state_key):
+        if not link_blob(username, key, md5, file_size):
+            return False
+        with upload_meta_lock:
+            replaced = upload_states.get(state_key)
+            if replaced is not None:
+                replaced.finished = True
+        tmp_path = join('tmp', username, key)
+        if os.path.exists(tmp_path):
+            upload_file_pool.discard(tmp_path)
+            os.remove(tmp_path)
+            upload_state_type.remove_file(get_state_path(username, key))
+        save_file_md5(username, key, md5)
+    cleanup_upload_state(state_key)
+    with dedup_lock:
+        dedup_hits += 1
+        dedup_bytes += file_size
+    logger.info(f'<-- Upload plan: key {key} is linked to stored content, no block to upload. '
+                f'(dedup: {dedup_hits} hits, {dedup_bytes} bytes saved)')
+    send_buffers(connection_socket,
+                 make_response_buffers(OP_SAVE, 200, TYPE_FILE,
+                                       f'The content is stored. No block has to be uploaded.', {
+                                           FIELD_KEY: key,
+                                           FIELD_SIZE: file_size,
+                                           FIELD_TOTAL_BLOCK: 0,
+                                           FIELD_BLOCK_SIZE: block_size,
+                                           FIELD_MAX_BLOCK_COUNT: max(1, MAX_UPLOAD_BATCH // block_size),
+                                           FIELD_MD5: md5,
+                                           FIELD_DEDUPLICATED: file_size
+                                       }))
+    return True
+
+
+def file_delete_process(username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    FILE DELETE: delete the file of "key", or the tmp files of its upload
+    :param username:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False:
+        if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is True:
+            delete_key = (username, json_data[FIELD_KEY])
+            delete_lock = get_upload_lock(delete_key)
+            with delete_lock:
+                if not os.path.exists(join('file', username, json_data[FIELD_KEY])) and \
+                   os.path.exists(join('tmp', username, json_data[FIELD_KEY])):
+                    try:
+                        upload_file_pool.discard(join('tmp', username, json_data[FIELD_KEY]))
+                        os.remove(join('tmp', username, json_data[FIELD_KEY]))
+                        upload_state_type.remove_file(get_state_path(username, json_data[FIELD_KEY]))
+                    except Exception as ex:
+                        logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+                    cleanup_upload_state(delete_key)
+            logger.error(
+                f'<-- The "key" {json_data[FIELD_KEY]} is not completely uploaded. The tmp files are deleted.')
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                               f'The "key" {json_data[FIELD_KEY]} is not completely uploaded. '
+                                               f'The tmp files are deleted.',
+                                               {}))
             return
-        try:
-            os.remove(join('file', username, json_data[FIELD_KEY]))
-            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is deleted.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 200, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is deleted.',
-                                     {FIELD_KEY: json_data[FIELD_KEY]}))
-        except Exception as ex:
-            logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+        logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                           f'The "key" {json_data[FIELD_KEY]} is not existing.', {}))
+        return
+    try:
+        conn_cache.open_files.discard(join('file', username, json_data[FIELD_KEY]))
+        # A file with other links is referenced by the content-addressed store (even if --dedup is off now)
+        md5 = None
+        if os.stat(join('file', username, json_data[FIELD_KEY])).st_nlink > 1:
+            md5 = get_stored_file_md5(username, json_data[FIELD_KEY])
+        os.remove(join('file', username, json_data[FIELD_KEY]))
+        remove_file_md5(username, json_data[FIELD_KEY])
+        if md5 is not None:
+            release_blob(username, md5)
+        logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is deleted.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_GET, 200, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is deleted.',
+                                           {FIELD_KEY: json_data[FIELD_KEY]}))
+    except Exception as ex:
+        logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
-    if request_operation == OP_UPLOAD:
-        if FIELD_KEY not in json_data.keys():
-            logger.info(f'--> Upload file/block without any key.')
-            logger.error(f'<-- Field "key" is missing for FILE block uploading.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 410, TYPE_FILE, f'Field "key" is missing for FILE uploading.', {}))
-            return
-        logger.info(f'--> Upload file/block of "key" {json_data[FIELD_KEY]}.')
 
-        if os.path.exists(join('file', username, json_data[FIELD_KEY])) is True:
-            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is completely uploaded.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 408, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is completely uploaded.', {}))
+def file_status_process(username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    FILE STATUS: return the progress of the upload of "key", with the missing blocks as [first, count] runs,
+    so that an interrupted upload is resumed without SAVE (which would start it again)
+    :param username:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    key = json_data[FIELD_KEY]
+    logger.info(f'--> Status of the upload of key "{key}"')
+    state = conn_cache.get_upload((username, key))
+    if state is None and os.path.exists(join('tmp', username, key)) is True:
+        try:
+            state = get_upload_state(username, key)
+        except FileNotFoundError:
+            state = None
+    if state is None or state.finished:
+        if os.path.exists(join('file', username, key)) is True:
+            logger.info(f'<-- The "key" {key} is completely uploaded.')
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_STATUS, 200, TYPE_FILE, f'The "key" {key} is completely uploaded.', {
+                                                   FIELD_KEY: key,
+                                                   FIELD_SIZE: getsize(join('file', username, key)),
+                                                   FIELD_MISSING: []
+                                               }))
             return
+        logger.error(f'<-- The "key" {key} is not existing.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_STATUS, 404, TYPE_FILE, f'The "key" {key} is not existing.', {}))
+        return
 
-        if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is False:
-            logger.error(
-                f'<-- The "key" {json_data[FIELD_KEY]} is not accepted for uploading.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 408, TYPE_FILE,
-                                     f'The "key" {json_data[FIELD_KEY]} is not accepted for uploading.',
-                                     {}))
-            return
+    missing = state.missing()
+    rval = {
+        FIELD_KEY: key,
+        FIELD_SIZE: state.size,
+        FIELD_TOTAL_BLOCK: state.total,
+        FIELD_BLOCK_SIZE: state.block_size,
+        FIELD_RECEIVED: state.total - sum(count for _, count in missing),
+        FIELD_MISSING: missing,
+        FIELD_MAX_BLOCK_COUNT: max(1, MAX_UPLOAD_BATCH // state.block_size)
+    }
+    if json_data.get(FIELD_COMPACT) is True:
+        # The missing blocks may use the compact framing on this connection
+        rval[FIELD_SESSION_ID] = conn_cache.open_session(username, key, state.block_size)
+    logger.info(f'<-- Upload status: key {key}, {rval[FIELD_RECEIVED]} of {state.total} blocks received, '
+                f'{len(missing)} missing ranges.')
+    send_buffers(connection_socket,
+                 make_response_buffers(OP_STATUS, 200, TYPE_FILE, f'This is the upload status.', rval))
+
+
+def upload_block(username, key, block_index, bin_data, conn_cache, block_count=1):
+    """
+    Write the block block_index of the upload of key, or the batch of block_count contiguous blocks from it
+    (one pwrite). The part of UPLOAD shared by the JSON request and the compact framing.
+    :param username:
+    :param key:
+    :param block_index:
+    :param bin_data:
+    :param conn_cache: ConnectionCache of the connection
+    :param block_count: number of blocks in bin_data
+    :return:
+        status code
+        status message
+        MD5 of the file if this block completed the upload, otherwise None
+    """
+    global logger, dedup_bytes
+    state_key = (username, key)
+    file_path = join('tmp', username, key)
+    # An upload this connection is writing to is known to be in progress
+    state = conn_cache.get_upload(state_key)
+
+    if state is None and os.path.exists(join('file', username, key)) is True:
+        logger.error(f'<-- The "key" {key} is completely uploaded.')
+        return 408, f'The "key" {key} is completely uploaded.', None
+
+    if state is None and os.path.exists(file_path) is False:
+        logger.error(f'<-- The "key" {key} is not accepted for uploading.')
+        return 408, f'The "key" {key} is not accepted for uploading.', None
+
+    if state is None:
+        state = get_upload_state(username, key)
+        if state.finished:
+            logger.error(f'<-- The "key" {key} is completely uploaded.')
+            return 408, f'The "key" {key} is completely uploaded.', None
+        conn_cache.put_upload(state_key, state)
+    file_size = state.size
+    block_size = state.block_size
+    total_block = state.total
+    if block_index >= total_block:
+        logger.error(f'<-- The "block_index" exceed the max index.')
+        return 405, f'The "block_index" exceed the max index.', None
+    if block_index < 0:
+        logger.error(f'<-- The "block_index" should >= 0.')
+        return 410, f'The "block_index" should >= 0.', None
+    # The packet readers already refuse a body above the batch limit; this is only a consistency check
+    if block_count > 1 and (block_index + block_count > total_block or block_size * block_count > MAX_UPLOAD_BATCH):
+        logger.error(f'<-- The "block_count" exceed the max index or the max batch.')
+        return 405, f'The "block_count" exceed the max index or the max batch.', None
+    # Only the last block of the file is shorter
+    if len(bin_data) != min(block_size * (block_index + block_count), file_size) - block_size * block_index:
+        logger.error(f'<-- The "block_size" is wrong.')
+        return 406, f'The "block_size" is wrong.', None
+
+    md5 = None
+    file_missing = False
+    upload_complete = False
+    try:
+        pooled_file = upload_file_pool.acquire(file_path)
+    except FileNotFoundError:
+        logger.error(
+            f'<-- Tmp file for key "{key}" is missing during UPLOAD. '
+            f'Upload is no longer accepted.'
+        )
+        file_missing = True
+    if not file_missing:
+        try:
+            # Blocks received before are a retransmission and are not written again. Any other write is
+            # registered first, or it could land in the stored file after the upload is claimed finished
+            if not all(state.has(i) for i in range(block_index, block_index + block_count)):
+                if not state.begin_write():
+                    logger.error(f'<-- The "key" {key} is completely uploaded.')
+                    return 408, f'The "key" {key} is completely uploaded.', None
+                try:
+                    os.pwrite(pooled_file[0], bin_data, block_size * block_index)
+                finally:
+                    state.end_write()
+
+            # The bitmap and the MD5 have their own locks
+            if block_count == 1:
+                if state.add(block_index):
+                    state.update_md5(pooled_file[0], block_index, bin_data)
+            else:
+                for i in range(block_count):
+                    if state.add(block_index + i):
+                        state.update_md5(pooled_file[0], block_index + i,
+                                         bin_data[block_size * i:block_size * (i + 1)])
+
+            # Completion is serialized by the per-key lock (also taken by DELETE)
+            if state.is_complete() and not state.finished:
+                with get_upload_lock(state_key):
+                    upload_complete = state.claim_finish()
+                    if upload_complete:
+                        md5 = state.get_md5(pooled_file[0])
+                        state.remove()
+                        shutil.move(file_path, join('file', username, key))
+                        if DEDUP:
+                            saved = store_blob(username, key, md5)
+                            if saved:
+                                with dedup_lock:
+                                    dedup_bytes += saved
+                        save_file_md5(username, key, md5)
+        finally:
+            upload_file_pool.release(pooled_file)
+        if upload_complete:
+            upload_file_pool.discard(file_path)
+            logger.info(f'<-- Upload of "key" {key} is completed. '
+                        f'(fd pool: {upload_file_pool.hits} hits, {upload_file_pool.misses} misses, '
+                        f'{upload_file_pool.evictions} evictions)')
 
-        if FIELD_BLOCK_INDEX not in json_data.keys():
-            logger.error(f'<-- The "block_index" is compulsory.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 410, TYPE_FILE, f'The "block_index" is compulsory.', {}))
-            return
-        file_path = join('tmp', username, json_data[FIELD_KEY])
-        file_size = getsize(file_path)
-        block_size = MAX_PACKET_SIZE
-        total_block = math.ceil(file_size / block_size)
-        block_index = json_data[FIELD_BLOCK_INDEX]
-        if block_index >= total_block:
-            logger.error(f'<-- The "block_index" exceed the max index.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 405, TYPE_FILE, f'The "block_index" exceed the max index.', {}))
-            return
-        if block_index < 0:
-            logger.error(f'<-- The "block_index" should >= 0.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 410, TYPE_FILE, f'The "block_index" should >= 0.', {}))
-            return
-        if block_index == total_block - 1 and len(bin_data) != file_size - block_size * block_index:
-            logger.error(f'<-- The "block_size" is wrong.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 406, TYPE_FILE, f'The "block_size" is wrong.', {}))
-            return
+    # Cleanup after releasing per-key lock
+    if file_missing or upload_complete:
+        cleanup_upload_state(state_key)
 
-        if block_index != total_block - 1 and len(bin_data) != block_size:
-            logger.error(f'<-- The "block_size" is wrong.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 406, TYPE_FILE, f'The "block_size" is wrong.', {}))
-            return
+    if file_missing:
+        return 408, f'The "key" {key} is not accepted for uploading (tmp file missing).', None
+    if block_count > 1:
+        return 200, f'The blocks {block_index}+{block_count} are uploaded.', md5
+    return 200, f'The block {block_index} is uploaded.', md5
 
-        state_key = (username, json_data[FIELD_KEY])
-        # Get or create lock and state atomically under meta-lock
-        with upload_meta_lock:
-            lock = _get_or_create_upload_lock(state_key)
-            state = upload_states.get(state_key)
-            if state is None:
-                state = {
-                    "total": total_block,
-                    "received": set()
-                }
-                upload_states[state_key] = state
-        
-        # Now acquire per-key lock for file operations
-        file_missing = False
-        upload_complete = False
-        with lock:
-            if not os.path.exists(file_path):
-                logger.error(
-                    f'<-- Tmp file for key "{json_data[FIELD_KEY]}" is missing during UPLOAD. '
-                    f'Upload is no longer accepted.'
-                )
-                file_missing = True
-            else:
-                # Write block to file
-                with open(file_path, 'rb+') as fid:
-                    fid.seek(block_size * block_index)
-                    fid.write(bin_data)
-                
-                # Update state (state dict itself is protected by the per-key lock)
-                state["received"].add(block_index)
-                upload_complete = len(state["received"]) == state["total"]
-                if upload_complete:
-                    md5 = get_file_md5(file_path)
-                    shutil.move(file_path, join('file', username, json_data[FIELD_KEY]))
-        
-        # Cleanup after releasing per-key lock
-        if file_missing or upload_complete:
-            cleanup_upload_state(state_key)
-        
-        if file_missing:
-            connection_socket.send(
-                make_response_packet(
-                    OP_UPLOAD,
-                    408,
-                    TYPE_FILE,
-                    f'The "key" {json_data[FIELD_KEY]} is not accepted for uploading (tmp file missing).',
-                    {}
-                )
-            )
-            return
-        
+
+def file_upload_process(username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    FILE UPLOAD: write the block "block_index" of "key", or the "block_count" blocks from it in the binary data
+    :param username:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    logger.info(f'--> Upload file/block of "key" {json_data[FIELD_KEY]}.')
+    block_count = json_data.get(FIELD_BLOCK_COUNT, 1)
+    if type(block_count) is not int or block_count <= 0:
+        logger.error(f'<-- The "block_count" should be a positive integer.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_UPLOAD, 410, TYPE_FILE,
+                                           f'The "block_count" should be a positive integer.', {}))
+        return
+    block_index = json_data[FIELD_BLOCK_INDEX]
+    status_code, status_msg, md5 = upload_block(username, json_data[FIELD_KEY], block_index, bin_data, conn_cache,
+                                                block_count)
+    rval = {}
+    if status_code == 200:
         rval = {
             FIELD_KEY: json_data[FIELD_KEY],
             FIELD_BLOCK_INDEX: block_index
         }
-        if upload_complete:
+        if FIELD_BLOCK_COUNT in json_data:
+            rval[FIELD_BLOCK_COUNT] = block_count
+        if md5 is not None:
             rval[FIELD_MD5] = md5
-        connection_socket.send(
-            make_response_packet(OP_UPLOAD, 200, TYPE_FILE, f'The block {block_index} is uploaded.', rval))
+    send_buffers(connection_socket,
+                 make_response_buffers(OP_UPLOAD, status_code, TYPE_FILE, status_msg, rval))
+
+
+def download_block(username, key, block_size, block_index, conn_cache, block_count=1):
+    """
+    Find the block block_index of the stored file of key, or the range of block_count blocks from it (cut to
+    MAX_DOWNLOAD_RANGE). The part of DOWNLOAD shared by the JSON request and the compact framing.
+    :param username:
+    :param key:
+    :param block_size: of the download plan
+    :param block_index:
+    :param conn_cache: ConnectionCache of the connection
+    :param block_count: number of blocks asked for
+    :return:
+        status code
+        status message
+        the open file (None if the status is not 200), offset and length of the block(s)
+    """
+    global logger
+    if os.path.exists(join('file', username, key)) is False:
+        if os.path.exists(join('tmp', username, key)) is True:
+            logger.error(f'<-- The "key" {key} is not completely uploaded. Please upload it first.')
+            return 404, f'The "key" {key} is not completely uploaded. Please upload it first', None, 0, 0
+        logger.error(f'<-- The "key" {key} is not existing.')
+        return 404, f'The "key" {key} is not existing.', None, 0, 0
+
+    file_path = join('file', username, key)
+    fid, file_size = conn_cache.open_files.get(file_path)
+    total_block = math.ceil(file_size / block_size)
+    if block_index >= total_block:
+        logger.error(f'<-- The "block_index" exceed the max index.')
+        return 410, f'The "block_index" exceed the max index.', None, 0, 0
+    if block_index < 0:
+        logger.error(f'<-- The "block_index" should >= 0.')
+        return 410, f'The "block_index" should >= 0.', None, 0, 0
+    if block_index + block_count > total_block:
+        logger.error(f'<-- The "block_count" exceed the max index.')
+        return 410, f'The "block_count" exceed the max index.', None, 0, 0
+
+    offset = block_size * block_index
+    if block_count == 1:
+        count = min(block_size, file_size - offset)
+        logger.info(f'<-- Return block {block_index}({count}bytes) of "key" {key} >= 0.')
+        return 200, 'An available block.', fid, offset, count
+    block_count = max(1, min(block_count, MAX_DOWNLOAD_RANGE // block_size))
+    count = min(block_size * block_count, file_size - offset)
+    if hasattr(os, 'posix_fadvise'):
+        # Start reading the range from the disk while the head is sent
+        os.posix_fadvise(fid.fileno(), offset, count, os.POSIX_FADV_WILLNEED)
+    logger.info(f'<-- Return blocks {block_index}+{block_count}({count}bytes) of "key" {key}.')
+    return 200, 'An available range of blocks.', fid, offset, count
+
+
+def file_download_process(username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    FILE DOWNLOAD: send the block "block_index" of "key", or the "block_count" blocks from it in one packet
+    :param username:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    logger.info(f'--> Download file/block of "key" {json_data[FIELD_KEY]}.')
+    # The client repeats the "block_size" of its GET plan; the default plan has none
+    block_size = get_plan_block_size(json_data)
+    if block_size is None:
+        logger.error(f'<-- The "block_size" should be a positive integer.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_GET, 410, TYPE_FILE,
+                                           f'The "block_size" should be a positive integer.', {}))
+        return
+    block_count = json_data.get(FIELD_BLOCK_COUNT, 1)
+    if type(block_count) is not int or block_count <= 0:
+        logger.error(f'<-- The "block_count" should be a positive integer.')
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_GET, 410, TYPE_FILE,
+                                           f'The "block_count" should be a positive integer.', {}))
         return
+    block_index = json_data[FIELD_BLOCK_INDEX]
+    status_code, status_msg, fid, offset, count = download_block(username, json_data[FIELD_KEY], block_size,
+                                                                 block_index, conn_cache, block_count)
+    if status_code != 200:
+        send_buffers(connection_socket, make_response_buffers(OP_GET, status_code, TYPE_FILE, status_msg, {}))
+        return
+    rval = {
+        FIELD_BLOCK_INDEX: block_index,
+        FIELD_KEY: json_data[FIELD_KEY],
+        FIELD_SIZE: count
+    }
+    if FIELD_BLOCK_COUNT in json_data:
+        # The range may be cut to MAX_DOWNLOAD_RANGE; the client asks again for the rest
+        rval[FIELD_BLOCK_COUNT] = -(-count // block_size)
+    send_file_packet(connection_socket,
+                     encode_response_json(OP_DOWNLOAD, 200, TYPE_FILE, status_msg, rval),
+                     fid, offset, count)
+
 
-    if request_operation == OP_DOWNLOAD:
-        if FIELD_KEY not in json_data.keys():
-            logger.info(f'--> Download file/block without any key.')
-            logger.error(f'<-- Field "key" is missing for FILE block downloading.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for FILE downloading.', {}))
+def data_process(username, request_operation, json_data, connection_socket):
+    """
+    Data Process
+    :param username:
+    :param request_operation:
+    :param json_data:
+    :param connection_socket:
+    :return: None
+    """
+    process_request(TYPE_DATA, request_operation, username, json_data, None, connection_socket, None)
+
+
+def file_process(username, request_operation, json_data, bin_data, connection_socket, conn_cache):
+    """
+    File Process
+    :param username:
+    :param request_operation:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return:
+    """
+    process_request(TYPE_FILE, request_operation, username, json_data, bin_data, connection_socket, conn_cache)
+
+
+def verify_token(token):
+    """
+    Check a token given by LOGIN: base64 of "<username>.<login time>.<md5 of both and the secret>"
+    :param token:
+    :return:
+        username, or None if the token is not valid
+        the error message
+    """
+    try:
+        token = base64.b64decode(token).decode()
+    except Exception as ex:
+        return None, 'Token format is wrong.'
+    parts = token.split('.')
+    if len(parts) != 4:
+        return None, 'Token format is wrong.'
+    user_str = '.'.join(parts[:3])
+    if hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest().lower() != parts[3].lower():
+        return None, 'Token is wrong.'
+    return parts[0], None
+
+
+def get_token_user(token, conn_cache):
+    """
+    Verify a token once per connection: look it up in the connection, then in token_cache, and verify it otherwise
+    :param token:
+    :param conn_cache: ConnectionCache of the connection
+    :return:
+        username, or None if the token is not valid
+        the error message
+    """
+    username = conn_cache.tokens.get(token)
+    if username is not None:
+        return username, None
+    username = token_cache.get(token)
+    if username is None:
+        username, error = verify_token(token)
+        if username is None:
+            return None, error
+        token_cache.put(token, username)
+    conn_cache.put_token(token, username)
+    return username, None
+
+
+def prepare_user_dirs(username):
+    """
+    Create the data/file/tmp/state/meta/cas directories of a user, once per process
+    :param username:
+    :return: None
+    """
+    if username in prepared_users:
+        return
+    os.makedirs(join('data', username), exist_ok=True)
+    os.makedirs(join('file', username), exist_ok=True)
+    os.makedirs(join('tmp', username), exist_ok=True)
+    os.makedirs(join('state', username), exist_ok=True)
+    os.makedirs(join('meta', username), exist_ok=True)
+    os.makedirs(join('cas', username), exist_ok=True)
+    prepared_users.add(username)
+
+
+def auth_login_process(username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    AUTH LOGIN: check the password (MD5 of the username) and return a token
+    :param username: None, LOGIN has no token
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    # Check the username and password
+    if hashlib.md5(json_data[FIELD_USERNAME].encode()).hexdigest().lower() != json_data['password'].lower():
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_LOGIN, 401, TYPE_AUTH, f'"Password error for login.', {}))
+        return
+    # Login successful
+    user_str = f'{json_data[FIELD_USERNAME].replace(".", "_")}.' \
+               f'{get_time_based_filename("login")}'
+    md5_auth_str = hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest()
+    send_buffers(connection_socket,
+                 make_response_buffers(OP_LOGIN, 200, TYPE_AUTH, f'Login successfully', {
+                                           FIELD_TOKEN: base64.b64encode(f'{user_str}.{md5_auth_str}'.encode()).decode()
+                                       }))
+
+
+# (type, operation) -> (handler, required fields, whether a token is required).
+# STEP_dispatch looks a request up here once; only requests without an entry go through the full checks.
+REQUEST_HANDLERS = {
+    (TYPE_AUTH, OP_LOGIN): (auth_login_process, (FIELD_USERNAME, FIELD_PASSWORD), False),
+    (TYPE_DATA, OP_GET): (data_get_process, (FIELD_KEY,), True),
+    (TYPE_DATA, OP_SAVE): (data_save_process, (), True),
+    (TYPE_DATA, OP_DELETE): (data_delete_process, (FIELD_KEY,), True),
+    (TYPE_FILE, OP_GET): (file_get_process, (FIELD_KEY,), True),
+    (TYPE_FILE, OP_SAVE): (file_save_process, (), True),
+    (TYPE_FILE, OP_DELETE): (file_delete_process, (FIELD_KEY,), True),
+    (TYPE_FILE, OP_STATUS): (file_status_process, (FIELD_KEY,), True),
+    (TYPE_FILE, OP_UPLOAD): (file_upload_process, (FIELD_KEY, FIELD_BLOCK_INDEX), True),
+    (TYPE_FILE, OP_DOWNLOAD): (file_download_process, (FIELD_KEY, FIELD_BLOCK_INDEX), True),
+}
+
+
+def process_request(request_type, request_operation, username, json_data, bin_data, connection_socket, conn_cache):
+    """
+    Check the required fields of a request and run its handler from REQUEST_HANDLERS
+    :param request_type:
+    :param request_operation:
+    :param username:
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    entry = REQUEST_HANDLERS.get((request_type, request_operation))
+    if entry is None:
+        return
+    handler, required_fields, _ = entry
+    for field in required_fields:
+        if field not in json_data:
+            logger.error(f'<-- Field "{field}" is missing for {request_type} {request_operation}.')
+            send_buffers(connection_socket,
+                         make_response_buffers(request_operation, 410, request_type,
+                                               f'Field "{field}" is missing for {request_type} {request_operation}.',
+                                               {}))
             return
-        logger.info(f'--> Download file/block of "key" {json_data[FIELD_KEY]}.')
-
-        if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False:
-            if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is True:
-                logger.error(
-                    f'<-- The "key" {json_data[FIELD_KEY]} is not completely uploaded. Please upload it first.')
-                connection_socket.send(
-                    make_response_packet(OP_GET, 404, TYPE_FILE,
-                                         f'The "key" {json_data[FIELD_KEY]} is not completely uploaded. '
-                                         f'Please upload it first',
-                                         {}))
-                return
-            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is not existing.', {}))
+    handler(username, json_data, bin_data, connection_socket, conn_cache)
+
+
+def STEP_dispatch(json_data, bin_data, connection_socket, conn_cache):
+    """
+    Check one STEP request and dispatch it to its handler in REQUEST_HANDLERS.
+    The response is sent through connection_socket, which needs the sendmsg() and sendfile()
+    methods of a blocking socket.
+    :param json_data:
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    if type(json_data) is tuple:
+        compact_dispatch(json_data, bin_data, connection_socket, conn_cache)
+        return
+    request_type = json_data.get(FIELD_TYPE)
+    request_operation = json_data.get(FIELD_OPERATION)
+    try:
+        entry = REQUEST_HANDLERS.get((request_type, request_operation))
+    except TypeError:
+        # Not hashable, so not a valid type or operation
+        entry = None
+    if entry is None or json_data.get(FIELD_DIRECTION) != DIR_REQUEST:
+        reject_request(json_data, connection_socket, conn_cache)
+        return
+
+    username = None
+    if entry[2]:
+        if FIELD_TOKEN not in json_data:
+            send_buffers(connection_socket,
+                         make_response_buffers(request_operation, 403, TYPE_AUTH, f'No token.', {}))
+            return
+        username, error = get_token_user(json_data[FIELD_TOKEN], conn_cache)
+        if username is None:
+            send_buffers(connection_socket,
+                         make_response_buffers(request_operation, 403, TYPE_AUTH, error, {}))
             return
+        prepare_user_dirs(username)
+
+    process_request(request_type, request_operation, username, json_data, bin_data, connection_socket, conn_cache)
 
-        if FIELD_BLOCK_INDEX not in json_data.keys():
-            logger.error(f'<-- The "block_index" is compulsory.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_index" is compulsory.', {}))
+
+def compact_dispatch(head, bin_data, connection_socket, conn_cache):
+    """
+    Serve an UPLOAD/DOWNLOAD block of the compact framing. Its session was opened by a FILE SAVE/GET of this
+    connection, which checked the token, so there is no token and no JSON to check here.
+    The response is a compact head with the status (and the block for DOWNLOAD).
+    :param head: tuple of COMPACT_HEAD
+    :param bin_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    global logger
+    opcode, session_id, block_index = head[2], head[7], head[8]
+    session = conn_cache.sessions.get(session_id)
+    if session is None:
+        logger.error(f'<-- Unknown compact session {session_id}.')
+        status_code = 403
+    elif opcode == COMPACT_UPLOAD:
+        status_code, _, _ = upload_block(session[0], session[1], block_index, bin_data, conn_cache, head[5] or 1)
+    elif opcode == COMPACT_DOWNLOAD:
+        status_code, _, fid, offset, count = download_block(session[0], session[1], session[2], block_index,
+                                                            conn_cache, head[5] or 1)
+        if status_code == 200:
+            # The head tells how many blocks of the range are sent
+            send_file_range(connection_socket,
+                            COMPACT_HEAD.pack(COMPACT_MAGIC, COMPACT_VERSION, opcode, 0, 200,
+                                              -(-count // session[2]) if head[5] else 0, count, session_id,
+                                              block_index),
+                            fid, offset, count)
             return
-        file_path = join('file', username, json_data[FIELD_KEY])
-        file_size = getsize(file_path)
-        block_size = MAX_PACKET_SIZE
-        total_block = math.ceil(file_size / block_size)
-        block_index = json_data[FIELD_BLOCK_INDEX]
-        if block_index >= total_block:
-            logger.error(f'<-- The "block_index" exceed the max index.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_index" exceed the max index.', {}))
+    else:
+        logger.error(f'<-- Compact operation {opcode} is not allowed.')
+        status_code = 408
+    # The block count of the request is echoed
+    send_buffers(connection_socket,
+                 [COMPACT_HEAD.pack(COMPACT_MAGIC, COMPACT_VERSION, opcode, 0, status_code, head[5], 0, session_id,
+                                    block_index)])
+
+
+def reject_request(json_data, connection_socket, conn_cache):
+    """
+    Answer a request that STEP_dispatch has no handler for, with the first check it fails
+    :param json_data:
+    :param connection_socket:
+    :param conn_cache: ConnectionCache of the connection
+    :return: None
+    """
+    if FIELD_DIRECTION in json_data:
+        if json_data[FIELD_DIRECTION] == DIR_EARTH:
+            send_buffers(connection_socket,
+                         make_response_buffers('3BODY', 333, 'DANGEROUS',
+                                               f'DO NOT ANSWER! DO NOT ANSWER! DO NOT ANSWER!', {}))
             return
-        if block_index < 0:
-            logger.error(f'<-- The "block_index" should >= 0.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_index" should >= 0.', {}))
+
+    compulsory_fields = [FIELD_OPERATION, FIELD_DIRECTION, FIELD_TYPE]
+
+    for _compulsory_fields in compulsory_fields:
+        if _compulsory_fields not in json_data:
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_ERROR, 400, 'ERROR',
+                                               f'Compulsory field {_compulsory_fields} is missing.',
+                                               {}))
             return
 
-        with open(file_path, 'rb') as fid:
-            fid.seek(block_size * block_index)
-            if block_size * (block_index + 1) < file_size:
-                bin_data = fid.read(block_size)
-            else:
-                bin_data = fid.read(file_size - block_size * block_index)
+    request_type = json_data[FIELD_TYPE]
+    request_operation = json_data[FIELD_OPERATION]
+    request_direction = json_data[FIELD_DIRECTION]
+
+    if request_direction != DIR_REQUEST:
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_ERROR, 407, 'ERROR', f'Wrong direction. Should be "REQUEST"', {}))
+        return
 
-            rval = {
-                FIELD_BLOCK_INDEX: block_index,
-                FIELD_KEY: json_data[FIELD_KEY],
-                FIELD_SIZE: len(bin_data)
-            }
-            logger.info(f'<-- Return block {block_index}({len(bin_data)}bytes) of "key" {json_data[FIELD_KEY]} >= 0.')
+    if request_operation not in [OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN, OP_STATUS]:
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_ERROR, 408, 'ERROR', f'Operation {request_operation} is not allowed', {}))
+        return
 
-            connection_socket.send(make_response_packet(OP_DOWNLOAD, 200, TYPE_FILE,
-                                                        'An available block.', rval, bin_data))
+    if request_type not in [TYPE_FILE, TYPE_DATA, TYPE_AUTH]:
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_ERROR, 409, 'ERROR', f'Type {request_type} is not allowed', {}))
+        return
+
+    if request_operation == OP_LOGIN:
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_LOGIN, 409, TYPE_AUTH, f'Type of LOGIN has to be AUTH.', {}))
+        return
+
+    # A valid type and operation without a handler (e.g. BYE): only the token is checked, nothing is answered
+    if FIELD_TOKEN not in json_data:
+        send_buffers(connection_socket,
+                     make_response_buffers(request_operation, 403, TYPE_AUTH, f'No token.', {}))
+        return
+    username, error = get_token_user(json_data[FIELD_TOKEN], conn_cache)
+    if username is None:
+        send_buffers(connection_socket,
+                     make_response_buffers(request_operation, 403, TYPE_AUTH, error, {}))
 
 
 def STEP_service(connection_socket, addr):
@@ -611,160 +2670,426 @@ def STEP_service(connection_socket, addr):
     :return: None
     """
     global logger
-    while True:
-        json_data, bin_data = get_tcp_packet(connection_socket)
-        json_data: dict
-        if json_data is None:
-            logger.warning('Connection is closed by client.')
-            break
-
-        if FIELD_DIRECTION in json_data:
-            if json_data[FIELD_DIRECTION] == DIR_EARTH:
-                connection_socket.send(
-                    make_response_packet('3BODY', 333, 'DANGEROUS', f'DO NOT ANSWER! DO NOT ANSWER! DO NOT ANSWER!', {}))
-                continue
+    reader = PacketReader(connection_socket)
+    conn_cache = ConnectionCache()
+    try:
+        while True:
+            json_data, bin_data = reader.read_packet()
+            json_data: dict
+            if json_data is None:
+                logger.warning('Connection is closed by client.')
+                break
 
-        compulsory_fields = [FIELD_OPERATION, FIELD_DIRECTION, FIELD_TYPE]
+            STEP_dispatch(json_data, bin_data, connection_socket, conn_cache)
+    except timeout as ex:
+        reap_connection(addr, ex)
+    finally:
+        conn_cache.close()
+        connection_socket.close()
+    logger.info(f'Connection close. {addr}')
 
-        check_ok = True
-        for _compulsory_fields in compulsory_fields:
-            if _compulsory_fields not in list(json_data.keys()):
-                connection_socket.send(
-                    make_response_packet(OP_ERROR, 400, 'ERROR', f'Compulsory field {_compulsory_fields} is missing.',
-                                         {}))
-                check_ok = False
-                break
-        if check_ok is False:
-            continue
 
-        request_type = json_data[FIELD_TYPE]
-        request_operation = json_data[FIELD_OPERATION]
-        request_direction = json_data[FIELD_DIRECTION]
+def reap_connection(addr, reason):
+    """
+    Count and log a connection the server closes because of a timeout or a deadline
+    :param addr:
+    :param reason:
+    :return: None
+    """
+    global logger, reaped_connections
+    with reaped_lock:
+        reaped_connections += 1
+        reaped = reaped_connections
+    logger.warning(f'<-- Reap connection {addr}: {str(reason) or "timed out"} ({reaped} reaped)')
 
-        if request_direction != DIR_REQUEST:
-            connection_socket.send(
-                make_response_packet(OP_ERROR, 407, 'ERROR', f'Wrong direction. Should be "REQUEST"', {}))
-            continue
 
-        if request_operation not in [OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN]:
-            connection_socket.send(
-                make_response_packet(OP_ERROR, 408, 'ERROR', f'Operation {request_operation} is not allowed', {}))
-            continue
+def make_server_socket(server_ip, server_port):
+    """
+    Create the listening TCP socket
+    :param server_ip
+    :param server_port
+    :return: the socket
+    """
+    server_socket = socket(AF_INET, SOCK_STREAM)
+    server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server_socket.bind((server_ip, int(server_port)))
+    server_socket.listen(LISTEN_BACKLOG)
+    return server_socket
 
-        if request_type not in [TYPE_FILE, TYPE_DATA, TYPE_AUTH]:
-            connection_socket.send(
-                make_response_packet(OP_ERROR, 409, 'ERROR', f'Type {request_type} is not allowed', {}))
-            continue
 
-        if request_operation == OP_LOGIN:
-            if request_type != TYPE_AUTH:
-                connection_socket.send(
-                    make_response_packet(OP_LOGIN, 409, TYPE_AUTH, f'Type of LOGIN has to be AUTH.', {}))
-                continue
+class ConnectionPool:
+    """
+    Bounded pool of daemon threads running STEP_service for the thread engine, with admission control:
+    at most `workers` connections are served at a time and at most `max_queued` more wait for a thread.
+    Threads are started on demand and then kept. Each queued connection is claimed by an idle thread, by
+    a new thread, or (all threads started and busy) by the next thread to finish, so a connection never
+    waits behind a long session while a thread could still be started.
+    """
+
+    def __init__(self, workers, max_queued):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.queue = Queue()
+        self.lock = Lock()
+        self.threads = 0
+        self.active = 0
+        # Threads waiting for a connection that no submit has claimed, and connections no thread has claimed
+        self.idle = 0
+        self.unclaimed = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    @property
+    def queued(self):
+        return self.queue.qsize()
+
+    def submit(self, connection_socket, addr):
+        """
+        :return: False if the connection is rejected (the pool and its queue are full)
+        """
+        with self.lock:
+            if self.active + self.queue.qsize() >= self.workers + self.max_queued:
+                self.rejected += 1
+                return False
+            self.accepted += 1
+            self.queue.put((connection_socket, addr))
+            if self.idle > 0:
+                self.idle -= 1
+            elif self.threads < self.workers:
+                self.threads += 1
+                th = Thread(target=self._run)
+                th.daemon = True
+                th.start()
             else:
-                if FIELD_USERNAME not in json_data.keys():
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 410, TYPE_AUTH, f'"username" has to be a field for LOGIN', {}))
-                    continue
-                if FIELD_PASSWORD not in json_data.keys():
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 410, TYPE_AUTH, f'"password" has to be a field for LOGIN', {}))
-                    continue
-
-                # Check the username and password
-                if hashlib.md5(json_data[FIELD_USERNAME].encode()).hexdigest().lower() != json_data['password'].lower():
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 401, TYPE_AUTH, f'"Password error for login.', {}))
-                    continue
-                else:
-                    # Login successful
-                    user_str = f'{json_data[FIELD_USERNAME].replace(".", "_")}.' \
-                               f'{get_time_based_filename("login")}'
-                    md5_auth_str = hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest()
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 200, TYPE_AUTH, f'Login successfully', {
-                            FIELD_TOKEN: base64.b64encode(f'{user_str}.{md5_auth_str}'.encode()).decode()
-                        }))
-                    continue
-
-        # If the operation is not LOGIN, check token
-        if FIELD_TOKEN not in json_data.keys():
-            connection_socket.send(
-                make_response_packet(request_operation, 403, TYPE_AUTH, f'No token.', {}))
-            continue
+                self.unclaimed += 1
+        return True
 
-        token = json_data[FIELD_TOKEN]
-        token = base64.b64decode(token).decode()
-        token: str
+    def _run(self):
+        global logger
+        while True:
+            connection_socket, addr = self.queue.get()
+            with self.lock:
+                self.active += 1
+            try:
+                STEP_service(connection_socket, addr)
+            except Exception as ex:
+                logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+                connection_socket.close()
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    if self.unclaimed > 0:
+                        self.unclaimed -= 1
+                    else:
+                        self.idle += 1
+
+
+def reject_connection(connection_socket):
+    """
+    Answer a connection the server has no room for with an ERROR packet carrying "retry_after", and close it.
+    :param connection_socket:
+    :return: None
+    """
+    try:
+        connection_socket.settimeout(1)
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_ERROR, 503, 'ERROR',
+                                           f'The server is busy. Retry after {RETRY_AFTER} seconds.',
+                                           {FIELD_RETRY_AFTER: RETRY_AFTER}))
+    except OSError:
+        pass
+    finally:
+        connection_socket.close()
+
+
+def tcp_listener(server_ip, server_port, server_socket=None):
+    """
+    TCP listener: liston to a port and assign TCP sub connections to the threads of a ConnectionPool
+    :param server_ip
+    :param server_port
+    :param server_socket: a listening socket to accept on (shared by the --workers processes), None to create one
+    :return: None
+    """
+    global logger
+    if server_socket is None:
+        server_socket = make_server_socket(server_ip, server_port)
+    pool = ConnectionPool(MAX_CONNECTIONS, CONNECTION_QUEUE)
+    logger.info('Server is ready!')
+    logger.info(
+        f'Start the TCP service, listing {server_port} on IP {"All available" if server_ip == "" else server_ip}')
+    while True:
+        try:
+            connection_socket, addr = server_socket.accept()
+            if not pool.submit(connection_socket, addr):
+                reject_connection(connection_socket)
+                logger.warning(f'<-- Reject connection from {addr[0]} on {addr[1]}: the server is busy. '
+                               f'({pool.active} active, {pool.queued} queued, {pool.rejected} rejected)')
+                continue
+            logger.info(f'--> New connection from {addr[0]} on {addr[1]} '
+                        f'({pool.active} active, {pool.queued} queued, {pool.rejected} rejected)')
 
-        if len(token.split('.')) != 4:
-            connection_socket.send(
-                make_response_packet(request_operation, 403, TYPE_AUTH, f'Token format is wrong.', {}))
-            continue
+        except Exception as ex:
+            logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
-        user_str = ".".join(token.split('.')[:3])
-        md5_auth_str = token.split('.')[3]
-        if hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest().lower() != md5_auth_str.lower():
-            connection_socket.send(
-                make_response_packet(request_operation, 403, TYPE_AUTH, f'Token is wrong.', {}))
-            continue
 
-        username = token.split('.')[0]
+class AsyncResponseBuffer:
+    """
+    A socket-like object handed to the synchronous STEP_dispatch by the asyncio engine.
+    Responses are collected here and written to the StreamWriter by the event loop.
+    """
 
-        os.makedirs(join('data', username), exist_ok=True)
-        os.makedirs(join('file', username), exist_ok=True)
-        os.makedirs(join('tmp', username), exist_ok=True)
+    def __init__(self):
+        self.buffers = []
 
-        if request_type == TYPE_DATA:
-            data_process(username, request_operation, json_data, connection_socket)
-            continue
+    def send(self, data):
+        self.buffers.append(data)
+        return len(data)
 
-        if request_type == TYPE_FILE:
-            file_process(username, request_operation, json_data, bin_data, connection_socket)
-            continue
+    def sendall(self, data):
+        self.buffers.append(data)
 
-    connection_socket.close()
-    logger.info(f'Connection close. {addr}')
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        self.buffers.extend(buffers)
+        return sum(len(data) for data in buffers)
+
+    def sendfile(self, file, offset=0, count=None):
+        """
+        The event loop writes from memory, so the range is read here (in the executor) with pread.
+        """
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        data = os.pread(file.fileno(), count, offset)
+        self.buffers.append(data)
+        return len(data)
+
+
+async def async_readexactly(reader, n, deadline):
+    """
+    reader.readexactly(n) before a deadline
+    :param reader: asyncio.StreamReader
+    :param n:
+    :param deadline: loop.time() by which the bytes have to be there, or None
+    :return: bytes
+    """
+    if deadline is None:
+        return await reader.readexactly(n)
+    seconds = deadline - asyncio.get_running_loop().time()
+    if seconds <= 0:
+        raise timeout('The packet is not complete before its deadline.')
+    if hasattr(asyncio, 'timeout'):
+        async with asyncio.timeout(seconds):
+            return await reader.readexactly(n)
+    return await asyncio.wait_for(reader.readexactly(n), seconds)
+
+
+async def async_get_tcp_packet(reader):
+    """
+    Receive a complete STEP "packet" from an asyncio StreamReader.
+    Same wire formats as PacketReader (JSON and compact), with its idle timeout and deadlines.
+    :param reader: asyncio.StreamReader
+    :return:
+        json_data
+        bin_data
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        first = await async_readexactly(reader, 1, loop.time() + IDLE_TIMEOUT if IDLE_TIMEOUT else None)
+        deadline = loop.time() + HEADER_DEADLINE if HEADER_DEADLINE else None
+        if first[0] == COMPACT_MAGIC:
+            head = COMPACT_HEAD.unpack(first + await async_readexactly(reader, COMPACT_HEAD.size - 1, deadline))
+            if head[1] != COMPACT_VERSION:
+                return None, None
+            if head[6] > (MAX_UPLOAD_BATCH if head[5] > 1 else MAX_BODY_SIZE):
+                logger.warning(f'Compact packet of {head[6]} bytes is too large.')
+                return None, None
+            return head, await async_readexactly(reader, head[6],
+                                                 loop.time() + BODY_DEADLINE if BODY_DEADLINE else None)
+        data = first + await async_readexactly(reader, 7, deadline)
+        j_len, b_len = struct.unpack('!II', data)
+        if j_len > MAX_JSON_SIZE or b_len > MAX_BODY_SIZE:
+            logger.warning(f'Packet of {j_len}+{b_len} bytes is too large.')
+            return None, None
+        j_bin = await async_readexactly(reader, j_len, deadline)
+        try:
+            json_data = json_loads(j_bin)
+        except Exception as ex:
+            return None, None
+        if is_oversized_batch(json_data, b_len):
+            logger.warning(f'UPLOAD batch of {b_len} bytes is too large.')
+            return None, None
+        bin_data = await async_readexactly(reader, b_len, loop.time() + BODY_DEADLINE if BODY_DEADLINE else None)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None, None
+    return json_data, bin_data
 
 
-def tcp_listener(server_ip, server_port):
+async def async_STEP_service(reader, writer):
+    """
+    STEP Protocol service for the asyncio engine.
+    Socket I/O stays on the event loop; LOGIN is answered inline, DATA/FILE requests (disk I/O)
+    run in the default executor. Requests of one connection are still processed in order.
+    :param reader: asyncio.StreamReader
+    :param writer: asyncio.StreamWriter
+    :return: None
     """
-    TCP listener: liston to a port and assign TCP sub connections using new threads
+    global logger
+    addr = writer.get_extra_info('peername')
+    logger.info(f'--> New connection from {addr[0]} on {addr[1]}')
+    loop = asyncio.get_running_loop()
+    conn_cache = ConnectionCache()
+    try:
+        while True:
+            json_data, bin_data = await async_get_tcp_packet(reader)
+            if json_data is None:
+                logger.warning('Connection is closed by client.')
+                break
+
+            response = AsyncResponseBuffer()
+            if type(json_data) is tuple or json_data.get(FIELD_TYPE) in [TYPE_FILE, TYPE_DATA]:
+                await loop.run_in_executor(None, STEP_dispatch, json_data, bin_data, response, conn_cache)
+            else:
+                STEP_dispatch(json_data, bin_data, response, conn_cache)
+
+            for data in response.buffers:
+                writer.write(data)
+            await writer.drain()
+    except (timeout, asyncio.TimeoutError) as ex:
+        reap_connection(addr, ex)
+    except ConnectionError as ex:
+        logger.warning(f'Connection error {addr}: {ex}')
+    except Exception as ex:
+        logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+    finally:
+        conn_cache.close()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+        logger.info(f'Connection close. {addr}')
+
+
+async def async_tcp_listener(server_ip, server_port, async_workers=None, server_socket=None):
+    """
+    TCP listener of the asyncio engine: one event loop with non-blocking sockets serves all connections
     :param server_ip
     :param server_port
+    :param async_workers: size of the executor for disk I/O, None for the asyncio default
+    :param server_socket: a listening socket to accept on (shared by the --workers processes), None to create one
     :return: None
     """
     global logger
-    server_socket = socket(AF_INET, SOCK_STREAM)
-    server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-    server_socket.bind((server_ip, int(server_port)))
-    server_socket.listen(20)
-    logger.info('Server is ready!')
+    loop = asyncio.get_running_loop()
+    if async_workers is not None:
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=async_workers))
+    if server_socket is None:
+        server = await asyncio.start_server(async_STEP_service, host=server_ip or None, port=int(server_port),
+                                            reuse_address=True)
+    else:
+        server = await asyncio.start_server(async_STEP_service, sock=server_socket)
+    logger.info('Server is ready! (asyncio engine)')
     logger.info(
         f'Start the TCP service, listing {server_port} on IP {"All available" if server_ip == "" else server_ip}')
-    while True:
-        try:
-            connection_socket, addr = server_socket.accept()
-            logger.info(f'--> New connection from {addr[0]} on {addr[1]}')
-            th = Thread(target=STEP_service, args=(connection_socket, addr))
-            th.daemon = True
-            th.start() 
+    async with server:
+        await server.serve_forever()
 
-        except Exception as ex:
-            logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+
+def serve(server_ip, server_port, engine, async_workers=None, server_socket=None):
+    """
+    Run the TCP service with the chosen engine
+    :param server_ip
+    :param server_port
+    :param engine: thread or asyncio
+    :param async_workers: see async_tcp_listener
+    :param server_socket: see tcp_listener
+    :return: None
+    """
+    if engine == 'asyncio':
+        asyncio.run(async_tcp_listener(server_ip, server_port, async_workers, server_socket))
+    else:
+        tcp_listener(server_ip, server_port, server_socket)
+
+
+def serve_workers(server_ip, server_port, workers, engine, async_workers=None):
+    """
+    Pre-fork mode: the listening socket is created here and shared by `workers` forked processes, which all
+    accept on it with the chosen engine, so that JSON, hashing and packet building use several cores.
+    A block of an upload may reach any worker, so the upload state is the shared sidecar file
+    (SharedUploadState). A worker that exits is replaced.
+    :param server_ip
+    :param server_port
+    :param workers: number of worker processes
+    :param engine: thread or asyncio
+    :param async_workers: see async_tcp_listener
+    :return: None
+    """
+    global logger, upload_state_type
+    upload_state_type = SharedUploadState
+    server_socket = make_server_socket(server_ip, server_port)
+    children = set()
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                serve(server_ip, server_port, engine, async_workers, server_socket)
+            except KeyboardInterrupt:
+                status = 0
+            except Exception as ex:
+                logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
+            finally:
+                os._exit(status)
+        children.add(pid)
+
+    for _ in range(workers):
+        start_worker()
+    logger.info(f'{workers} workers are started: {sorted(children)}')
+    while True:
+        pid, status = os.wait()
+        if pid in children:
+            children.discard(pid)
+            logger.error(f'Worker {pid} exited (status {status}). Start a new one.')
+            start_worker()
 
 
 def main():
-    global logger
+    global logger, MIN_BLOCK_SIZE, MAX_BLOCK_SIZE, MAX_FILE_SIZE, MAX_BODY_SIZE, DOWNLOAD_OPEN_FILES, MAX_DOWNLOAD_RANGE, MAX_UPLOAD_BATCH, DEDUP
+    global MAX_CONNECTIONS, CONNECTION_QUEUE, LISTEN_BACKLOG
+    global IDLE_TIMEOUT, READ_TIMEOUT, HEADER_DEADLINE, BODY_DEADLINE
     logger = set_logger('STEP')
     parser = _argparse()
     server_ip = parser.ip
     server_port = parser.port
+    MIN_BLOCK_SIZE = parser.min_block_size
+    MAX_BLOCK_SIZE = parser.max_block_size
+    file_meta_cache.capacity = parser.meta_cache_size
+    token_cache.capacity = parser.token_cache_size
+    logger.info(f'JSON codec: {set_json_codec(parser.json_codec)}')
+    DOWNLOAD_OPEN_FILES = parser.download_open_files
+    MAX_DOWNLOAD_RANGE = parser.max_download_range
+    MAX_UPLOAD_BATCH = parser.max_upload_batch
+    MAX_FILE_SIZE = parser.max_file_size
+    MAX_BODY_SIZE = max(MAX_BLOCK_SIZE, MAX_UPLOAD_BATCH)
+    DEDUP = parser.dedup
+    upload_file_pool.capacity = parser.upload_open_files
+    MAX_CONNECTIONS = parser.max_connections
+    CONNECTION_QUEUE = parser.connection_queue
+    LISTEN_BACKLOG = parser.backlog
+    IDLE_TIMEOUT = parser.idle_timeout
+    READ_TIMEOUT = parser.read_timeout
+    HEADER_DEADLINE = parser.header_deadline
+    BODY_DEADLINE = parser.body_deadline
 
     os.makedirs('data', exist_ok=True)
     os.makedirs('file', exist_ok=True)
+    os.makedirs('meta', exist_ok=True)
+    os.makedirs('cas', exist_ok=True)
 
-    tcp_listener(server_ip, server_port)
+    if parser.workers > 1:
+        serve_workers(server_ip, server_port, parser.workers, parser.engine, parser.async_workers)
+    else:
+        serve(server_ip, server_port, parser.engine, parser.async_workers)
 
 
 if __name__ == '__main__':
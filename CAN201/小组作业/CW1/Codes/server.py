@@ -4,7 +4,7 @@ import os
 from os.path import join, getsize
 import hashlib
 import argparse
-from threading import Thread
+from threading import Thread, Lock
 import time
 import logging
 from logging.handlers import TimedRotatingFileHandler
@@ -13,8 +13,20 @@ import uuid
 import math
 import shutil
 import struct
+import mmap
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 MAX_PACKET_SIZE = 20480
+# File hashing: read size, and the file size from which mmap is used
+HASH_BUFFER_SIZE = 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+# Largest JSON section and binary section (one block) of a request packet. A larger length in a header
+# closes the connection before anything is allocated for it.
+MAX_JSON_SIZE = 1024 * 1024
+MAX_BODY_SIZE = MAX_PACKET_SIZE
 
 # Const Value
 OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN, OP_ERROR = 'SAVE', 'DELETE', 'GET', 'UPLOAD', 'DOWNLOAD', 'BYE', 'LOGIN', "ERROR"
@@ -25,6 +37,57 @@ FIELD_STATUS, FIELD_STATUS_MSG, FIELD_BLOCK_INDEX = 'status', 'status_msg', 'blo
 DIR_REQUEST, DIR_RESPONSE = 'REQUEST', 'RESPONSE'
 
 logger = logging.getLogger('')
+# (username, key) -> UploadState of the uploads in progress
+upload_states = {}
+# (username, key) -> Lock of the upload: blocks of one upload may come over several connections at once
+upload_locks = {}
+upload_meta_lock = Lock()
+
+
+def new_digest(algorithm='md5'):
+    """
+    Create a hash object: md5, sha1, sha256, blake2b, or xxh64/xxh3_64/xxh3_128 if xxhash is installed.
+    :param algorithm:
+    :return: the hash object, or None if the algorithm is not available
+    """
+    if algorithm in ('md5', 'sha1', 'sha256', 'blake2b'):
+        return hashlib.new(algorithm)
+    if xxhash is not None and algorithm in ('xxh64', 'xxh3_64', 'xxh3_128'):
+        return getattr(xxhash, algorithm)()
+    return None
+
+
+def get_file_digest(filename, algorithm='md5', buffer_size=None, mmap_threshold=None):
+    """
+    Get the digest of a big file.
+    Reads HASH_BUFFER_SIZE at a time with readinto into one reused buffer; files of HASH_MMAP_THRESHOLD
+    or more are hashed through mmap instead (no read copies at all).
+    :param filename:
+    :param algorithm: see new_digest
+    :param buffer_size: default HASH_BUFFER_SIZE
+    :param mmap_threshold: default HASH_MMAP_THRESHOLD, 0 to never use mmap
+    :return: hex digest
+    """
+    buffer_size = HASH_BUFFER_SIZE if buffer_size is None else buffer_size
+    mmap_threshold = HASH_MMAP_THRESHOLD if mmap_threshold is None else mmap_threshold
+    m = new_digest(algorithm)
+    with open(filename, 'rb', buffering=0) as fid:
+        size = os.fstat(fid.fileno()).st_size
+        if 0 < mmap_threshold <= size:
+            with mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                for offset in range(0, size, buffer_size):
+                    m.update(view[offset:offset + buffer_size])
+                view.release()
+        else:
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                n = fid.readinto(buffer)
+                if not n:
+                    break
+                m.update(view[:n])
+    return m.hexdigest()
 
 
 def get_file_md5(filename):
@@ -33,14 +96,236 @@ def get_file_md5(filename):
     :param filename:
     :return:
     """
-    m = hashlib.md5()
-    with open(filename, 'rb') as fid:
-        while True:
-            d = fid.read(2048)
-            if not d:
-                break
-            m.update(d)
-    return m.hexdigest()
+    return get_file_digest(filename, 'md5')
+
+
+def save_file_md5(username, key, md5):
+    """
+    Save the MD5 of a stored file to meta/<username>/<key>, together with the size, mtime and inode
+    of the file, so that GET does not have to read the whole file again.
+    :param username:
+    :param key:
+    :param md5:
+    :return: None
+    """
+    st = os.stat(join('file', username, key))
+    with open(join('meta', username, key), 'w') as fid:
+        json.dump({'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'ino': st.st_ino, 'md5': md5}, fid)
+
+
+def get_stored_file_md5(username, key):
+    """
+    MD5 of a stored file: the saved one if the file has not changed since (same size, mtime and inode),
+    otherwise it is computed from the file and saved again.
+    :param username:
+    :param key:
+    :return: md5
+    """
+    file_path = join('file', username, key)
+    st = os.stat(file_path)
+    try:
+        with open(join('meta', username, key), 'r') as fid:
+            meta = json.load(fid)
+        if (meta['size'], meta['mtime_ns'], meta['ino']) == (st.st_size, st.st_mtime_ns, st.st_ino):
+            return meta['md5']
+    except (OSError, ValueError, KeyError):
+        pass
+    md5 = get_file_md5(file_path)
+    save_file_md5(username, key, md5)
+    return md5
+
+
+def remove_file_md5(username, key):
+    """
+    Remove the saved MD5 of a deleted file.
+    """
+    try:
+        os.remove(join('meta', username, key))
+    except FileNotFoundError:
+        pass
+
+
+class UploadState:
+    """
+    Progress of one upload: a bitmap of the received blocks (one bit per block) and a counter.
+    It is checkpointed to a small sidecar file (see get_state_path) every CHECKPOINT_BLOCKS new blocks
+    or CHECKPOINT_SECONDS, so an upload can be continued after a server restart.
+    """
+    CHECKPOINT_BLOCKS = 1024
+    CHECKPOINT_SECONDS = 5.0
+    # magic, total block, block size, received blocks; followed by the bitmap
+    HEADER = struct.Struct('!4sQQQ')
+    MAGIC = b'STEP'
+
+    def __init__(self, path, total, block_size, bitmap=None, received=0):
+        self.path = path
+        self.total = total
+        self.block_size = block_size
+        self.bitmap = bytearray((total + 7) // 8) if bitmap is None else bitmap
+        self.received = received
+        # MD5 of the blocks [0, hashed), see update_md5
+        self.md5 = hashlib.md5()
+        self.md5_lock = Lock()
+        self.hashed = 0
+        # Set when the upload is completed or deleted; the state is no longer used then
+        self.finished = False
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    def has(self, block_index):
+        return self.bitmap[block_index >> 3] & (1 << (block_index & 7)) != 0
+
+    def add(self, block_index):
+        """
+        Mark a block as received and checkpoint if it is time to.
+        :return: True if the block is new
+        """
+        if self.has(block_index):
+            return False
+        self.bitmap[block_index >> 3] |= 1 << (block_index & 7)
+        self.received += 1
+        self.unsaved += 1
+        if self.unsaved >= self.CHECKPOINT_BLOCKS or time.monotonic() - self.saved_at >= self.CHECKPOINT_SECONDS:
+            self.checkpoint()
+        return True
+
+    def is_complete(self):
+        return self.received == self.total
+
+    def claim_finish(self):
+        """
+        Called under the lock of the upload by a request that sees the upload complete.
+        :return: True for exactly one caller, which then moves the tmp file
+        """
+        if self.finished:
+            return False
+        self.finished = True
+        return True
+
+    def update_md5(self, file_path, block_index, bin_data):
+        """
+        Feed the MD5 with the contiguous prefix of received blocks, so that the digest is ready when the
+        last block arrives. The new block is hashed from memory if it extends the prefix; blocks received
+        earlier out of order (or before a restart) are read back from the tmp file when the prefix reaches them.
+        One thread hashes at a time. A thread that finds the MD5 busy returns at once: the hashing thread
+        checks the prefix again after releasing the lock, so the block is not missed.
+        :param file_path: the tmp file
+        :param block_index: the block just received (already added)
+        :param bin_data: its data
+        :return: None
+        """
+        while self.hashed < self.total and self.has(self.hashed):
+            if not self.md5_lock.acquire(blocking=False):
+                return
+            fid = None
+            try:
+                while self.hashed < self.total and self.has(self.hashed):
+                    if self.hashed == block_index:
+                        self.md5.update(bin_data)
+                    else:
+                        # The tmp file is opened only if a block has to be read back
+                        if fid is None:
+                            fid = open(file_path, 'rb')
+                        self.md5.update(os.pread(fid.fileno(), self.block_size, self.hashed * self.block_size))
+                    self.hashed += 1
+            finally:
+                if fid is not None:
+                    fid.close()
+                self.md5_lock.release()
+
+    def get_md5(self, file_path):
+        """
+        MD5 of the completed upload. The part of the file not hashed yet (none, unless the state was
+        loaded from a checkpoint) is read back from the tmp file.
+        """
+        with self.md5_lock:
+            if self.hashed < self.total:
+                with open(file_path, 'rb') as fid:
+                    while self.hashed < self.total:
+                        self.md5.update(os.pread(fid.fileno(), self.block_size, self.hashed * self.block_size))
+                        self.hashed += 1
+            return self.md5.hexdigest()
+
+    def checkpoint(self):
+        """
+        Write the sidecar file (atomically, through a temporary file).
+        """
+        with open(self.path + '.part', 'wb') as fid:
+            fid.write(self.HEADER.pack(self.MAGIC, self.total, self.block_size, self.received))
+            fid.write(self.bitmap)
+        os.replace(self.path + '.part', self.path)
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    def remove(self):
+        """
+        Delete the sidecar file when the upload is completed or deleted.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a sidecar file written by checkpoint().
+        :return: UploadState, or None if there is no valid sidecar file
+        """
+        try:
+            with open(path, 'rb') as fid:
+                raw = fid.read()
+        except OSError:
+            return None
+        if len(raw) < cls.HEADER.size:
+            return None
+        magic, total, block_size, received = cls.HEADER.unpack_from(raw)
+        bitmap = bytearray(raw[cls.HEADER.size:])
+        if magic != cls.MAGIC or len(bitmap) != (total + 7) // 8:
+            return None
+        return cls(path, total, block_size, bitmap, received)
+
+
+def get_state_path(username, key):
+    """
+    Sidecar file of the upload of key: state/<username>/<key>.state, so that tmp/ holds only the data of keys.
+    Sidecars end with ".state" and their temporary files with ".state.part", so neither is another one.
+    """
+    return join('state', username, key) + '.state'
+
+
+def get_upload_state(username, key):
+    """
+    The UploadState of an upload in progress, reloaded from its sidecar file after a restart.
+    :return: UploadState or None
+    """
+    state = upload_states.get((username, key))
+    if state is None:
+        state = UploadState.load(get_state_path(username, key))
+        if state is not None:
+            upload_states[(username, key)] = state
+    return state
+
+
+def get_upload_lock(state_key):
+    """
+    The lock of the upload of state_key (username, key), created if needed.
+    """
+    with upload_meta_lock:
+        if state_key not in upload_locks:
+            upload_locks[state_key] = Lock()
+        return upload_locks[state_key]
+
+
+def cleanup_upload_lock(state_key):
+    """
+    Drop the lock of a completed or deleted upload, unless a request holds it.
+    """
+    with upload_meta_lock:
+        lock = upload_locks.get(state_key)
+        if lock is not None and lock.acquire(blocking=False):
+            lock.release()
+            upload_locks.pop(state_key, None)
 
 
 def get_time_based_filename(ext, prefix='', t=None):
@@ -101,26 +386,37 @@ def _argparse():
     return parse.parse_args()
 
 
+def make_packet_buffers(json_data, bin_data=None):
+    """
+    Make a packet following the STEP protocol as a list of buffers: the two lengths, the json section
+    and a memoryview of the binary data. Send it with send_buffers, the data is never copied.
+    :param json_data:
+    :param bin_data:
+    :return:
+        [header, json bytes] or [header, json bytes, memoryview of bin_data]
+    """
+    j = json.dumps(dict(json_data), ensure_ascii=False).encode()
+    if bin_data is None:
+        return [struct.pack('!II', len(j), 0), j]
+    else:
+        return [struct.pack('!II', len(j), len(bin_data)), j, memoryview(bin_data)]
+
+
 def make_packet(json_data, bin_data=None):
     """
     Make a packet following the STEP protocol.
-    Any information or data for TCP transmission has to use this function to get the packet.
+    Any information or data for TCP transmission has to use this function or make_packet_buffers.
     :param json_data:
     :param bin_data:
     :return:
         The complete binary packet
     """
-    j = json.dumps(dict(json_data), ensure_ascii=False)
-    j_len = len(j)
-    if bin_data is None:
-        return struct.pack('!II', j_len, 0) + j.encode()
-    else:
-        return struct.pack('!II', j_len, len(bin_data)) + j.encode() + bin_data
+    return b''.join(make_packet_buffers(json_data, bin_data))
 
 
-def make_response_packet(operation, status_code, data_type, status_msg, json_data, bin_data=None):
+def make_response_buffers(operation, status_code, data_type, status_msg, json_data, bin_data=None):
     """
-    Make a packet for response
+    Make a packet for response as a list of buffers, see make_packet_buffers
     :param operation: [SAVE, DELETE, GET, UPLOAD, DOWNLOAD, BYE, LOGIN]
     :param status_code: 200 or 400+
     :param data_type: [FILE, DATA, AUTH]
@@ -134,50 +430,74 @@ def make_response_packet(operation, status_code, data_type, status_msg, json_dat
     json_data[FIELD_STATUS] = status_code
     json_data[FIELD_STATUS_MSG] = status_msg
     json_data[FIELD_TYPE] = data_type
-    return make_packet(json_data, bin_data)
+    return make_packet_buffers(json_data, bin_data)
+
+
+def send_buffers(conn, buffers, flags=0):
+    """
+    Send a packet made of several buffers with sendmsg (scatter-gather), without joining them.
+    Partial sends are continued. Without sendmsg (e.g. on Windows) the buffers are joined and sent with sendall.
+    :param conn: the TCP connection
+    :param buffers: list of bytes-like objects
+    :param flags: flags of sendmsg
+    :return: None
+    """
+    if not hasattr(conn, 'sendmsg'):
+        conn.sendall(b''.join(buffers))
+        return
+    buffers = list(buffers)
+    while buffers:
+        sent = conn.sendmsg(buffers, [], flags)
+        done = 0
+        while done < len(buffers) and sent >= len(buffers[done]):
+            sent -= len(buffers[done])
+            done += 1
+        del buffers[:done]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
+def recv_exactly_into(conn, view):
+    """
+    Fill the whole buffer from the TCP stream with recv_into (no intermediate bytes objects).
+    :param conn: the TCP connection
+    :param view: a writable memoryview to fill
+    :return: True if the buffer is filled, False if the connection is closed
+    """
+    while len(view) > 0:
+        n = conn.recv_into(view)
+        if n == 0:
+            return False
+        view = view[n:]
+    return True
 
 
 def get_tcp_packet(conn):
     """
     Receive a complete TCP "packet" from a TCP stream and get the json data and binary data.
+    The json section and the binary section are received into one preallocated bytearray,
+    and the binary data is returned as a memoryview of it (no copy).
     :param conn: the TCP connection
     :return:
         json_data
-        bin_data
-    """
-    bin_data = b''
-    while len(bin_data) < 8:
-        data_rec = conn.recv(8)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
-    data = bin_data[:8]
-    bin_data = bin_data[8:]
-    j_len, b_len = struct.unpack('!II', data)
-    while len(bin_data) < j_len:
-        data_rec = conn.recv(j_len)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
-    j_bin = bin_data[:j_len]
-
+        bin_data (memoryview)
+    """
+    header = bytearray(8)
+    if not recv_exactly_into(conn, memoryview(header)):
+        return None, None
+    j_len, b_len = struct.unpack('!II', header)
+    if j_len > MAX_JSON_SIZE or b_len > MAX_BODY_SIZE:
+        return None, None
+    buffer = memoryview(bytearray(j_len + b_len))
+    if not recv_exactly_into(conn, buffer[:j_len]):
+        return None, None
     try:
-        json_data = json.loads(j_bin.decode())
+        json_data = json.loads(str(buffer[:j_len], 'utf-8'))
     except Exception as ex:
         return None, None
-
-    bin_data = bin_data[j_len:]
-    while len(bin_data) < b_len:
-        data_rec = conn.recv(b_len)
-        if data_rec == b'':
-            time.sleep(0.01)
-        if data_rec == b'':
-            return None, None
-        bin_data += data_rec
+    bin_data = buffer[j_len:]
+    if not recv_exactly_into(conn, bin_data):
+        return None, None
     return json_data, bin_data
 
 
@@ -195,21 +515,22 @@ def data_process(username, request_operation, json_data, connection_socket):
         if FIELD_KEY not in json_data.keys():
             logger.info(f'<-- Get data without key.')
             logger.error(f'<-- Field "key" is missing for DATA GET.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_DATA, f'Field "key" is missing for DATA GET.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 410, TYPE_DATA, f'Field "key" is missing for DATA GET.', {}))
             return
         logger.info(f'--> Get data {json_data[FIELD_KEY]}')
         if os.path.exists(join('data', username, json_data[FIELD_KEY])) is False:
             logger.error(f'<-- The key {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_DATA, f'The key {json_data[FIELD_KEY]} is not existing.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 404, TYPE_DATA,
+                                               f'The key {json_data[FIELD_KEY]} is not existing.', {}))
             return
         try:
             with open(join('data', username, json_data[FIELD_KEY]), 'r') as fid:
                 data_from_file = json.load(fid)
                 logger.info(f'<-- Find the data and return to client.')
-                connection_socket.send(
-                    make_response_packet(OP_GET, 200, TYPE_DATA, f'OK', data_from_file))
+                send_buffers(connection_socket,
+                             make_response_buffers(OP_GET, 200, TYPE_DATA, f'OK', data_from_file))
         except Exception as ex:
             logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
@@ -220,14 +541,16 @@ def data_process(username, request_operation, json_data, connection_socket):
         logger.info(f'--> Save data with key "{key}"')
         if os.path.exists(join('data', username, key)) is True:
             logger.error(f'<-- This key "{key}" is existing.')
-            connection_socket.send(make_response_packet(OP_SAVE, 402, TYPE_DATA, f'This key "{key}" is existing.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_SAVE, 402, TYPE_DATA, f'This key "{key}" is existing.', {}))
             return
         try:
             with open(join('data', username, key), 'w') as fid:
                 json.dump(json_data, fid)
                 logger.error(f'<-- Data is saved with key "{key}"')
-                connection_socket.send(
-                    make_response_packet(OP_SAVE, 200, TYPE_DATA, f'Data is saved with key "{key}"', {FIELD_KEY: key}))
+                send_buffers(connection_socket,
+                             make_response_buffers(OP_SAVE, 200, TYPE_DATA,
+                                                   f'Data is saved with key "{key}"', {FIELD_KEY: key}))
         except Exception as ex:
             logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
@@ -235,21 +558,24 @@ def data_process(username, request_operation, json_data, connection_socket):
         if FIELD_KEY not in json_data.keys():
             logger.info(f'--> Delete data without any key.')
             logger.error(f'<-- Field "key" is missing for DATA delete.')
-            connection_socket.send(
-                make_response_packet(OP_DELETE, 410, TYPE_DATA, f'Field "key" is missing for DATA delete.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_DELETE, 410, TYPE_DATA,
+                                               f'Field "key" is missing for DATA delete.', {}))
             return
         if os.path.exists(join('data', username, json_data[FIELD_KEY])) is False:
             logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_DELETE, 404, TYPE_DATA, f'The "key" {json_data[FIELD_KEY]} is not existing.',
-                                     {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_DELETE, 404, TYPE_DATA,
+                                               f'The "key" {json_data[FIELD_KEY]} is not existing.',
+                                               {}))
             return
         try:
             os.remove(join('data', username, json_data[FIELD_KEY]))
             logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is deleted.')
-            connection_socket.send(
-                make_response_packet(OP_DELETE, 200, TYPE_DATA, f'The "key" {json_data[FIELD_KEY]} is deleted.',
-                                     {FIELD_KEY: json_data[FIELD_KEY]}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_DELETE, 200, TYPE_DATA,
+                                               f'The "key" {json_data[FIELD_KEY]} is deleted.',
+                                               {FIELD_KEY: json_data[FIELD_KEY]}))
         except Exception as ex:
             logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
@@ -269,30 +595,31 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
         if FIELD_KEY not in json_data.keys():
             logger.info(f'<-- Get file without key.')
             logger.error(f'<-- Field "key" is missing for DATA GET.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for FILE GET.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for FILE GET.', {}))
             return
         logger.info(f'--> Plan to download file with "key" {json_data[FIELD_KEY]}')
         if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False and os.path.exists(
                 join('tmp', username, json_data[FIELD_KEY])) is False:
             logger.error(f'<-- The key {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_FILE, f'The key {json_data[FIELD_KEY]} is not existing.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                               f'The key {json_data[FIELD_KEY]} is not existing.', {}))
             return
 
         if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False and os.path.exists(
                 join('tmp', username, json_data[FIELD_KEY])) is True:
             logger.error(f'<-- The key {json_data[FIELD_KEY]} is not completely uploaded.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_FILE,
-                                     f'The key {json_data[FIELD_KEY]} is not completely uploaded.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                               f'The key {json_data[FIELD_KEY]} is not completely uploaded.', {}))
             return
 
         file_path = join('file', username, json_data[FIELD_KEY])
         file_size = getsize(file_path)
         block_size = MAX_PACKET_SIZE
         total_block = math.ceil(file_size / block_size)
-        md5 = get_file_md5(file_path)
+        md5 = get_stored_file_md5(username, json_data[FIELD_KEY])
         # Download Plan
         rval = {
             FIELD_KEY: json_data[FIELD_KEY],
@@ -302,8 +629,8 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
             FIELD_MD5: md5
         }
         logger.info(f'<-- Plan: file size {file_size}, total block number {FIELD_TOTAL_BLOCK}.')
-        connection_socket.send(
-            make_response_packet(OP_GET, 200, TYPE_FILE, f'OK. This is the download plan.', rval))
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_GET, 200, TYPE_FILE, f'OK. This is the download plan.', rval))
         return
 
     if request_operation == OP_SAVE:
@@ -313,12 +640,13 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
         logger.info(f'--> Plan to save/upload a file with key "{key}"')
         if os.path.exists(join('file', username, key)) is True:
             logger.error(f'<-- This key "{key}" is existing.')
-            connection_socket.send(make_response_packet(OP_SAVE, 402, TYPE_FILE, f'This "key" {key} is existing.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_SAVE, 402, TYPE_FILE, f'This "key" {key} is existing.', {}))
             return
         if FIELD_SIZE not in json_data.keys():
             logger.error(f'<-- This file "size" has to be included.')
-            connection_socket.send(
-                make_response_packet(OP_SAVE, 402, TYPE_FILE, f'This file "size" has to be included', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_SAVE, 402, TYPE_FILE, f'This file "size" has to be included', {}))
             return
         file_size = json_data[FIELD_SIZE]
         block_size = MAX_PACKET_SIZE
@@ -330,17 +658,22 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
                 FIELD_TOTAL_BLOCK: total_block,
                 FIELD_BLOCK_SIZE: block_size,
             }
-            # Write a tmp file
-            with open(join('tmp', username, key), 'wb+') as fid:
-                fid.seek(file_size - 1)
-                fid.write(b'\0')
-
-            fid = open(join('tmp', username, key + '.log'), 'w')
-            fid.close()
+            with get_upload_lock((username, key)):
+                # Write a tmp file
+                with open(join('tmp', username, key), 'wb+') as fid:
+                    fid.seek(file_size - 1)
+                    fid.write(b'\0')
+
+                state = UploadState(get_state_path(username, key), total_block, block_size)
+                state.checkpoint()
+                replaced = upload_states.get((username, key))
+                if replaced is not None:
+                    replaced.finished = True
+                upload_states[(username, key)] = state
 
             logger.error(f'<-- Upload plan: key {key}, total block number {total_block}, block size {block_size}.')
-            connection_socket.send(
-                make_response_packet(OP_SAVE, 200, TYPE_FILE, f'This is the upload plan.', rval))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_SAVE, 200, TYPE_FILE, f'This is the upload plan.', rval))
         except Exception as ex:
             logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
@@ -348,35 +681,44 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
         if FIELD_KEY not in json_data.keys():
             logger.info(f'--> Delete file without any key.')
             logger.error(f'<-- Field "key" is missing for FILE delete.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for FILE delete.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for FILE delete.', {}))
             return
 
         if os.path.exists(join('file', username, json_data[FIELD_KEY])) is False:
             if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is True:
+                state_key = (username, json_data[FIELD_KEY])
                 try:
-                    os.remove(join('tmp', username, json_data[FIELD_KEY]))
-                    os.remove(join('tmp', username, json_data[FIELD_KEY]) + '.log')
+                    with get_upload_lock(state_key):
+                        os.remove(join('tmp', username, json_data[FIELD_KEY]))
+                        state = upload_states.pop(state_key, None)
+                        if state is not None:
+                            state.finished = True
+                        if os.path.exists(get_state_path(username, json_data[FIELD_KEY])):
+                            os.remove(get_state_path(username, json_data[FIELD_KEY]))
+                    cleanup_upload_lock(state_key)
                 except Exception as ex:
                     logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
                 logger.error(
                     f'<-- The "key" {json_data[FIELD_KEY]} is not completely uploaded. The tmp files are deleted.')
-                connection_socket.send(
-                    make_response_packet(OP_GET, 404, TYPE_FILE,
-                                         f'The "key" {json_data[FIELD_KEY]} is not completely uploaded. '
-                                         f'The tmp files are deleted.',
-                                         {}))
+                send_buffers(connection_socket,
+                             make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                                   f'The "key" {json_data[FIELD_KEY]} is not completely uploaded. '
+                                                   f'The tmp files are deleted.',
+                                                   {}))
                 return
             logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is not existing.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                               f'The "key" {json_data[FIELD_KEY]} is not existing.', {}))
             return
         try:
             os.remove(join('file', username, json_data[FIELD_KEY]))
+            remove_file_md5(username, json_data[FIELD_KEY])
             logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is deleted.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 200, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is deleted.',
-                                     {FIELD_KEY: json_data[FIELD_KEY]}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 200, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is deleted.',
+                                               {FIELD_KEY: json_data[FIELD_KEY]}))
         except Exception as ex:
             logger.error(f'{str(ex)}@{ex.__traceback__.tb_lineno}')
 
@@ -384,30 +726,32 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
         if FIELD_KEY not in json_data.keys():
             logger.info(f'--> Upload file/block without any key.')
             logger.error(f'<-- Field "key" is missing for FILE block uploading.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 410, TYPE_FILE, f'Field "key" is missing for FILE uploading.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_UPLOAD, 410, TYPE_FILE,
+                                               f'Field "key" is missing for FILE uploading.', {}))
             return
         logger.info(f'--> Upload file/block of "key" {json_data[FIELD_KEY]}.')
 
         if os.path.exists(join('file', username, json_data[FIELD_KEY])) is True:
             logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is completely uploaded.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 408, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is completely uploaded.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_UPLOAD, 408, TYPE_FILE,
+                                               f'The "key" {json_data[FIELD_KEY]} is completely uploaded.', {}))
             return
 
         if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is False:
             logger.error(
                 f'<-- The "key" {json_data[FIELD_KEY]} is not accepted for uploading.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 408, TYPE_FILE,
-                                     f'The "key" {json_data[FIELD_KEY]} is not accepted for uploading.',
-                                     {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_UPLOAD, 408, TYPE_FILE,
+                                               f'The "key" {json_data[FIELD_KEY]} is not accepted for uploading.',
+                                               {}))
             return
 
         if FIELD_BLOCK_INDEX not in json_data.keys():
             logger.error(f'<-- The "block_index" is compulsory.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 410, TYPE_FILE, f'The "block_index" is compulsory.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_UPLOAD, 410, TYPE_FILE, f'The "block_index" is compulsory.', {}))
             return
         file_path = join('tmp', username, json_data[FIELD_KEY])
         file_size = getsize(file_path)
@@ -416,53 +760,81 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
         block_index = json_data[FIELD_BLOCK_INDEX]
         if block_index >= total_block:
             logger.error(f'<-- The "block_index" exceed the max index.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 405, TYPE_FILE, f'The "block_index" exceed the max index.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_UPLOAD, 405, TYPE_FILE,
+                                               f'The "block_index" exceed the max index.', {}))
             return
         if block_index < 0:
             logger.error(f'<-- The "block_index" should >= 0.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 410, TYPE_FILE, f'The "block_index" should >= 0.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_UPLOAD, 410, TYPE_FILE, f'The "block_index" should >= 0.', {}))
             return
         if block_index == total_block - 1 and len(bin_data) != file_size - block_size * block_index:
             logger.error(f'<-- The "block_size" is wrong.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 406, TYPE_FILE, f'The "block_size" is wrong.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_UPLOAD, 406, TYPE_FILE, f'The "block_size" is wrong.', {}))
             return
 
         if block_index != total_block - 1 and len(bin_data) != block_size:
             logger.error(f'<-- The "block_size" is wrong.')
-            connection_socket.send(
-                make_response_packet(OP_UPLOAD, 406, TYPE_FILE, f'The "block_size" is wrong.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_UPLOAD, 406, TYPE_FILE, f'The "block_size" is wrong.', {}))
             return
 
-        with open(file_path, 'rb+') as fid:
-            fid.seek(block_size * block_index)
-            fid.write(bin_data)
-        with open(file_path + '.log', 'a') as fid:
-            fid.write(f'{block_index}\n')
-        fid = open(file_path + '.log', 'r')
-        lines = fid.readlines()
-        fid.close()
+        state_key = (username, json_data[FIELD_KEY])
         rval = {
             FIELD_KEY: json_data[FIELD_KEY],
             FIELD_BLOCK_INDEX: block_index
         }
-        if len(set(lines)) == total_block:
-            md5 = get_file_md5(file_path)
-            rval[FIELD_MD5] = md5
-            os.remove(file_path + '.log')
-            shutil.move(file_path, join('file', username, json_data[FIELD_KEY]))
-        connection_socket.send(
-            make_response_packet(OP_UPLOAD, 200, TYPE_FILE, f'The block {block_index} is uploaded.', rval))
+        upload_complete = False
+        new_block = False
+        # Writing the block, recording it and completing the upload are serialized per key; exactly one
+        # request claims the completion and moves the tmp file. The MD5 has its own lock.
+        with get_upload_lock(state_key):
+            tmp_missing = os.path.exists(file_path) is False
+            if not tmp_missing:
+                with open(file_path, 'rb+') as fid:
+                    fid.seek(block_size * block_index)
+                    fid.write(bin_data)
+                state = get_upload_state(username, json_data[FIELD_KEY])
+                if state is None:
+                    state = UploadState(get_state_path(username, json_data[FIELD_KEY]), total_block, block_size)
+                    upload_states[state_key] = state
+                new_block = state.add(block_index)
+                upload_complete = state.is_complete() and state.claim_finish()
+                if upload_complete:
+                    md5 = state.get_md5(file_path)
+                    rval[FIELD_MD5] = md5
+                    state.remove()
+                    upload_states.pop(state_key, None)
+                    shutil.move(file_path, join('file', username, json_data[FIELD_KEY]))
+                    save_file_md5(username, json_data[FIELD_KEY], md5)
+        if upload_complete:
+            cleanup_upload_lock(state_key)
+        elif new_block and not state.finished:
+            try:
+                state.update_md5(file_path, block_index, bin_data)
+            except FileNotFoundError:
+                # Deleted since; the state is not used any more
+                pass
+        if tmp_missing:
+            # Completed or deleted by another connection since the checks above
+            logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is completely uploaded.')
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_UPLOAD, 408, TYPE_FILE,
+                                               f'The "key" {json_data[FIELD_KEY]} is completely uploaded.', {}))
+            return
+        send_buffers(connection_socket,
+                     make_response_buffers(OP_UPLOAD, 200, TYPE_FILE, f'The block {block_index} is uploaded.', rval))
         return
 
     if request_operation == OP_DOWNLOAD:
         if FIELD_KEY not in json_data.keys():
             logger.info(f'--> Download file/block without any key.')
             logger.error(f'<-- Field "key" is missing for FILE block downloading.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'Field "key" is missing for FILE downloading.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 410, TYPE_FILE,
+                                               f'Field "key" is missing for FILE downloading.', {}))
             return
         logger.info(f'--> Download file/block of "key" {json_data[FIELD_KEY]}.')
 
@@ -470,21 +842,22 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
             if os.path.exists(join('tmp', username, json_data[FIELD_KEY])) is True:
                 logger.error(
                     f'<-- The "key" {json_data[FIELD_KEY]} is not completely uploaded. Please upload it first.')
-                connection_socket.send(
-                    make_response_packet(OP_GET, 404, TYPE_FILE,
-                                         f'The "key" {json_data[FIELD_KEY]} is not completely uploaded. '
-                                         f'Please upload it first',
-                                         {}))
+                send_buffers(connection_socket,
+                             make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                                   f'The "key" {json_data[FIELD_KEY]} is not completely uploaded. '
+                                                   f'Please upload it first',
+                                                   {}))
                 return
             logger.error(f'<-- The "key" {json_data[FIELD_KEY]} is not existing.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 404, TYPE_FILE, f'The "key" {json_data[FIELD_KEY]} is not existing.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 404, TYPE_FILE,
+                                               f'The "key" {json_data[FIELD_KEY]} is not existing.', {}))
             return
 
         if FIELD_BLOCK_INDEX not in json_data.keys():
             logger.error(f'<-- The "block_index" is compulsory.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_index" is compulsory.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 410, TYPE_FILE, f'The "block_index" is compulsory.', {}))
             return
         file_path = join('file', username, json_data[FIELD_KEY])
         file_size = getsize(file_path)
@@ -493,13 +866,13 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
         block_index = json_data[FIELD_BLOCK_INDEX]
         if block_index >= total_block:
             logger.error(f'<-- The "block_index" exceed the max index.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_index" exceed the max index.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 410, TYPE_FILE, f'The "block_index" exceed the max index.', {}))
             return
         if block_index < 0:
             logger.error(f'<-- The "block_index" should >= 0.')
-            connection_socket.send(
-                make_response_packet(OP_GET, 410, TYPE_FILE, f'The "block_index" should >= 0.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_GET, 410, TYPE_FILE, f'The "block_index" should >= 0.', {}))
             return
 
         with open(file_path, 'rb') as fid:
@@ -516,8 +889,8 @@ def file_process(username, request_operation, json_data, bin_data, connection_so
             }
             logger.info(f'<-- Return block {block_index}({len(bin_data)}bytes) of "key" {json_data[FIELD_KEY]} >= 0.')
 
-            connection_socket.send(make_response_packet(OP_DOWNLOAD, 200, TYPE_FILE,
-                                                        'An available block.', rval, bin_data))
+            send_buffers(connection_socket, make_response_buffers(OP_DOWNLOAD, 200, TYPE_FILE,
+                                                                  'An available block.', rval, bin_data))
 
 
 def STEP_service(connection_socket, addr):
@@ -540,8 +913,9 @@ def STEP_service(connection_socket, addr):
         # This is an Easter egg. Aha, this is a very good book.
         if FIELD_DIRECTION in json_data:
             if json_data[FIELD_DIRECTION] == DIR_EARTH:
-                connection_socket.send(
-                    make_response_packet('3BODY', 333, 'DANGEROUS', f'DO NOT ANSWER! DO NOT ANSWER! DO NOT ANSWER!', {}))
+                send_buffers(connection_socket,
+                             make_response_buffers('3BODY', 333, 'DANGEROUS',
+                                                   f'DO NOT ANSWER! DO NOT ANSWER! DO NOT ANSWER!', {}))
                 continue
 
         # Check the compulsory fields
@@ -550,9 +924,10 @@ def STEP_service(connection_socket, addr):
         check_ok = True
         for _compulsory_fields in compulsory_fields:
             if _compulsory_fields not in list(json_data.keys()):
-                connection_socket.send(
-                    make_response_packet(OP_ERROR, 400, 'ERROR', f'Compulsory field {_compulsory_fields} is missing.',
-                                         {}))
+                send_buffers(connection_socket,
+                             make_response_buffers(OP_ERROR, 400, 'ERROR',
+                                                   f'Compulsory field {_compulsory_fields} is missing.',
+                                                   {}))
                 check_ok = False
                 break
         if check_ok is False:
@@ -563,55 +938,58 @@ def STEP_service(connection_socket, addr):
         request_direction = json_data[FIELD_DIRECTION]
 
         if request_direction != DIR_REQUEST:
-            connection_socket.send(
-                make_response_packet(OP_ERROR, 407, 'ERROR', f'Wrong direction. Should be "REQUEST"', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_ERROR, 407, 'ERROR', f'Wrong direction. Should be "REQUEST"', {}))
             continue
 
         if request_operation not in [OP_SAVE, OP_DELETE, OP_GET, OP_UPLOAD, OP_DOWNLOAD, OP_BYE, OP_LOGIN]:
-            connection_socket.send(
-                make_response_packet(OP_ERROR, 408, 'ERROR', f'Operation {request_operation} is not allowed', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_ERROR, 408, 'ERROR',
+                                               f'Operation {request_operation} is not allowed', {}))
             continue
 
         if request_type not in [TYPE_FILE, TYPE_DATA, TYPE_AUTH]:
-            connection_socket.send(
-                make_response_packet(OP_ERROR, 409, 'ERROR', f'Type {request_type} is not allowed', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(OP_ERROR, 409, 'ERROR', f'Type {request_type} is not allowed', {}))
             continue
 
         if request_operation == OP_LOGIN:
             if request_type != TYPE_AUTH:
-                connection_socket.send(
-                    make_response_packet(OP_LOGIN, 409, TYPE_AUTH, f'Type of LOGIN has to be AUTH.', {}))
+                send_buffers(connection_socket,
+                             make_response_buffers(OP_LOGIN, 409, TYPE_AUTH, f'Type of LOGIN has to be AUTH.', {}))
                 continue
             else:
                 if FIELD_USERNAME not in json_data.keys():
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 410, TYPE_AUTH, f'"username" has to be a field for LOGIN', {}))
+                    send_buffers(connection_socket,
+                                 make_response_buffers(OP_LOGIN, 410, TYPE_AUTH,
+                                                       f'"username" has to be a field for LOGIN', {}))
                     continue
                 if FIELD_PASSWORD not in json_data.keys():
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 410, TYPE_AUTH, f'"password" has to be a field for LOGIN', {}))
+                    send_buffers(connection_socket,
+                                 make_response_buffers(OP_LOGIN, 410, TYPE_AUTH,
+                                                       f'"password" has to be a field for LOGIN', {}))
                     continue
 
                 # Check the username and password
                 if hashlib.md5(json_data[FIELD_USERNAME].encode()).hexdigest().lower() != json_data['password'].lower():
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 401, TYPE_AUTH, f'"Password error for login.', {}))
+                    send_buffers(connection_socket,
+                                 make_response_buffers(OP_LOGIN, 401, TYPE_AUTH, f'"Password error for login.', {}))
                     continue
                 else:
                     # Login successful
                     user_str = f'{json_data[FIELD_USERNAME].replace(".", "_")}.' \
                                f'{get_time_based_filename("login")}'
                     md5_auth_str = hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest()
-                    connection_socket.send(
-                        make_response_packet(OP_LOGIN, 200, TYPE_AUTH, f'Login successfully', {
-                            FIELD_TOKEN: base64.b64encode(f'{user_str}.{md5_auth_str}'.encode()).decode()
-                        }))
+                    login_token = base64.b64encode(f'{user_str}.{md5_auth_str}'.encode()).decode()
+                    send_buffers(connection_socket,
+                                 make_response_buffers(OP_LOGIN, 200, TYPE_AUTH, f'Login successfully',
+                                                       {FIELD_TOKEN: login_token}))
                     continue
 
         # If the operation is not LOGIN, check token
         if FIELD_TOKEN not in json_data.keys():
-            connection_socket.send(
-                make_response_packet(request_operation, 403, TYPE_AUTH, f'No token.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(request_operation, 403, TYPE_AUTH, f'No token.', {}))
             continue
 
         token = json_data[FIELD_TOKEN]
@@ -619,15 +997,15 @@ def STEP_service(connection_socket, addr):
         token: str
 
         if len(token.split('.')) != 4:
-            connection_socket.send(
-                make_response_packet(request_operation, 403, TYPE_AUTH, f'Token format is wrong.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(request_operation, 403, TYPE_AUTH, f'Token format is wrong.', {}))
             continue
 
         user_str = ".".join(token.split('.')[:3])
         md5_auth_str = token.split('.')[3]
         if hashlib.md5(f'{user_str}kjh20)*(1'.encode()).hexdigest().lower() != md5_auth_str.lower():
-            connection_socket.send(
-                make_response_packet(request_operation, 403, TYPE_AUTH, f'Token is wrong.', {}))
+            send_buffers(connection_socket,
+                         make_response_buffers(request_operation, 403, TYPE_AUTH, f'Token is wrong.', {}))
             continue
 
         username = token.split('.')[0]
@@ -635,6 +1013,8 @@ def STEP_service(connection_socket, addr):
         os.makedirs(join('data', username), exist_ok=True)
         os.makedirs(join('file', username), exist_ok=True)
         os.makedirs(join('tmp', username), exist_ok=True)
+        os.makedirs(join('state', username), exist_ok=True)
+        os.makedirs(join('meta', username), exist_ok=True)
 
         if request_type == TYPE_DATA:
             data_process(username, request_operation, json_data, connection_socket)
@@ -685,6 +1065,7 @@ def main():
 
     os.makedirs('data', exist_ok=True)
     os.makedirs('file', exist_ok=True)
+    os.makedirs('meta', exist_ok=True)
 
     tcp_listener(server_ip, server_port)
 
@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+from threading import Barrier, Event, Thread
+
+import benchmark
+import server
+
+
+class ConcurrentUploadTest(unittest.TestCase):
+    """
+    server.py with the blocks of one upload sent over several connections at once, as the client does
+    with --block-workers.
+    """
+    THREADS = 16
+    # One block per connection, so that the last blocks arrive together
+    BLOCKS = THREADS
+    ROUNDS = 20
+
+    @classmethod
+    def setUpClass(cls):
+        benchmark.enter_workdir()
+        logging.disable(logging.CRITICAL)
+        for folder in ['data', 'file', 'meta']:
+            os.makedirs(folder)
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind(('127.0.0.1', 0))
+        cls.port = probe.getsockname()[1]
+        probe.close()
+        Thread(target=server.tcp_listener, args=('127.0.0.1', cls.port), daemon=True).start()
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', cls.port)).close()
+                return
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        raise RuntimeError('server did not start')
+
+    def upload_concurrently(self, key, content):
+        clients = [benchmark.BenchClient(self.port) for _ in range(self.THREADS)]
+        plan, _ = clients[0].request({server.FIELD_TYPE: server.TYPE_FILE, server.FIELD_OPERATION: server.OP_SAVE,
+                                      server.FIELD_KEY: key, server.FIELD_SIZE: len(content)})
+        self.assertEqual(plan[server.FIELD_STATUS], 200, plan)
+        block_size = plan[server.FIELD_BLOCK_SIZE]
+        barrier = Barrier(self.THREADS)
+        responses = []
+
+        def upload(client, block_indexes):
+            barrier.wait()
+            for block_index in block_indexes:
+                resp, _ = client.request({server.FIELD_TYPE: server.TYPE_FILE,
+                                          server.FIELD_OPERATION: server.OP_UPLOAD,
+                                          server.FIELD_KEY: key, server.FIELD_BLOCK_INDEX: block_index},
+                                         content[block_size * block_index:block_size * (block_index + 1)])
+                responses.append(resp)
+
+        # Interleaved block indexes: all connections write to the same key at the same time
+        threads = [Thread(target=upload, args=(client, range(t, plan[server.FIELD_TOTAL_BLOCK], self.THREADS)))
+                   for t, client in enumerate(clients)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        for client in clients:
+            client.close()
+        return plan, responses
+
+    def test_blocks_of_one_upload_from_concurrent_connections(self):
+        for round_ in range(self.ROUNDS):
+            key = f'concurrent-{round_}'
+            content = os.urandom(server.MAX_PACKET_SIZE * self.BLOCKS - 123)
+            plan, responses = self.upload_concurrently(key, content)
+            self.assertEqual(len(responses), plan[server.FIELD_TOTAL_BLOCK])
+            for resp in responses:
+                self.assertIsNotNone(resp, 'no response from the server')
+                self.assertEqual(resp[server.FIELD_STATUS], 200, resp)
+            # Exactly one response completes the upload, with the MD5 of the content
+            md5s = [resp[server.FIELD_MD5] for resp in responses if server.FIELD_MD5 in resp]
+            self.assertEqual(md5s, [hashlib.md5(content).hexdigest()])
+            with open(os.path.join('file', 'bench', key), 'rb') as fid:
+                self.assertEqual(fid.read(), content)
+            self.assertFalse(os.path.exists(os.path.join('tmp', 'bench', key)))
+            self.assertFalse(os.path.exists(server.get_state_path('bench', key)))
+
+
+
+class PausingMd5:
+    """
+    An MD5 whose second update waits until `resume` is set, to hold a thread in the middle of hashing.
+    """
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.updates = 0
+        self.paused = Event()
+        self.resume = Event()
+
+    def update(self, data):
+        self.updates += 1
+        if self.updates == 2:
+            self.paused.set()
+            self.resume.wait(5)
+        self.md5.update(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+class UploadStateMd5Test(unittest.TestCase):
+    """
+    The running MD5 of an UploadState fed by two connection threads at once.
+    """
+
+    def test_block_read_back_by_another_thread_is_hashed_once(self):
+        block_size = 4096
+        workdir = tempfile.mkdtemp(prefix='step-test-')
+        self.addCleanup(shutil.rmtree, workdir, True)
+        file_path = os.path.join(workdir, 'tmp')
+        content = os.urandom(block_size * 3)
+        blocks = [content[block_size * i:block_size * (i + 1)] for i in range(3)]
+        with open(file_path, 'wb') as fid:
+            fid.write(content)
+        state = server.UploadState(file_path + '.state', 3, block_size)
+        state.md5 = PausingMd5()
+        # Block 1 arrives first; block 0 then extends the prefix and block 1 is read back from the file
+        # by the thread of block 0, while the thread of block 1 goes on to update_md5
+        self.assertTrue(state.add(1))
+        self.assertTrue(state.add(0))
+        reader = Thread(target=state.update_md5, args=(file_path, 0, blocks[0]))
+        reader.start()
+        self.assertTrue(state.md5.paused.wait(5))
+        state.update_md5(file_path, 1, blocks[1])
+        state.md5.resume.set()
+        reader.join()
+        self.assertTrue(state.add(2))
+        state.update_md5(file_path, 2, blocks[2])
+        self.assertEqual(state.hashed, 3)
+        self.assertEqual(state.get_md5(file_path), hashlib.md5(content).hexdigest())
+
+if __name__ == '__main__':
+    unittest.main()